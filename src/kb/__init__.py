@@ -1 +1,12 @@
+import time
+_start = time.perf_counter()
+
 from .kb import KB
+from .sharded import ShardedKB
+from .backends import BuildOptions
+from .server import KBServer
+from .client import KBClient
+from .log import Log
+
+# heavy dependencies, e.g. rdflib and matplotlib, are imported when first needed and report their own import times
+Log.get_logger().info(f"imported kb in {time.perf_counter() - _start:.3f}s")
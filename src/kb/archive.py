@@ -0,0 +1,178 @@
+import json
+import mmap
+import numpy as np
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, Optional
+from zipfile import BadZipFile, ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+from .config import Config
+from .parallel import resolve_n_jobs
+
+
+# local file header layout, see the zip file format specification
+_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+
+def member_data_offset(archive_path: str, info: ZipInfo) -> int:
+    """
+    A function to find where the data of an archive member starts in the archive file
+    :param archive_path: a path to the archive file
+    :param info: zip info of the member
+    :return: absolute offset of member data
+    """
+    with open(archive_path, 'rb') as f:
+        f.seek(info.header_offset)
+        header = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+    if header[0] != _LOCAL_HEADER_SIGNATURE:
+        raise ValueError(f"bad local header of `{info.filename}` in {archive_path}")
+    # local header may have a different extra field than the central directory, so read both lengths
+    name_length, extra_length = header[9], header[10]
+    return info.header_offset + _LOCAL_HEADER.size + name_length + extra_length
+
+
+def read_npy(archive: ZipFile, archive_path: str, name: str, mmap: bool = True) -> np.ndarray:
+    """
+    A function to read a .npy archive member. Members stored without compression are memory-mapped
+    straight from the archive file, compressed ones are read into memory
+    :param archive: opened archive
+    :param archive_path: a path to the archive file
+    :param name: member name
+    :param mmap: whether to memory-map the member if possible
+    :return: numpy array, np.memmap if member was memory-mapped
+    """
+    info = archive.getinfo(name)
+    if not mmap or info.compress_type != ZIP_STORED:
+        with archive.open(name) as f:
+            return np.load(f, allow_pickle=False)
+
+    offset = member_data_offset(archive_path, info)
+    with open(archive_path, 'rb') as f:
+        f.seek(offset)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+    if not np.prod(shape):
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(archive_path, dtype=dtype, mode='r', offset=data_offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def write_npy(archive: ZipFile, name: str, array: np.ndarray):
+    """
+    A function to stream a numpy array into an archive member without compression,
+    so that it can be memory-mapped with read_npy later
+    :param archive: archive opened for writing
+    :param name: member name
+    :param array: array to write
+    """
+    with open_member(archive, name, ZIP_STORED) as f:
+        np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+
+
+def open_member(archive: ZipFile, name: str, compress_type: Optional[int] = None) -> IO[bytes]:
+    """
+    A function to open an archive member for writing, so that a section is streamed into the archive
+    :param archive: archive opened for writing
+    :param name: member name
+    :param compress_type: ZIP_STORED or ZIP_DEFLATED, defaults to member_compression(name)
+    :return: a writable binary file object
+    """
+    info = ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = member_compression(name) if compress_type is None else compress_type
+    return archive.open(info, 'w', force_zip64=True)
+
+
+def member_compression(name: str) -> int:
+    """
+    A function to choose compression of an archive member. Media which is compressed already,
+    e.g. JPEG or PNG images, gains nothing from deflating it again and is stored as is
+    :param name: member name
+    :return: ZIP_STORED or ZIP_DEFLATED
+    """
+    if Path(name).suffix.lower() in Config.STORED_EXTENSIONS:
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+def write_manifest(archive: ZipFile, archive_path: str):
+    """
+    A function to add a manifest of data offsets, sizes and checksums of all members written so far.
+    It lets readers check the archive without reading local headers and verify sections in parallel
+    :param archive: archive opened for writing, it should be the last member written
+    :param archive_path: a path to the archive file being written
+    """
+    archive.fp.flush()
+    sections = []
+    for info in archive.infolist():
+        sections.append({'name': info.filename,
+                         'header_offset': info.header_offset,
+                         'offset': member_data_offset(archive_path, info),
+                         'size': info.compress_size,
+                         'file_size': info.file_size,
+                         'compress_type': info.compress_type,
+                         'crc32': info.CRC})
+    with open_member(archive, Config.ARCHIVE_MANIFEST_FILE, ZIP_DEFLATED) as f:
+        f.write(json.dumps({'version': 1, 'sections': sections}).encode('utf-8'))
+
+
+def verify_archive(archive: ZipFile, archive_path: str, full: bool = False, n_jobs: Optional[int] = None):
+    """
+    A function to check an archive against its manifest. The quick check compares the manifest with
+    the central directory and the file size, the full check also computes checksums of all sections.
+    Checksums of stored sections are computed over the memory-mapped file in parallel
+    :param archive: opened archive
+    :param archive_path: a path to the archive file
+    :param full: whether to verify checksums of section data
+    :param n_jobs: number of threads computing checksums
+    :raises BadZipFile: if the archive does not match its manifest or data is corrupt
+    """
+    if Config.ARCHIVE_MANIFEST_FILE not in archive.NameToInfo:
+        # archives written before the manifest was introduced
+        if full:
+            bad_member = archive.testzip()
+            if bad_member is not None:
+                raise BadZipFile(f"archive member `{bad_member}` of {archive_path} is corrupt")
+        return
+
+    sections = json.loads(archive.read(Config.ARCHIVE_MANIFEST_FILE))['sections']
+    file_size = os.path.getsize(archive_path)
+    for section in sections:
+        info = archive.NameToInfo.get(section['name'])
+        if info is None:
+            raise BadZipFile(f"archive member `{section['name']}` of {archive_path} is missing")
+        if (info.header_offset, info.compress_size, info.CRC) != \
+                (section['header_offset'], section['size'], section['crc32']) \
+                or section['offset'] + section['size'] > file_size:
+            raise BadZipFile(f"archive member `{section['name']}` of {archive_path} does not match the manifest")
+    if not full:
+        return
+
+    with open(archive_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        def check(section: dict) -> Optional[str]:
+            if section['compress_type'] != ZIP_STORED:
+                # reading a compressed member checks its checksum
+                try:
+                    archive.read(section['name'])
+                except BadZipFile:
+                    return section['name']
+                return None
+            crc = 0
+            for start in range(section['offset'], section['offset'] + section['size'], Config.COPY_BUFFER_SIZE):
+                stop = min(start + Config.COPY_BUFFER_SIZE, section['offset'] + section['size'])
+                crc = zlib.crc32(data[start:stop], crc)
+            return None if crc == section['crc32'] else section['name']
+
+        with ThreadPoolExecutor(max_workers=resolve_n_jobs(n_jobs)) as pool:
+            corrupt = [x for x in pool.map(check, sections) if x is not None]
+    if corrupt:
+        raise BadZipFile(f"{len(corrupt)} archive members of {archive_path} are corrupt, "
+                         f"first of them: {corrupt[:10]}")
+
@@ -0,0 +1,435 @@
+from annoy import AnnoyIndex
+import numpy as np
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple, Type, Union
+from .config import Config
+from .parallel import map_chunks
+from .archive import read_npy
+from .cache import load_cached_member
+from zipfile import ZipFile
+
+
+@dataclass
+class BuildOptions:
+    """
+    Options of search index build
+    """
+    # number of trees, defaults to Config.N_TREES. When set along with auto_tune, only search_k is tuned
+    n_trees: Optional[int] = None
+    # number of threads building the index, -1 means all cores
+    n_jobs: int = -1
+    # build the index in a file instead of memory, for indexes larger than RAM
+    on_disk: bool = False
+    # choose the smallest n_trees and search_k reaching target_recall within latency_budget_ms
+    auto_tune: bool = False
+    # recall@recall_k to reach when auto tuning
+    target_recall: float = 0.9
+    recall_k: int = 10
+    # average query latency in milliseconds not to exceed when auto tuning, None means no limit
+    latency_budget_ms: Optional[float] = None
+    # number of sampled queries used for auto tuning
+    n_tune_queries: int = 200
+    # number of neighbors of every item to precompute and store in the archive, 0 disables the table
+    knn_k: int = 0
+
+
+class SearchBackend:
+    """
+    An interface for nearest neighbor search engines used by the knowledge base.
+    Mirrors the part of the AnnoyIndex API the knowledge base relies on,
+    items are identified with dense internal ids 0..N-1
+    """
+    # name recorded in the archive metadata
+    NAME = None
+    # archive member the index is stored in
+    FILE_NAME = None
+
+    def __init__(self, vector_length: int, metric: str = Config.INDEX_METRIC):
+        """
+        :param vector_length: length of indexed vectors
+        :param metric: similarity metric, one of Config.INDEX_METRIC possible values
+        """
+        self.vector_length = vector_length
+        self.metric = metric
+
+    def add_item(self, i: int, vector: Union[Sequence[float], np.ndarray]):
+        raise NotImplementedError
+
+    def build(self, n_trees: int = Config.N_TREES, n_jobs: int = -1):
+        raise NotImplementedError
+
+    def unbuild(self):
+        raise NotImplementedError
+
+    def on_disk_build(self, path: str):
+        """
+        A method to build the index in a file instead of memory, should be called before adding items
+        :param path: a path to the index file
+        """
+        raise NotImplementedError
+
+    def save(self, path: str):
+        raise NotImplementedError
+
+    def load(self, path: str):
+        raise NotImplementedError
+
+    def unload(self):
+        raise NotImplementedError
+
+    def load_from_archive(self, archive: ZipFile, archive_path: str, digest: Optional[str] = None):
+        """
+        A method to load an index stored in an archive. By default the index file is taken
+        from the shared content-addressed cache, so processes loading the same index map one copy
+        :param archive: opened archive
+        :param archive_path: a path to the archive file
+        :param digest: content hash of the index file if known
+        """
+        load_cached_member(archive, self.FILE_NAME, self.load, digest)
+
+    def get_n_items(self) -> int:
+        raise NotImplementedError
+
+    def get_item_vector(self, i: int) -> List[float]:
+        raise NotImplementedError
+
+    def get_nns_by_item(self, i: int, n: int, search_k: int = -1, include_distances: bool = False):
+        raise NotImplementedError
+
+    def get_nns_by_vector(self, vector, n: int, search_k: int = -1, include_distances: bool = False):
+        raise NotImplementedError
+
+    def get_nns_by_items(self,
+                         items: np.ndarray,
+                         n: int,
+                         search_k: int = -1,
+                         n_jobs: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to query many items at once
+        :param items: internal ids to query, negative ids are skipped
+        :param n: number of neighbors per query
+        :param search_k: number of nodes to inspect during search
+        :param n_jobs: number of threads
+        :return: a tuple of (ids, distances) arrays of shape (len(items), n) padded with -1 and nan
+        """
+        items = np.asarray(items, dtype=np.int64)
+
+        def query(row):
+            if items[row] < 0:
+                return [], []
+            return self.get_nns_by_item(int(items[row]), n, search_k=search_k, include_distances=True)
+
+        return self._query_rows(len(items), n, query, n_jobs)
+
+    def get_nns_by_vectors(self,
+                           vectors: np.ndarray,
+                           n: int,
+                           search_k: int = -1,
+                           n_jobs: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to query many vectors at once
+        :param vectors: a 2-D array of query vectors
+        :param n: number of neighbors per query
+        :param search_k: number of nodes to inspect during search
+        :param n_jobs: number of threads
+        :return: a tuple of (ids, distances) arrays of shape (len(vectors), n) padded with -1 and nan
+        """
+        def query(row):
+            return self.get_nns_by_vector(vectors[row], n, search_k=search_k, include_distances=True)
+
+        return self._query_rows(len(vectors), n, query, n_jobs)
+
+    @staticmethod
+    def _query_rows(n_queries: int, n: int, query, n_jobs: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to run single queries over a thread pool and collect results into padded arrays
+        :param n_queries: number of queries
+        :param n: number of neighbors per query
+        :param query: a callable taking a row number and returning (ids, distances) lists
+        :param n_jobs: number of threads
+        :return: a tuple of (ids, distances) arrays of shape (n_queries, n)
+        """
+        ids = np.full((n_queries, n), -1, dtype=np.int64)
+        distances = np.full((n_queries, n), np.nan, dtype=np.float32)
+
+        def query_rows(start, stop):
+            for row in range(start, stop):
+                nearest, nearest_distances = query(row)
+                ids[row, :len(nearest)] = nearest
+                distances[row, :len(nearest)] = nearest_distances
+
+        map_chunks(n_queries, query_rows, n_jobs=n_jobs)
+        return ids, distances
+
+
+class AnnoyBackend(SearchBackend):
+    """
+    Approximate search with Annoy
+    """
+    NAME = 'annoy'
+    FILE_NAME = 'kb_index.ann'
+
+    def __init__(self, vector_length: int, metric: str = Config.INDEX_METRIC):
+        SearchBackend.__init__(self, vector_length, metric)
+        self._index = AnnoyIndex(vector_length, metric)
+        self._on_disk_path = None
+
+    def add_item(self, i, vector):
+        self._index.add_item(i, vector)
+
+    def build(self, n_trees=Config.N_TREES, n_jobs=-1):
+        self._index.build(n_trees, n_jobs=n_jobs)
+
+    def unbuild(self):
+        self._index.unbuild()
+
+    def on_disk_build(self, path):
+        self._on_disk_path = path
+        self._index.on_disk_build(path)
+
+    def save(self, path):
+        # index built on disk is already in its file
+        if self._on_disk_path and os.path.abspath(path) == os.path.abspath(self._on_disk_path):
+            return
+        self._index.save(path)
+
+    def load(self, path):
+        self._index.load(path)
+
+    def unload(self):
+        self._index.unload()
+
+    def get_n_items(self):
+        return self._index.get_n_items()
+
+    def get_item_vector(self, i):
+        return self._index.get_item_vector(i)
+
+    def get_nns_by_item(self, i, n, search_k=-1, include_distances=False):
+        # annoy releases the GIL while searching, so batch queries scale across threads
+        return self._index.get_nns_by_item(i, n, search_k=search_k, include_distances=include_distances)
+
+    def get_nns_by_vector(self, vector, n, search_k=-1, include_distances=False):
+        return self._index.get_nns_by_vector(vector, n, search_k=search_k, include_distances=include_distances)
+
+
+class BruteForceBackend(SearchBackend):
+    """
+    Exact search with blocked numpy matrix products over a float32 matrix.
+    The matrix is memory-mapped when loaded, so only the block being scanned has to be in memory.
+    Distances follow Annoy definitions, so both backends rank and report results the same way
+    """
+    NAME = 'brute_force'
+    FILE_NAME = 'kb_index.npy'
+
+    def __init__(self, vector_length: int, metric: str = Config.INDEX_METRIC):
+        if metric not in ('angular', 'euclidean', 'manhattan', 'hamming', 'dot'):
+            raise ValueError(f"unsupported metric `{metric}`")
+        SearchBackend.__init__(self, vector_length, metric)
+        self._items = dict()
+        self._matrix = None
+        self._on_disk_path = None
+        # squared norms of matrix rows, needed by angular, euclidean and hamming metrics
+        self._norms = None
+
+    def add_item(self, i, vector):
+        if self._matrix is not None:
+            raise RuntimeError("can not add items to a built index")
+        self._items[i] = np.asarray(vector, dtype=np.float32)
+
+    def build(self, n_trees=Config.N_TREES, n_jobs=-1):
+        # exact search does not need trees, just stack vectors into a matrix
+        # like annoy, ids which were never added become zero vectors
+        n_items = max(self._items) + 1 if self._items else 0
+        shape = (n_items, self.vector_length)
+        if self._on_disk_path:
+            matrix = np.lib.format.open_memmap(self._on_disk_path, mode='w+', dtype=np.float32, shape=shape)
+        else:
+            matrix = np.zeros(shape, dtype=np.float32)
+        for i, vector in self._items.items():
+            matrix[i] = vector
+        self._items = dict()
+        self._set_matrix(matrix)
+
+    def on_disk_build(self, path):
+        self._on_disk_path = path
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray, metric: str = Config.INDEX_METRIC) -> 'BruteForceBackend':
+        """
+        :param matrix: a 2-D array of vectors, row number is item id
+        :param metric: similarity metric
+        :return: a built index searching the given matrix
+        """
+        index = cls(matrix.shape[1], metric)
+        index._set_matrix(matrix)
+        return index
+
+    def save(self, path):
+        if self._on_disk_path and os.path.abspath(path) == os.path.abspath(self._on_disk_path):
+            self._matrix.flush()
+            return
+        np.save(path, np.asarray(self._matrix), allow_pickle=False)
+
+    def load(self, path):
+        self._set_matrix(np.load(path, mmap_mode='r', allow_pickle=False))
+
+    def unload(self):
+        self._matrix = None
+        self._norms = None
+
+    def load_from_archive(self, archive, archive_path, digest=None):
+        # the matrix is stored uncompressed, so it is memory-mapped straight from the archive
+        self._set_matrix(read_npy(archive, archive_path, self.FILE_NAME))
+
+    def get_n_items(self):
+        return len(self._matrix)
+
+    def get_item_vector(self, i):
+        return self._matrix[i].tolist()
+
+    def get_nns_by_item(self, i, n, search_k=-1, include_distances=False):
+        return self.get_nns_by_vector(self._matrix[i], n, search_k=search_k, include_distances=include_distances)
+
+    def get_nns_by_vector(self, vector, n, search_k=-1, include_distances=False):
+        ids, distances = self._search(np.asarray(vector, dtype=np.float32).reshape(1, -1), n)
+        count = int((ids[0] >= 0).sum())
+        nearest = ids[0, :count].tolist()
+        if include_distances:
+            return nearest, distances[0, :count].tolist()
+        return nearest
+
+    def get_nns_by_items(self, items, n, search_k=-1, n_jobs=None):
+        items = np.asarray(items, dtype=np.int64)
+        n = max(0, n)
+        valid = items >= 0
+        ids = np.full((len(items), n), -1, dtype=np.int64)
+        distances = np.full((len(items), n), np.nan, dtype=np.float32)
+        ids[valid], distances[valid] = self.get_nns_by_vectors(self._matrix[items[valid]], n, n_jobs=n_jobs)
+        return ids, distances
+
+    def get_nns_by_vectors(self, vectors, n, search_k=-1, n_jobs=None):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n = max(0, n)
+        ids = np.full((len(vectors), n), -1, dtype=np.int64)
+        distances = np.full((len(vectors), n), np.nan, dtype=np.float32)
+
+        def query_rows(start, stop):
+            for block_start in range(start, stop, Config.BRUTE_FORCE_QUERY_BLOCK):
+                block_stop = min(stop, block_start + Config.BRUTE_FORCE_QUERY_BLOCK)
+                ids[block_start:block_stop], distances[block_start:block_stop] = \
+                    self._search(vectors[block_start:block_stop], n)
+
+        # numpy releases the GIL inside matrix products
+        map_chunks(len(vectors), query_rows, n_jobs=n_jobs, chunks_per_worker=1)
+        return ids, distances
+
+    def _set_matrix(self, matrix: np.ndarray):
+        self._matrix = matrix
+        self._norms = None
+        if self.metric in ('angular', 'euclidean'):
+            self._norms = self._row_norms(matrix)
+        elif self.metric == 'hamming':
+            self._norms = self._row_norms(matrix > 0.5)
+
+    @staticmethod
+    def _row_norms(matrix: np.ndarray) -> np.ndarray:
+        """
+        :param matrix: a matrix to compute squared row norms for, processed block by block
+        :return: a float32 array of squared row norms
+        """
+        norms = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), Config.BRUTE_FORCE_ITEM_BLOCK):
+            block = np.asarray(matrix[start:start + Config.BRUTE_FORCE_ITEM_BLOCK], dtype=np.float32)
+            norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+        return norms
+
+    def _distances(self, queries: np.ndarray, start: int, stop: int) -> np.ndarray:
+        """
+        A method to compute distances between queries and a block of indexed items
+        :param queries: a 2-D float32 array of queries
+        :param start: first item of the block
+        :param stop: item after the last one of the block
+        :return: a (len(queries), stop - start) array of distances, smaller is closer
+        """
+        block = np.asarray(self._matrix[start:stop], dtype=np.float32)
+        if self.metric == 'manhattan':
+            return np.abs(queries[:, None, :] - block[None, :, :]).sum(axis=2)
+        if self.metric == 'dot':
+            # the bigger the product the closer the items
+            return -(queries @ block.T)
+        if self.metric == 'hamming':
+            bits_queries = (queries > 0.5).astype(np.float32)
+            bits_block = (block > 0.5).astype(np.float32)
+            q_norms = bits_queries.sum(axis=1)
+            return q_norms[:, None] + self._norms[None, start:stop] - 2 * (bits_queries @ bits_block.T)
+
+        q_norms = np.einsum('ij,ij->i', queries, queries)
+        products = queries @ block.T
+        if self.metric == 'euclidean':
+            return np.sqrt(np.maximum(q_norms[:, None] + self._norms[None, start:stop] - 2 * products, 0))
+        # angular distance as in annoy: euclidean distance of normalized vectors
+        denominator = np.sqrt(q_norms[:, None] * self._norms[None, start:stop])
+        cosine = np.divide(products, denominator, out=np.zeros_like(products), where=denominator > 0)
+        return np.sqrt(np.maximum(2 - 2 * cosine, 0))
+
+    def _search(self, queries: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to find exact top-n neighbors of queries scanning items block by block
+        :param queries: a 2-D float32 array of queries
+        :param n: number of neighbors, no neighbors are returned if it is not positive as in annoy
+        :return: a tuple of (ids, distances) arrays of shape (len(queries), n) padded with -1 and nan
+        """
+        n_queries = len(queries)
+        n = max(0, n)
+        if n == 0:
+            return np.full((n_queries, 0), -1, dtype=np.int64), np.full((n_queries, 0), np.nan, dtype=np.float32)
+        n_items = self.get_n_items()
+        best_ids = np.full((n_queries, 0), -1, dtype=np.int64)
+        best_distances = np.full((n_queries, 0), np.inf, dtype=np.float32)
+
+        # manhattan distance broadcasts over all dimensions so it needs smaller blocks
+        item_block = Config.BRUTE_FORCE_ITEM_BLOCK
+        if self.metric == 'manhattan':
+            item_block = max(1, item_block // max(1, self.vector_length))
+
+        for start in range(0, n_items, item_block):
+            stop = min(n_items, start + item_block)
+            distances = np.concatenate([best_distances, self._distances(queries, start, stop)], axis=1)
+            ids = np.concatenate([best_ids, np.broadcast_to(np.arange(start, stop), (n_queries, stop - start))],
+                                 axis=1)
+            if distances.shape[1] > n:
+                top = np.argpartition(distances, n - 1, axis=1)[:, :n]
+                distances = np.take_along_axis(distances, top, axis=1)
+                ids = np.take_along_axis(ids, top, axis=1)
+            best_distances, best_ids = distances.astype(np.float32), ids
+
+        order = np.argsort(best_distances, axis=1, kind='stable')
+        best_distances = np.take_along_axis(best_distances, order, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+        if self.metric == 'dot':
+            best_distances = -best_distances
+
+        ids = np.full((n_queries, n), -1, dtype=np.int64)
+        distances = np.full((n_queries, n), np.nan, dtype=np.float32)
+        ids[:, :best_ids.shape[1]] = best_ids
+        distances[:, :best_distances.shape[1]] = best_distances
+        return ids, distances
+
+
+# search backends by the name recorded in the archive
+BACKENDS: Dict[str, Type[SearchBackend]] = {
+    AnnoyBackend.NAME: AnnoyBackend,
+    BruteForceBackend.NAME: BruteForceBackend,
+}
+
+
+def get_backend(name: str) -> Type[SearchBackend]:
+    """
+    :param name: backend name
+    :return: search backend class
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"unknown search backend `{name}`, possible values: {list(BACKENDS)}")
+    return BACKENDS[name]
@@ -0,0 +1,183 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from typing import Dict, Optional, Tuple
+from .backends import BruteForceBackend, BuildOptions
+from .config import Config
+from .kb import KB
+from .log import Log
+from .metrics import stage_times
+from .synthetic import make_synthetic_kb
+from .tuning import measure_recall
+
+log = Log.get_logger()
+
+
+def run_benchmark(directory: Optional[str] = None,
+                  n_entities: int = 10000,
+                  vector_length: int = 64,
+                  n_queries: int = 1000,
+                  k_nearest: int = 10,
+                  backend: str = Config.INDEX_BACKEND,
+                  build_options: Optional[BuildOptions] = None,
+                  n_jobs: Optional[int] = None,
+                  data_format: str = 'ttl',
+                  image_share: float = 0.1,
+                  n_repeats: int = 3,
+                  seed: int = 0,
+                  out_path: Optional[str] = None) -> dict:
+    """
+    A function to measure build and query performance of a knowledge base on synthetic data:
+    time of every read_raw stage, cold and warm read_ttlplus, select_similar latency percentiles
+    and throughput, and recall@k against exact search
+    :param directory: a directory for generated input and the archive, a temporary one is used and removed if None
+    :param n_entities: number of entities
+    :param vector_length: length of embeddings
+    :param n_queries: number of select_similar queries
+    :param k_nearest: number of neighbors per query, also k of recall@k
+    :param backend: search backend, one of backends.BACKENDS keys
+    :param build_options: search index build options
+    :param n_jobs: number of threads and processes used by read_raw and batch queries
+    :param data_format: graph serialization, one of synthetic.SYNTHETIC_FORMATS
+    :param image_share: share of entities with an image
+    :param n_repeats: number of warm reads, the fastest one is reported
+    :param seed: random seed of data and queries
+    :param out_path: optional, a path to write results to as JSON
+    :return: a dict of results, times are in seconds unless their names say otherwise
+    """
+    results = {'params': {'n_entities': n_entities, 'vector_length': vector_length, 'n_queries': n_queries,
+                          'k_nearest': k_nearest, 'backend': backend, 'n_jobs': n_jobs,
+                          'data_format': data_format, 'image_share': image_share, 'seed': seed},
+               'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                               'numpy': np.__version__, 'cpu_count': os.cpu_count()}}
+    root = directory or tempfile.mkdtemp(prefix='_kb_benchmark_')
+    try:
+        start = time.perf_counter()
+        inputs = make_synthetic_kb(os.path.join(root, 'input'), n_entities=n_entities, vector_length=vector_length,
+                                   image_share=image_share, data_format=data_format, seed=seed)
+        results['generate'] = time.perf_counter() - start
+
+        out_dir = os.path.join(root, 'kb')
+        os.makedirs(out_dir, exist_ok=True)
+        results['build'], results['enrich'] = _time_read_raw(out_dir, inputs, backend=backend, n_jobs=n_jobs,
+                                                             build_options=build_options)
+        ttlplus_path = os.path.join(out_dir, 'kb.ttlplus')
+        results['archive_bytes'] = os.path.getsize(ttlplus_path)
+        results['read'] = _time_read_ttlplus(ttlplus_path, n_repeats)
+
+        kb = KB()
+        kb.read_ttlplus(ttlplus_path)
+        rng = np.random.default_rng(seed)
+        internal_ids = rng.choice(len(kb._id_map), size=min(n_queries, len(kb._id_map)), replace=False)
+        results['query'] = _time_queries(kb, kb._id_map.to_external_many(internal_ids), k_nearest, n_jobs)
+        results['recall'] = _measure_recall(kb, internal_ids, k_nearest)
+    finally:
+        if directory is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if out_path:
+        with open(out_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    log.info(f"benchmark results: {json.dumps(results)}")
+    return results
+
+
+def _time_read_raw(out_dir: str,
+                   inputs: dict,
+                   backend: str,
+                   n_jobs: Optional[int],
+                   build_options: Optional[BuildOptions]) -> Tuple[Dict[str, float], Dict[str, int]]:
+    """
+    :return: a tuple of time of every read_raw stage and of the whole call, and counts of enriched entities
+    """
+    kb = KB()
+    kb.metrics.enable()
+    start = time.perf_counter()
+    kb.read_raw(out_bk_path_dir=out_dir, backend=backend, n_jobs=n_jobs, build_options=build_options, **inputs)
+    total = time.perf_counter() - start
+    snapshot = kb.metrics.snapshot()
+    timings = stage_times(snapshot, 'read_raw.')
+    timings['total'] = total
+    counts = {name[len('enrich.'):]: x for name, x in snapshot['counters'].items() if name.startswith('enrich.')}
+    return timings, counts
+
+
+def _time_read_ttlplus(ttlplus_path: str, n_repeats: int) -> Dict[str, float]:
+    """
+    Cold reads run in a new interpreter with an empty index cache, warm reads follow each other in this process
+    :return: time of cold full and lazy reads and of the fastest warm read
+    """
+    results = dict()
+    for name, lazy in (('cold', False), ('cold_lazy', True)):
+        with tempfile.TemporaryDirectory(prefix='_kb_cache_') as cache_dir:
+            results[name] = _cold_read(ttlplus_path, cache_dir, lazy)
+
+    warm = []
+    for _ in range(max(1, n_repeats)):
+        start = time.perf_counter()
+        KB().read_ttlplus(ttlplus_path)
+        warm.append(time.perf_counter() - start)
+    results['warm'] = min(warm)
+    return results
+
+
+def _cold_read(ttlplus_path: str, cache_dir: str, lazy: bool) -> float:
+    """
+    A function to read a knowledge base in a new interpreter. A plain subprocess is used rather than
+    a multiprocessing one, which would import the main module of the caller again
+    :return: time of read_ttlplus, not counting interpreter start and imports
+    """
+    package = __name__.rpartition('.')[0]
+    code = (f"import sys, time\n"
+            f"from {package} import KB\n"
+            f"start = time.perf_counter()\n"
+            f"KB().read_ttlplus(sys.argv[1], lazy=sys.argv[2] == 'lazy')\n"
+            f"print(time.perf_counter() - start)\n")
+    env = dict(os.environ, KB_CACHE_DIR=cache_dir, PYTHONPATH=os.pathsep.join(x for x in sys.path if x))
+    output = subprocess.run([sys.executable, '-c', code, ttlplus_path, 'lazy' if lazy else 'full'],
+                            env=env, capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def _time_queries(kb: KB, entity_ids: np.ndarray, k_nearest: int, n_jobs: Optional[int]) -> Dict[str, float]:
+    """
+    Queries are distinct, so that the result cache does not answer them
+    :return: latency percentiles in milliseconds and throughput in queries per second
+        of single and batch queries
+    """
+    latencies = np.empty(len(entity_ids))
+    for i, entity_id in enumerate(entity_ids.tolist()):
+        start = time.perf_counter()
+        kb.select_similar(entity_id, k_nearest)
+        latencies[i] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    kb.select_similar_many(entity_ids, k_nearest, n_jobs=n_jobs)
+    batch_time = time.perf_counter() - start
+
+    latencies_ms = latencies * 1000
+    return {'p50_ms': float(np.percentile(latencies_ms, 50)),
+            'p99_ms': float(np.percentile(latencies_ms, 99)),
+            'mean_ms': float(latencies_ms.mean()),
+            'max_ms': float(latencies_ms.max()),
+            'throughput_qps': len(latencies) / max(latencies.sum(), 1e-9),
+            'batch_throughput_qps': len(entity_ids) / max(batch_time, 1e-9)}
+
+
+def _measure_recall(kb: KB, internal_ids: np.ndarray, k_nearest: int) -> Dict[str, float]:
+    """
+    :return: recall@k of the search index against exact search over the embedding matrix,
+        queries are indexed items which are left out of their own neighbors
+    """
+    queries = np.asarray(kb._main_vectors(internal_ids), dtype=np.float32)
+    matrix = kb._embeddings if kb._embeddings is not None else kb._main_vectors(np.arange(len(kb._id_map)))
+    exact_ids, _ = BruteForceBackend.from_matrix(matrix, kb._index.metric).get_nns_by_vectors(queries, k_nearest + 1)
+    measured = measure_recall(kb._index, queries, exact_ids, k_nearest, kb._search_k(), internal_ids)
+    return {'k': k_nearest, 'recall': measured['recall'], 'latency_ms': measured['latency_ms']}
+
@@ -0,0 +1,161 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from zipfile import ZipFile
+from typing import Callable, Optional, TypeVar
+from .config import Config
+from .log import Log
+
+
+log = Log.get_logger()
+
+T = TypeVar('T')
+
+
+def cache_dir() -> str:
+    """
+    :return: root of the shared cache, KB_CACHE_DIR environment variable overrides Config.CACHE_DIR
+    """
+    return os.path.expanduser(os.environ.get('KB_CACHE_DIR', Config.CACHE_DIR))
+
+
+def file_sha256(path: str) -> str:
+    """
+    :param path: a path to a file
+    :return: hex sha256 digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(Config.COPY_BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_member_path(archive: ZipFile, name: str, digest: Optional[str] = None) -> str:
+    """
+    A function to get a path to an archive member in a content-addressed cache shared by processes.
+    The member is copied to the cache once, all later calls with the same contents reuse it,
+    so many workers map a single copy of the file. Adding an entry prunes old ones, see prune_cache()
+    :param archive: opened archive
+    :param name: member name
+    :param digest: content hash of the member if known. Otherwise crc32 and size recorded
+        in the archive directory are used as a key
+    :return: a path to the cached member
+    """
+    info = archive.getinfo(name)
+    key = digest or f"crc32-{info.CRC:08x}-{info.file_size}"
+
+    for root in (cache_dir(), os.path.join(tempfile.gettempdir(), 'kb-cache')):
+        path = os.path.join(root, key, os.path.basename(name))
+        if os.path.exists(path) and os.path.getsize(path) == info.file_size:
+            _touch(os.path.dirname(path))
+            return path
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # copy to a unique temporary file and atomically move it in place,
+            # concurrent writers of the same key produce identical files so the last one wins harmlessly
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+            try:
+                with os.fdopen(fd, 'wb') as dst, archive.open(name) as src:
+                    shutil.copyfileobj(src, dst, Config.COPY_BUFFER_SIZE)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            log.info(f"cached `{name}` at {path}")
+            prune_cache(root, keep=key)
+            return path
+        except OSError as e:
+            log.warning(f"can not use cache directory {root}: {e}")
+
+    raise OSError(f"can not cache `{name}`, no writable cache directory")
+
+
+def load_cached_member(archive: ZipFile, name: str, load: Callable[[str], T], digest: Optional[str] = None) -> T:
+    """
+    A function to load an archive member from the shared cache, see cached_member_path(). Another process may
+    remove the entry between resolving its path and loading the file, e.g. compaction in a server worker,
+    so a member whose file is gone is copied to the cache again
+    :param archive: opened archive
+    :param name: member name
+    :param load: a callable taking a path to the cached member
+    :param digest: content hash of the member if known
+    :return: whatever load returns
+    """
+    path = cached_member_path(archive, name, digest)
+    try:
+        return load(path)
+    except OSError:
+        if os.path.exists(path):
+            raise
+        log.warning(f"cache entry {path} was removed before it was loaded, copying `{name}` again")
+    return load(cached_member_path(archive, name, digest))
+
+
+def remove_cached(digest: str):
+    """
+    A function to remove the cache entry of an outdated member, e.g. of an index replaced by compaction.
+    Processes which have the file mapped already keep using it, files in use on Windows are left in place.
+    Processes about to load it copy it again, see load_cached_member()
+    :param digest: content hash the member was cached under
+    """
+    for root in (cache_dir(), os.path.join(tempfile.gettempdir(), 'kb-cache')):
+        path = os.path.join(root, digest)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            log.info(f"removed outdated cache entry {path}")
+
+
+def prune_cache(root: Optional[str] = None,
+                max_bytes: int = Config.CACHE_MAX_BYTES,
+                max_age: float = Config.CACHE_MAX_AGE,
+                keep: Optional[str] = None,
+                grace_period: float = Config.CACHE_GRACE_PERIOD):
+    """
+    A function to remove cache entries which were not used for longer than max_age, and then least recently
+    used entries until the rest takes at most max_bytes. Entries are directories named after content keys,
+    their modification time is refreshed whenever they are used
+    :param root: cache root, defaults to cache_dir()
+    :param max_bytes: maximum total size of cached files
+    :param max_age: time in seconds an entry is kept without being used
+    :param keep: optional, key of an entry which should not be removed, e.g. the one just added
+    :param grace_period: time in seconds an entry used recently is kept even if the cache is too big,
+        so a process which has just resolved its path can still load it
+    """
+    root = root or cache_dir()
+    entries = []
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_dir():
+                    size = sum(os.path.getsize(os.path.join(entry.path, x)) for x in os.listdir(entry.path))
+                    entries.append((entry.stat().st_mtime, size, entry.path, entry.name))
+    except OSError as e:
+        log.warning(f"can not list cache directory {root}: {e}")
+        return
+
+    total = sum(x[1] for x in entries)
+    now = time.time()
+    # least recently used entries come first
+    for mtime, size, path, key in sorted(entries):
+        if (now - mtime <= max_age and total <= max_bytes) or now - mtime <= grace_period:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        if not os.path.exists(path):
+            total -= size
+            log.info(f"removed cache entry {path}")
+
+
+def _touch(path: str):
+    """
+    A function to mark a cache entry as used
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
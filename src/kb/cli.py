@@ -0,0 +1,65 @@
+import argparse
+import json
+from typing import List, Optional
+from .config import Config
+
+
+def main(argv: Optional[List[str]] = None):
+    """
+    Entry point of the `kb` command
+    :param argv: command line arguments, sys.argv is used if None
+    """
+    parser = argparse.ArgumentParser(prog='kb', description="a tool to work with graphs enriched with embeddings")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help="serve similarity search over a local HTTP API")
+    serve.add_argument('path', help="a path to a .ttlplus file or to a manifest of a sharded knowledge base")
+    serve.add_argument('--host', default=Config.SERVER_HOST, help="host to listen on")
+    serve.add_argument('--port', type=int, default=Config.SERVER_PORT, help="port to listen on")
+    serve.add_argument('--workers', type=int, default=Config.SERVER_WORKERS, help="number of worker processes")
+    serve.add_argument('--batch-window', type=float, default=Config.BATCH_WINDOW * 1000,
+                       help="time in milliseconds concurrent requests are collected for")
+    serve.add_argument('--max-batch', type=int, default=Config.MAX_BATCH,
+                       help="number of queries answered at once without waiting for the window to end")
+    serve.add_argument('--n-jobs', type=int, default=None, help="number of threads every batch is spread over")
+    serve.add_argument('--metrics', action='store_true', help="record timings and counters served at /metrics")
+
+    bench = commands.add_parser('bench', help="measure build and query performance on a synthetic knowledge base")
+    bench.add_argument('--entities', type=int, default=10000, help="number of entities")
+    bench.add_argument('--vector-length', type=int, default=64, help="length of embeddings")
+    bench.add_argument('--queries', type=int, default=1000, help="number of select_similar queries")
+    bench.add_argument('--k', type=int, default=10, help="number of neighbors per query and k of recall@k")
+    bench.add_argument('--backend', default=Config.INDEX_BACKEND, help="search backend")
+    bench.add_argument('--n-jobs', type=int, default=None, help="number of threads and processes")
+    bench.add_argument('--format', default='ttl', help="graph serialization: ttl, nt or nt.gz")
+    bench.add_argument('--dir', default=None, help="a directory to keep generated data in, temporary if omitted")
+    bench.add_argument('--out', default=None, help="a path to write JSON results to, printed if omitted")
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        # the server module imports the knowledge base, so that `kb --help` stays fast
+        from .server import KBServer, read_kb
+        kb = read_kb(args.path)
+        if args.metrics and hasattr(kb, 'metrics'):
+            kb.metrics.enable()
+        server = KBServer(kb,
+                          host=args.host,
+                          port=args.port,
+                          n_workers=args.workers,
+                          batch_window=args.batch_window / 1000,
+                          max_batch=args.max_batch,
+                          n_jobs=args.n_jobs)
+        server.serve_forever()
+    elif args.command == 'bench':
+        from .benchmark import run_benchmark
+        results = run_benchmark(directory=args.dir,
+                                n_entities=args.entities,
+                                vector_length=args.vector_length,
+                                n_queries=args.queries,
+                                k_nearest=args.k,
+                                backend=args.backend,
+                                n_jobs=args.n_jobs,
+                                data_format=args.format,
+                                out_path=args.out)
+        if not args.out:
+            print(json.dumps(results, indent=2))
@@ -0,0 +1,165 @@
+import http.client
+import json
+import numpy as np
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+from .config import Config
+
+
+# filters which can be sent to the server: a set of entity ids or a SPARQL query
+RemoteFilter = Union[str, Iterable[int]]
+
+
+class KBClient:
+    """
+    A client of KBServer mirroring search methods of KB. It keeps one connection open,
+    so an instance should not be shared between threads
+    """
+    def __init__(self, host: str = Config.SERVER_HOST, port: int = Config.SERVER_PORT, timeout: float = 60.0):
+        """
+        :param host: server host
+        :param port: server port
+        :param timeout: time in seconds to wait for a response
+        """
+        self._connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def health(self) -> dict:
+        """
+        :return: a dict with `status` and `pid` of the worker which answered
+        """
+        return self._request('GET', '/health')
+
+    def metrics(self) -> dict:
+        """
+        :return: a snapshot of metrics of the worker which answered along with its `pid`,
+            see KB.metrics_snapshot(). Workers record metrics separately
+        """
+        return self._request('GET', '/metrics')
+
+    def select_similar(self,
+                       entity_id: int,
+                       k_nearest: int = 10,
+                       search_k: Optional[int] = None,
+                       include_distances: bool = False,
+                       filter_by: Optional[RemoteFilter] = None) -> Union[List[int], Tuple[List[int], List[float]]]:
+        """
+        A method to select k nearest to the entity with the given integer id, see KB.select_similar()
+        :param entity_id: entity id whose closest neighbors we want
+        :param k_nearest: a number of neighbors we want
+        :param search_k: number of nodes to inspect during search, defaults to the knowledge base value
+        :param include_distances: whether to return distances along with ids
+        :param filter_by: optional, a set of entity ids or a SPARQL query restricting neighbors
+        :return: a list of int ids of closest neighbors or a tuple of (ids, distances) lists
+        """
+        ids, distances = self.select_similar_many([entity_id], k_nearest=k_nearest, search_k=search_k,
+                                                  filter_by=filter_by)
+        return self._format_result(ids[0], distances[0], include_distances)
+
+    def select_similar_by_vector(self,
+                                 vector: Union[Sequence[float], np.ndarray],
+                                 k_nearest: int = 10,
+                                 search_k: Optional[int] = None,
+                                 include_distances: bool = False,
+                                 filter_by: Optional[RemoteFilter] = None) \
+            -> Union[List[int], Tuple[List[int], List[float]]]:
+        """
+        A method to select k nearest to an arbitrary vector, see KB.select_similar_by_vector()
+        :param vector: query vector, its length should match the knowledge base embeddings
+        :param k_nearest: a number of neighbors we want
+        :param search_k: number of nodes to inspect during search, defaults to the knowledge base value
+        :param include_distances: whether to return distances along with ids
+        :param filter_by: optional, a set of entity ids or a SPARQL query restricting neighbors
+        :return: a list of int ids of closest neighbors or a tuple of (ids, distances) lists
+        """
+        ids, distances = self.select_similar_many(vectors=np.asarray(vector, dtype=np.float32).reshape(1, -1),
+                                                  k_nearest=k_nearest, search_k=search_k, filter_by=filter_by)
+        return self._format_result(ids[0], distances[0], include_distances)
+
+    def select_similar_many(self,
+                            entity_ids: Optional[Union[Sequence[int], np.ndarray]] = None,
+                            k_nearest: int = 10,
+                            vectors: Optional[np.ndarray] = None,
+                            search_k: Optional[int] = None,
+                            filter_by: Optional[RemoteFilter] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to select k nearest neighbors for many entities or query vectors at once.
+        Exactly one of entity_ids and vectors should be given, see KB.select_similar_many()
+        :param entity_ids: a sequence or array of entity ids whose closest neighbors we want
+        :param k_nearest: a number of neighbors we want per query
+        :param vectors: a 2-D array of query vectors, one per row
+        :param search_k: number of nodes to inspect during search, defaults to the knowledge base value
+        :param filter_by: optional, a set of entity ids or a SPARQL query restricting neighbors
+        :return: a tuple of (ids, distances) arrays of shape (n_queries, k_nearest).
+            Rows of missing entities and slots without a neighbor hold -1 in ids and nan in distances
+        """
+        if (entity_ids is None) == (vectors is None):
+            raise ValueError("exactly one of `entity_ids` and `vectors` should be provided")
+        if filter_by is not None and not isinstance(filter_by, str):
+            filter_by = np.asarray(list(filter_by), dtype=np.int64).tolist()
+        request = {'k_nearest': k_nearest, 'search_k': search_k, 'filter_by': filter_by}
+        if entity_ids is not None:
+            request['entity_ids'] = np.asarray(entity_ids, dtype=np.int64).ravel().tolist()
+            response = self._request('POST', '/select_similar', request)
+        else:
+            request['vectors'] = np.asarray(vectors, dtype=np.float32).tolist()
+            response = self._request('POST', '/select_similar_by_vector', request)
+        ids = np.asarray(response['ids'], dtype=np.int64).reshape(-1, k_nearest)
+        distances = np.asarray(response['distances'], dtype=np.float32).reshape(-1, k_nearest)
+        return ids, distances
+
+    def get_embeddings(self, entity_ids: Union[Sequence[int], np.ndarray]) -> np.ndarray:
+        """
+        A method to get embeddings of many entities at once, see KB.get_embeddings()
+        :param entity_ids: a sequence or array of entity ids
+        :return: a 2-D array with one embedding per row, rows of entities without embeddings are filled with nan
+        """
+        entity_ids = np.asarray(entity_ids, dtype=np.int64).ravel()
+        response = self._request('POST', '/embeddings', {'entity_ids': entity_ids.tolist()})
+        # None of missing values turns into nan
+        return np.asarray(response['embeddings'], dtype=np.float32).reshape(len(entity_ids), -1)
+
+    def close(self):
+        """
+        A method to close the connection to the server
+        """
+        self._connection.close()
+
+    def __enter__(self) -> 'KBClient':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _request(self, method: str, path: str, request: Optional[dict] = None) -> dict:
+        """
+        :param method: HTTP method
+        :param path: API path
+        :param request: request body
+        :return: response body
+        """
+        body = None if request is None else json.dumps(request).encode('utf-8')
+        headers = {'Content-Type': 'application/json'} if body is not None else dict()
+        try:
+            self._connection.request(method, path, body=body, headers=headers)
+            response = self._connection.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            # the server closed a kept alive connection, the request is sent once more on a new one
+            self._connection.close()
+            self._connection.request(method, path, body=body, headers=headers)
+            response = self._connection.getresponse()
+        result = json.loads(response.read())
+        if response.status == 400:
+            raise ValueError(result['error'])
+        if response.status != 200:
+            raise RuntimeError(f"server responded with {response.status}: {result.get('error')}")
+        return result
+
+    @staticmethod
+    def _format_result(ids: np.ndarray,
+                       distances: np.ndarray,
+                       include_distances: bool) -> Union[List[int], Tuple[List[int], List[float]]]:
+        """
+        :return: ids of found neighbors, with their distances if requested, in the format of KB.select_similar()
+        """
+        found = ids >= 0
+        ids, distances = ids[found].tolist(), distances[found].tolist()
+        return (ids, distances) if include_distances else ids
@@ -0,0 +1,251 @@
+import numpy as np
+from array import array
+import rdflib
+from rdflib import BNode, Literal, URIRef
+from rdflib.term import Node
+from functools import lru_cache
+from zipfile import ZipFile
+from typing import Iterable, Iterator, Optional, Tuple
+from .archive import read_npy, write_npy
+from .config import Config
+from .lookup import PackedStrings
+
+
+# separates lexical form, datatype and language of literals in term keys
+_SEPARATOR = '\x00'
+
+
+def term_key(term: Node) -> str:
+    """
+    A function to encode an rdflib term as a string. Keys of different terms are different,
+    and sorting keys groups terms by kind
+    :param term: URIRef, BNode or Literal
+    :return: term key
+    """
+    if isinstance(term, Literal):
+        return f"L{term}{_SEPARATOR}{term.datatype or ''}{_SEPARATOR}{term.language or ''}"
+    if isinstance(term, BNode):
+        return f"B{term}"
+    if isinstance(term, URIRef):
+        return f"U{term}"
+    raise TypeError(f"can not encode term of type {type(term).__name__}")
+
+
+def key_term(key: str) -> Node:
+    """
+    A function to decode a term key back to rdflib term
+    :param key: term key
+    :return: URIRef, BNode or Literal
+    """
+    kind, value = key[0], key[1:]
+    if kind == 'U':
+        return URIRef(value)
+    if kind == 'B':
+        return BNode(value)
+    # lexical form may contain the separator, datatype and language never do
+    value, datatype, language = value.rsplit(_SEPARATOR, 2)
+    return Literal(value, lang=language or None, datatype=URIRef(datatype) if datatype else None)
+
+
+class CompactGraph:
+    """
+    A read-only graph stored as a sorted dictionary of terms plus an integer triple array.
+    Arrays are memory-mapped from the archive, terms are decoded only when they are returned,
+    and an rdflib Graph is built only on demand with to_graph()
+    """
+    def __init__(self, terms: PackedStrings, triples: np.ndarray):
+        """
+        :param terms: sorted term keys, a term id is a position in this array
+        :param triples: an (n, 3) integer array of (subject, predicate, object) term ids sorted by rows
+        """
+        self._terms = terms
+        self._triples = triples
+        # permutations sorting triples by predicate and by object along with sorted columns, built on first use
+        self._by_predicate = None
+        self._by_object = None
+        self._term = lru_cache(maxsize=Config.TERM_CACHE_SIZE)(self._decode_term)
+
+    @classmethod
+    def from_graph(cls, graph: rdflib.Graph) -> 'CompactGraph':
+        """
+        A method to dictionary-encode an rdflib graph
+        :param graph: rdflib graph
+        :return: CompactGraph instance
+        """
+        return cls.from_keys(tuple(map(term_key, triple)) for triple in graph)
+
+    @classmethod
+    def from_keys(cls, triples: Iterable[Tuple[str, str, str]]) -> 'CompactGraph':
+        """
+        A method to dictionary-encode a stream of triples of term keys, e.g. of a disk-backed graph store
+        :param triples: (subject, predicate, object) term keys without duplicate triples
+        :return: CompactGraph instance
+        """
+        term_ids = dict()
+        flat = array('q')
+        for triple in triples:
+            for key in triple:
+                flat.append(term_ids.setdefault(key, len(term_ids)))
+
+        keys = list(term_ids)
+        order = np.array(sorted(range(len(keys)), key=keys.__getitem__), dtype=np.int64)
+        # term id in encounter order -> term id in sorted order
+        rank = np.empty(len(keys), dtype=np.int64)
+        rank[order] = np.arange(len(keys))
+
+        dtype = np.int32 if len(keys) < np.iinfo(np.int32).max else np.int64
+        triples = rank[np.frombuffer(flat, dtype=np.int64)].reshape(-1, 3).astype(dtype)
+        triples = triples[np.lexsort((triples[:, 2], triples[:, 1], triples[:, 0]))]
+        return cls(PackedStrings.from_list(keys[i] for i in order.tolist()), triples)
+
+    def save(self, archive: ZipFile):
+        """
+        A method to write the graph to archive members which can be memory-mapped later
+        :param archive: archive opened for writing
+        """
+        write_npy(archive, f"{Config.GRAPH_FOLDER}/terms_data.npy", self._terms.data)
+        write_npy(archive, f"{Config.GRAPH_FOLDER}/terms_offsets.npy", self._terms.offsets)
+        write_npy(archive, f"{Config.GRAPH_FOLDER}/triples.npy", self._triples)
+
+    @classmethod
+    def load(cls, archive: ZipFile, archive_path: str) -> 'CompactGraph':
+        """
+        :param archive: opened archive
+        :param archive_path: a path to the archive file
+        :return: CompactGraph instance backed by memory-mapped arrays
+        """
+        terms = PackedStrings(read_npy(archive, archive_path, f"{Config.GRAPH_FOLDER}/terms_data.npy"),
+                              read_npy(archive, archive_path, f"{Config.GRAPH_FOLDER}/terms_offsets.npy"))
+        return cls(terms, read_npy(archive, archive_path, f"{Config.GRAPH_FOLDER}/triples.npy"))
+
+    @staticmethod
+    def in_archive(archive: ZipFile) -> bool:
+        """
+        :param archive: opened archive
+        :return: whether the archive has a compact graph section
+        """
+        return f"{Config.GRAPH_FOLDER}/triples.npy" in archive.namelist()
+
+    def to_graph(self) -> rdflib.Graph:
+        """
+        :return: an in-memory rdflib graph with the same triples
+        """
+        terms = [key_term(key) for key in self._terms]
+        graph = rdflib.Graph()
+        graph.addN((terms[s], terms[p], terms[o], graph) for s, p, o in self._triples.tolist())
+        return graph
+
+    def key_triples(self) -> Iterator[Tuple[str, str, str]]:
+        """
+        :return: an iterator over (subject, predicate, object) term keys, triples are read in blocks
+        """
+        for start in range(0, len(self._triples), Config.GRAPH_STORE_BATCH):
+            for s, p, o in self._triples[start:start + Config.GRAPH_STORE_BATCH].tolist():
+                yield self._terms[s], self._terms[p], self._terms[o]
+
+    def __len__(self) -> int:
+        return len(self._triples)
+
+    def __iter__(self) -> Iterator[Tuple[Node, Node, Node]]:
+        return self.triples((None, None, None))
+
+    def __contains__(self, triple: Tuple[Node, Node, Node]) -> bool:
+        for _ in self.triples(triple):
+            return True
+        return False
+
+    def triples(self, pattern: Tuple[Optional[Node], Optional[Node], Optional[Node]]) \
+            -> Iterator[Tuple[Node, Node, Node]]:
+        """
+        A method to select triples matching a pattern, None matches any term
+        :param pattern: (subject, predicate, object) pattern
+        :return: an iterator over matching triples
+        """
+        for s, p, o in self._select(pattern).tolist():
+            yield self._term(s), self._term(p), self._term(o)
+
+    def subjects(self, predicate: Optional[Node] = None, object: Optional[Node] = None) -> Iterator[Node]:
+        for s, _, _ in self._select((None, predicate, object)).tolist():
+            yield self._term(s)
+
+    def objects(self, subject: Optional[Node] = None, predicate: Optional[Node] = None) -> Iterator[Node]:
+        for _, _, o in self._select((subject, predicate, None)).tolist():
+            yield self._term(o)
+
+    def subject_objects(self, predicate: Optional[Node] = None) -> Iterator[Tuple[Node, Node]]:
+        for s, _, o in self._select((None, predicate, None)).tolist():
+            yield self._term(s), self._term(o)
+
+    def term_id(self, term: Node) -> int:
+        """
+        A method to find a term in the dictionary with a binary search over sorted keys
+        :param term: rdflib term
+        :return: term id or -1 if the graph does not have such a term
+        """
+        key = term_key(term).encode('utf-8')
+        data, offsets = self._terms.data, self._terms.offsets
+        low, high = 0, len(self._terms)
+        while low < high:
+            middle = (low + high) // 2
+            if data[offsets[middle]:offsets[middle + 1]].tobytes() < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self._terms) and data[offsets[low]:offsets[low + 1]].tobytes() == key:
+            return low
+        return -1
+
+    def _decode_term(self, term_id: int) -> Node:
+        return key_term(self._terms[term_id])
+
+    def _select(self, pattern: Tuple[Optional[Node], Optional[Node], Optional[Node]]) -> np.ndarray:
+        """
+        :param pattern: (subject, predicate, object) pattern
+        :return: an (n, 3) array of matching triples
+        """
+        ids = []
+        for term in pattern:
+            ids.append(None if term is None else self.term_id(term))
+            if ids[-1] == -1:
+                return self._triples[:0]
+        s, p, o = ids
+
+        if s is not None:
+            # triples are sorted by subject
+            selected = self._triples[self._range(self._triples[:, 0], s)]
+        elif p is not None:
+            if self._by_predicate is None:
+                self._by_predicate = self._sort_by(1)
+            order, column = self._by_predicate
+            selected = self._triples[np.sort(order[self._range(column, p)])]
+        elif o is not None:
+            if self._by_object is None:
+                self._by_object = self._sort_by(2)
+            order, column = self._by_object
+            selected = self._triples[np.sort(order[self._range(column, o)])]
+        else:
+            selected = self._triples
+
+        if p is not None:
+            selected = selected[selected[:, 1] == p]
+        if o is not None:
+            selected = selected[selected[:, 2] == o]
+        return selected
+
+    def _sort_by(self, position: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param position: column to sort triples by
+        :return: a tuple of (permutation, sorted column)
+        """
+        order = np.argsort(self._triples[:, position], kind='stable')
+        return order, np.asarray(self._triples[order, position])
+
+    @staticmethod
+    def _range(column: np.ndarray, value: int) -> slice:
+        """
+        :param column: sorted column
+        :param value: value to find
+        :return: a slice of rows holding the value
+        """
+        return slice(int(np.searchsorted(column, value, side='left')),
+                     int(np.searchsorted(column, value, side='right')))
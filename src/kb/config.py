@@ -1,5 +1,9 @@
 from dataclasses import dataclass
-from rdflib import Graph, Literal, RDF, URIRef, Namespace
+from .imports import rdf_term
+
+
+# graph metadata terms are rdflib terms made on first use, so that importing config does not import rdflib
+_NAMESPACE = "http://knowledge.base/"
 
 
 @dataclass(frozen=True)
@@ -10,34 +14,135 @@ class Config:
     LOG_LEVEL = 'INFO'
     # images location
     IMAGES_FOLDER = 'images'
+    # downscaled copies of images location
+    THUMBNAILS_FOLDER = 'thumbnails'
 
     # [search index]
+    # Search engine to use. Possible values: "annoy" (approximate) or "brute_force" (exact)
+    INDEX_BACKEND = 'annoy'
     # Number of trees to use in Annoy index
     # The bigger thins number - the greater index precision
     N_TREES = 10
     # Similarity metric to use. Possible values: "angular", "euclidean", "manhattan", "hamming", or "dot"'
     INDEX_METRIC = 'angular'
+    # n_trees values and search_k multipliers of n_trees * k tried by index auto tuning, in increasing order
+    TUNE_N_TREES = (10, 20, 50, 100, 200)
+    TUNE_SEARCH_K_MULTIPLIERS = (1, 2, 4, 8, 16, 32)
+    # random seed to sample auto tuning queries
+    TUNE_SEED = 0
+    # Number of query vectors and indexed vectors processed at once by the exact search backend
+    BRUTE_FORCE_QUERY_BLOCK = 256
+    BRUTE_FORCE_ITEM_BLOCK = 65536
+
+    # [ingestion]
+    # number of embeddings read and validated at once
+    EMBEDDING_CHUNK_SIZE = 4096
+    # number of N-Triples or N-Quads lines parsed at once by a worker process
+    PARSE_CHUNK_LINES = 100000
+    # file name of a disk-backed graph store and number of rows fetched from it at once
+    GRAPH_STORE_FILE = 'graph.sqlite'
+    GRAPH_STORE_BATCH = 10000
+
+    # [query]
+    # default number of nodes to inspect during search, -1 lets Annoy use n_trees * k
+    # a knowledge base may store its own default
+    SEARCH_K = -1
+    # number of threads used by batch queries, -1 means all cores
+    N_JOBS = -1
+    # number of compiled search filters to keep in memory
+    FILTER_CACHE_SIZE = 32
+    # factor by which filtered search grows the number of requested neighbors
+    # until enough of them pass the filter
+    FILTER_GROWTH = 4
+    # number of select_similar results to keep in memory for knowledge bases without a neighbors table
+    RESULT_CACHE_SIZE = 4096
+    # total size in bytes of decoded images to keep in memory
+    IMAGE_CACHE_BYTES = 256 * 1024 * 1024
+    # maximum width and height of thumbnails made on the fly for knowledge bases built without them
+    THUMBNAIL_SIZE = 256
+
+    # [server]
+    # address the similarity server listens on, port 0 picks a free port
+    SERVER_HOST = '127.0.0.1'
+    SERVER_PORT = 8765
+    # number of worker processes sharing the loaded knowledge base
+    SERVER_WORKERS = 1
+    # time in seconds concurrent requests are collected for before they are answered as one batch
+    BATCH_WINDOW = 0.002
+    # number of queries which are answered at once without waiting for the window to end
+    MAX_BATCH = 256
+    # maximum size in bytes of a request body
+    MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+    # [metrics]
+    # whether knowledge bases record timings and counters from the start, see KB.metrics
+    METRICS_ENABLED = False
+    # upper bounds in milliseconds of latency histogram buckets
+    LATENCY_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    # number of functions and allocation sites reported by profiling
+    PROFILE_TOP = 20
+
+    # [archive]
+    # archive folder with compact graph arrays
+    GRAPH_FOLDER = 'graph'
+    # number of decoded graph terms to keep in memory
+    TERM_CACHE_SIZE = 65536
+    # shared cache for index files which can not be memory-mapped from the archive directly
+    # can be overridden with KB_CACHE_DIR environment variable
+    CACHE_DIR = '~/.cache/kb'
+    # total size in bytes of the shared cache and time in seconds an unused cache entry is kept
+    CACHE_MAX_BYTES = 16 * 1024 * 1024 * 1024
+    CACHE_MAX_AGE = 30 * 24 * 60 * 60
+    # time in seconds a cache entry used by some process is not pruned, so it can load the file
+    CACHE_GRACE_PERIOD = 60
+    # buffer size for copying and hashing files
+    COPY_BUFFER_SIZE = 16 * 1024 * 1024
+    # archive member with data offsets, sizes and checksums of all other members
+    ARCHIVE_MANIFEST_FILE = 'sections.json'
+    # extensions of archive members which are compressed already and are stored without deflating them again
+    STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.npy', '.npz', '.ann')
+    # archive member with external entity ids in search index order
+    ID_MAP_FILE = 'id_map.npy'
+    # archive member with entity lookup tables
+    LOOKUP_FILE = 'lookup.npz'
+    # archive member with embedding matrix, rows are aligned with the id map
+    EMBEDDINGS_FILE = 'embeddings.npy'
+    # default dtype of embedding matrix. Possible values: "float32", "float16"
+    EMBEDDING_DTYPE = 'float32'
+    # archive members with precomputed neighbors of every item, rows are aligned with the id map
+    KNN_IDS_FILE = 'knn_ids.npy'
+    KNN_DISTANCES_FILE = 'knn_distances.npy'
+    # number of items whose neighbors are computed at once while building the neighbors table
+    KNN_BLOCK = 16384
+    # manifest of a sharded knowledge base and folders of its shards
+    SHARD_MANIFEST_FILE = 'manifest.json'
+    SHARD_FOLDER = 'shard_{:04d}'
+    # suffix of a sidecar archive with changes made to a knowledge base since it was built
+    DELTA_SUFFIX = '.delta'
 
     # [graph metadata]
     # default namespace for kb metadata
-    NAMESPACE = Namespace("http://knowledge.base/")
+    NAMESPACE = rdf_term('Namespace', _NAMESPACE)
     # default predicate for pointing at embedding
-    HAS_EMBEDDING = NAMESPACE.has_embedding
+    HAS_EMBEDDING = rdf_term('URIRef', _NAMESPACE + 'has_embedding')
     # default predicate for pointing at image
-    HAS_IMAGE = NAMESPACE.has_image
+    HAS_IMAGE = rdf_term('URIRef', _NAMESPACE + 'has_image')
     # embedding class
-    EMBEDDING = NAMESPACE.embedding
+    EMBEDDING = rdf_term('URIRef', _NAMESPACE + 'embedding')
     # image class
-    IMAGE = NAMESPACE.image
+    IMAGE = rdf_term('URIRef', _NAMESPACE + 'image')
     # predicate to specify location
-    LOCATED_AT = NAMESPACE.located_at
+    LOCATED_AT = rdf_term('URIRef', _NAMESPACE + 'located_at')
     # embedding location
-    EMBEDDING_LOCATION = Literal('AnnoyIndex')
+    EMBEDDING_LOCATION = rdf_term('Literal', 'AnnoyIndex')
     # images location (the one specified in graph)
-    IMAGE_LOCATION_GRAPH = Literal(IMAGES_FOLDER)
+    IMAGE_LOCATION_GRAPH = rdf_term('Literal', IMAGES_FOLDER)
     # embedding length predicate
-    HAS_LENGTH = NAMESPACE.has_length
+    HAS_LENGTH = rdf_term('URIRef', _NAMESPACE + 'has_length')
 
     # [output]
     # fontsize to show labels on images
     FONTSIZE = 14
+    # number of columns and size in inches of a cell of image grids
+    GRID_COLUMNS = 5
+    GRID_CELL_SIZE = 3
@@ -0,0 +1,244 @@
+from __future__ import annotations
+import numpy as np
+import os
+import shutil
+import tempfile
+from zipfile import ZipFile
+from typing import Dict, Tuple, TYPE_CHECKING
+from .archive import member_compression, open_member, write_npy
+from .backends import BruteForceBackend
+from .config import Config
+from .id_map import IdMap
+from .imports import import_module
+from .lookup import EntityLookup
+
+if TYPE_CHECKING:
+    from rdflib import Graph, URIRef
+
+
+class DeltaSegment:
+    """
+    Changes made to a knowledge base since its archive was built: added entities with their
+    triples, embeddings and images, and tombstones of removed entities.
+    Kept in a small sidecar archive next to the .ttlplus file, searched exactly and
+    merged with the main index results at query time until the knowledge base is compacted
+    """
+    def __init__(self, vector_length: int, entity_predicate: URIRef, metric: str = Config.INDEX_METRIC):
+        """
+        :param vector_length: length of embeddings
+        :param entity_predicate: a predicate which leads to entity id
+        :param metric: similarity metric of the knowledge base
+        """
+        self.vector_length = vector_length
+        self.entity_predicate = entity_predicate
+        self.metric = metric
+        # external ids and vectors of added embeddings
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, vector_length), dtype=np.float32)
+        # external ids of entities removed from the main archive, entities added back
+        # after removal live in delta only
+        self.tombstones = np.zeros(0, dtype=np.int64)
+        # added triples
+        self.graph = import_module('rdflib').Graph()
+        # image name -> a path to an image file not yet written to the delta archive
+        self._new_images = dict()
+        # image names already in the delta archive
+        self._images = set()
+        self._archive = None
+        self._refresh()
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.tombstones) + len(self.graph)
+
+    @staticmethod
+    def path_for(ttlplus_path: str) -> str:
+        """
+        :param ttlplus_path: a path to .ttlplus file
+        :return: a path to its delta archive
+        """
+        return ttlplus_path + Config.DELTA_SUFFIX
+
+    @classmethod
+    def load(cls, path: str, vector_length: int, entity_predicate: URIRef, metric: str = Config.INDEX_METRIC):
+        """
+        :param path: a path to delta archive
+        :param vector_length: length of embeddings
+        :param entity_predicate: a predicate which leads to entity id
+        :param metric: similarity metric of the knowledge base
+        :return: DeltaSegment instance
+        """
+        delta = cls(vector_length, entity_predicate, metric)
+        delta._archive = ZipFile(path, 'r')
+        with delta._archive.open('ids.npy') as f:
+            delta.ids = np.load(f, allow_pickle=False)
+        with delta._archive.open('vectors.npy') as f:
+            delta.vectors = np.load(f, allow_pickle=False)
+        with delta._archive.open('tombstones.npy') as f:
+            delta.tombstones = np.load(f, allow_pickle=False)
+        delta.graph.parse(data=delta._archive.read('triples.nt').decode('utf-8'), format='nt')
+        delta._images = {x[len(Config.IMAGES_FOLDER) + 1:] for x in delta._archive.namelist()
+                         if x.startswith(f"{Config.IMAGES_FOLDER}/")}
+        delta._refresh()
+        return delta
+
+    def save(self, path: str):
+        """
+        A method to write delta archive. It is written to a temp file and moved in place,
+        so readers never see a partially written delta
+        :param path: a path to delta archive
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp_delta_')
+        os.close(fd)
+        try:
+            with ZipFile(tmp_path, 'w') as zip_file:
+                write_npy(zip_file, 'ids.npy', self.ids)
+                write_npy(zip_file, 'vectors.npy', self.vectors)
+                write_npy(zip_file, 'tombstones.npy', self.tombstones)
+                with open_member(zip_file, 'triples.nt') as f:
+                    self.graph.serialize(destination=f, format='nt', encoding='utf-8')
+                for name in sorted(self._images):
+                    with self._archive.open(f"{Config.IMAGES_FOLDER}/{name}") as src, \
+                            open_member(zip_file, f"{Config.IMAGES_FOLDER}/{name}") as dst:
+                        shutil.copyfileobj(src, dst, Config.COPY_BUFFER_SIZE)
+                for name, image_path in sorted(self._new_images.items()):
+                    zip_file.write(image_path, arcname=f"{Config.IMAGES_FOLDER}/{name}",
+                                   compress_type=member_compression(name))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if self._archive is not None:
+            self._archive.close()
+        self._archive = ZipFile(path, 'r')
+        self._images |= set(self._new_images)
+        self._new_images = dict()
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def add_graph(self, graph: Graph):
+        """
+        :param graph: triples to add
+        """
+        self.graph += graph
+        self._refresh()
+
+    def add_vectors(self, ids: np.ndarray, vectors: np.ndarray):
+        """
+        A method to add or replace embeddings
+        :param ids: external entity ids
+        :param vectors: a 2-D array of vectors aligned with ids
+        """
+        keep = ~np.isin(self.ids, ids)
+        self.ids = np.concatenate([self.ids[keep], ids.astype(np.int64)])
+        self.vectors = np.concatenate([self.vectors[keep], vectors.astype(np.float32)])
+        self._refresh()
+
+    def add_image(self, name: str, path: str):
+        """
+        :param name: image name
+        :param path: a path to image file
+        """
+        self._new_images[name] = path
+
+    def remove(self, ids: np.ndarray, subjects: Dict[int, URIRef]):
+        """
+        A method to tombstone entities and drop whatever delta holds for them
+        :param ids: external entity ids to remove
+        :param subjects: entity id -> subject URI of removed entities
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        self.tombstones = np.union1d(self.tombstones, ids)
+        keep = ~np.isin(self.ids, ids)
+        self.ids, self.vectors = self.ids[keep], self.vectors[keep]
+        for entity_id, subject in subjects.items():
+            image = self.lookup.image(entity_id)
+            if image:
+                self._images.discard(image)
+                self._new_images.pop(image, None)
+            self.graph.remove((subject, None, None))
+        self._refresh()
+
+    def _refresh(self):
+        """
+        A method to rebuild derived structures after a change
+        """
+        self.id_map = IdMap(self.ids)
+        self.lookup = EntityLookup.from_graph(self.graph, self.entity_predicate)
+        # main index results of these entities are hidden, they are either removed or replaced by delta
+        self.shadowed = np.union1d(self.tombstones, self.ids)
+        self._index = BruteForceBackend.from_matrix(self.vectors, self.metric)
+
+    def is_removed(self, entity_ids: np.ndarray) -> np.ndarray:
+        """
+        :param entity_ids: external entity ids
+        :return: a bool array telling which entities were removed
+        """
+        return np.isin(entity_ids, self.tombstones)
+
+    def open_image(self, name: str):
+        """
+        :param name: image name
+        :return: a binary file object with image contents or None if delta does not have the image
+        """
+        if name in self._new_images:
+            return open(self._new_images[name], 'rb')
+        if name in self._images:
+            return self._archive.open(f"{Config.IMAGES_FOLDER}/{name}")
+        return None
+
+    def image_names(self):
+        return self._images | set(self._new_images)
+
+    def search(self, vectors: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to find exact nearest neighbors among added embeddings
+        :param vectors: a 2-D array of query vectors
+        :param k: number of neighbors
+        :return: a tuple of (external ids, distances) arrays padded with -1 and nan
+        """
+        ids, distances = self._index.get_nns_by_vectors(vectors, k)
+        return self.id_map.to_external_many(ids), distances
+
+
+def merge_results(metric: str,
+                  ids: Tuple[np.ndarray, ...],
+                  distances: Tuple[np.ndarray, ...],
+                  k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    A function to merge several padded top-k results into one by distance
+    :param metric: similarity metric, for "dot" the bigger the distance the closer the items
+    :param ids: arrays of ids of shape (n_queries, k_i), -1 marks empty slots
+    :param distances: arrays of distances aligned with ids
+    :param k: number of neighbors to keep
+    :return: a tuple of (ids, distances) arrays of shape (n_queries, k) padded with -1 and nan
+    """
+    all_ids = np.concatenate(ids, axis=1)
+    all_distances = np.concatenate(distances, axis=1).astype(np.float32)
+    keys = -all_distances if metric == 'dot' else all_distances.copy()
+    keys[all_ids < 0] = np.inf
+    # the same entity may come from several sources, keep the closest copy only
+    order = np.argsort(keys, axis=1, kind='stable')
+    all_ids = np.take_along_axis(all_ids, order, axis=1)
+    all_distances = np.take_along_axis(all_distances, order, axis=1)
+    for row in range(len(all_ids)):
+        _, first = np.unique(all_ids[row], return_index=True)
+        duplicate = np.ones(all_ids.shape[1], dtype=bool)
+        duplicate[first] = False
+        all_ids[row, duplicate] = -1
+    keys = np.take_along_axis(keys, order, axis=1)
+    keys[all_ids < 0] = np.inf
+    order = np.argsort(keys, axis=1, kind='stable')[:, :k]
+    merged_ids = np.take_along_axis(all_ids, order, axis=1)
+    merged_distances = np.take_along_axis(all_distances, order, axis=1)
+    merged_distances[merged_ids < 0] = np.nan
+
+    ids = np.full((len(merged_ids), k), -1, dtype=np.int64)
+    distances = np.full((len(merged_ids), k), np.nan, dtype=np.float32)
+    ids[:, :merged_ids.shape[1]] = merged_ids
+    distances[:, :merged_distances.shape[1]] = merged_distances
+    return ids, distances
@@ -0,0 +1,185 @@
+import copy
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from .config import Config
+from .parallel import resolve_n_jobs
+
+
+class EmbeddingSource:
+    """
+    A source of entity embeddings for building a knowledge base. Embeddings may come from
+    a directory with one .npy file per entity, a stacked .npy/.npz matrix with an id array,
+    or an in-memory or memory-mapped numpy matrix. Vectors are streamed in chunks of rows
+    and validated chunk by chunk, so the whole input never has to be in memory
+    """
+    def __init__(self,
+                 embeddings: Union[str, np.ndarray],
+                 ids: Optional[Union[str, Sequence[int], np.ndarray]] = None,
+                 n_jobs: Optional[int] = None,
+                 chunk_size: int = Config.EMBEDDING_CHUNK_SIZE):
+        """
+        :param embeddings: a path to a directory with .npy files named after entity ids,
+            a path to a .npy file with a 2-D matrix, a path to a .npz file with `vectors` and `ids` arrays
+            or a 2-D numpy array (np.memmap included)
+        :param ids: entity ids of matrix rows, a sequence, an array or a path to .npy file.
+            Required for matrix inputs except .npz files, ignored for directories
+        :param n_jobs: number of threads reading files from a directory
+        :param chunk_size: number of vectors read and validated at once
+        """
+        self._files = None
+        self._directory = None
+        self._matrix = None
+        self._n_jobs = resolve_n_jobs(n_jobs)
+        self._chunk_size = chunk_size
+
+        if isinstance(embeddings, np.ndarray):
+            self._set_matrix(embeddings, ids, source='embedding matrix')
+        elif os.path.isdir(embeddings):
+            self._directory = embeddings
+            self._scan_directory(embeddings)
+        elif Path(embeddings).suffix == '.npz':
+            with np.load(embeddings, allow_pickle=False) as arrays:
+                if 'vectors' not in arrays or 'ids' not in arrays:
+                    raise ValueError(f"{embeddings} should contain `vectors` and `ids` arrays, "
+                                     f"found: {list(arrays.keys())}")
+                self._set_matrix(arrays['vectors'], arrays['ids'], source=embeddings)
+        elif Path(embeddings).suffix == '.npy':
+            self._set_matrix(np.load(embeddings, mmap_mode='r', allow_pickle=False), ids, source=embeddings)
+        else:
+            raise ValueError(f"embeddings should be a directory, a .npy or .npz file or a numpy array, "
+                             f"got `{embeddings}`")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def names(self) -> Dict[int, str]:
+        """
+        :return: entity id -> name of embedding to record in the graph
+        """
+        if self._files is not None:
+            return dict(zip(self.ids.tolist(), self._files))
+        return {x: str(x) for x in self.ids.tolist()}
+
+    def subset(self, mask: np.ndarray) -> 'EmbeddingSource':
+        """
+        A method to make a source of some of the embeddings, e.g. of one shard of a knowledge base
+        :param mask: a bool array aligned with ids telling which embeddings to keep
+        :return: EmbeddingSource instance, vectors of a matrix input are copied to memory
+        """
+        subset = copy.copy(self)
+        subset.ids = self.ids[mask]
+        if self._files is not None:
+            subset._files = [name for name, keep in zip(self._files, mask.tolist()) if keep]
+        else:
+            subset._matrix = np.asarray(self._matrix[np.flatnonzero(mask)])
+        return subset
+
+    def _set_matrix(self, matrix: np.ndarray, ids, source: str):
+        """
+        A method to validate a stacked matrix input
+        :param matrix: 2-D array of vectors
+        :param ids: entity ids of matrix rows
+        :param source: description of input for error messages
+        """
+        if ids is None:
+            raise ValueError(f"entity ids should be provided along with {source}")
+        if isinstance(ids, str):
+            ids = np.load(ids, allow_pickle=False)
+        ids = np.asarray(ids)
+        if matrix.ndim != 2:
+            raise ValueError(f"{source} should be a 2-D array, got shape {matrix.shape}")
+        self._check_dtype(matrix.dtype, source)
+        if ids.ndim != 1 or not np.issubdtype(ids.dtype, np.integer):
+            raise ValueError(f"entity ids should be a 1-D integer array, got shape {ids.shape} of {ids.dtype}")
+        if len(ids) != len(matrix):
+            raise ValueError(f"{source} has {len(matrix)} rows but {len(ids)} entity ids were provided")
+        self._matrix = matrix
+        self.ids = ids.astype(np.int64)
+        self.vector_length = matrix.shape[1]
+
+    def _scan_directory(self, path: str):
+        """
+        A method to list embedding files in a single pass and read one of them to get vector length
+        :param path: a path to embeddings directory
+        """
+        self._files = []
+        ids = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                stem = Path(entry.name).stem
+                if stem.isnumeric() and entry.is_file():
+                    self._files.append(entry.name)
+                    ids.append(int(stem))
+        if not self._files:
+            raise ValueError(f"no embedding files named after entity ids found in {path}")
+        self.ids = np.array(ids, dtype=np.int64)
+
+        sample_vector = self._load_file(self._files[0])
+        self._check_dtype(sample_vector.dtype, self._files[0])
+        self.vector_length = len(sample_vector)
+
+    def _load_file(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self._directory, name), allow_pickle=False).ravel()
+
+    @staticmethod
+    def _check_dtype(dtype: np.dtype, source: str):
+        if not (np.issubdtype(dtype, np.number) or np.issubdtype(dtype, np.bool_)):
+            raise ValueError(f"{source} should hold numbers, got dtype {dtype}")
+
+    def chunks(self) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        A method to stream validated vectors in id order
+        :return: an iterator over (first row, float32 2-D array of vectors) tuples
+        """
+        if self._matrix is not None:
+            for start in range(0, len(self), self._chunk_size):
+                chunk = np.asarray(self._matrix[start:start + self._chunk_size], dtype=np.float32)
+                self._check_finite(chunk, self.ids[start:start + len(chunk)])
+                yield start, chunk
+            return
+
+        with ThreadPoolExecutor(max_workers=self._n_jobs) as pool:
+            # read the next chunk while the current one is being consumed,
+            # at most two chunks of vectors are in memory at once
+            pending = self._read_chunk(pool, 0)
+            for start in range(0, len(self), self._chunk_size):
+                vectors = [x.result() for x in pending]
+                if start + self._chunk_size < len(self):
+                    pending = self._read_chunk(pool, start + self._chunk_size)
+                yield start, self._stack(vectors, self._files[start:start + len(vectors)],
+                                         self.ids[start:start + len(vectors)])
+
+    def _read_chunk(self, pool: ThreadPoolExecutor, start: int) -> List:
+        return [pool.submit(self._load_file, x) for x in self._files[start:start + self._chunk_size]]
+
+    def _stack(self, vectors: List[np.ndarray], files: List[str], ids: np.ndarray) -> np.ndarray:
+        """
+        A method to validate vectors read from files and stack them into a matrix
+        :param vectors: vectors read from files
+        :param files: names of files
+        :param ids: entity ids of files
+        :return: float32 2-D array of vectors
+        """
+        wrong_length = [f"{name} ({len(x)})" for name, x in zip(files, vectors) if len(x) != self.vector_length]
+        if wrong_length:
+            raise ValueError(f"{len(wrong_length)} embedding files do not have expected length "
+                             f"{self.vector_length}: {', '.join(wrong_length[:10])}")
+        wrong_dtype = [f"{name} ({x.dtype})" for name, x in zip(files, vectors)
+                       if not (np.issubdtype(x.dtype, np.number) or np.issubdtype(x.dtype, np.bool_))]
+        if wrong_dtype:
+            raise ValueError(f"{len(wrong_dtype)} embedding files do not hold numbers: {', '.join(wrong_dtype[:10])}")
+
+        chunk = np.stack(vectors).astype(np.float32, copy=False)
+        self._check_finite(chunk, ids)
+        return chunk
+
+    @staticmethod
+    def _check_finite(chunk: np.ndarray, ids: np.ndarray):
+        bad = ~np.isfinite(chunk).all(axis=1)
+        if bad.any():
+            raise ValueError(f"{int(bad.sum())} embeddings have nan or infinite values, "
+                             f"first of their entity ids: {ids[bad][:10].tolist()}")
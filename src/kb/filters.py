@@ -0,0 +1,61 @@
+from __future__ import annotations
+import numpy as np
+from typing import Iterable, Optional, Tuple, Union, TYPE_CHECKING
+from .id_map import IdMap
+
+if TYPE_CHECKING:
+    from rdflib import URIRef
+    from rdflib.term import Node
+
+
+class IdFilter:
+    """
+    A set of entity ids allowed in similarity search results. It is compiled to a bitmap over
+    internal ids of the search index once, so checking candidate neighbors costs a bit lookup per neighbor
+    """
+    def __init__(self, entity_ids: Union[Iterable[int], np.ndarray], id_map: IdMap):
+        """
+        :param entity_ids: allowed entity ids
+        :param id_map: id map of the search index
+        """
+        if not isinstance(entity_ids, np.ndarray):
+            entity_ids = list(entity_ids)
+        self.entity_ids = np.unique(np.asarray(entity_ids, dtype=np.int64))
+        internal_ids = id_map.to_internal_many(self.entity_ids)
+        # internal ids of allowed entities which are in the search index, in increasing order
+        self.internal_ids = np.sort(internal_ids[internal_ids >= 0])
+        bits = np.zeros(len(id_map), dtype=bool)
+        bits[self.internal_ids] = True
+        self._bits = np.packbits(bits)
+        # exact search index over allowed vectors, built on first use by very selective searches
+        self.exact_index = None
+
+    def __len__(self) -> int:
+        return len(self.entity_ids)
+
+    @property
+    def n_indexed(self) -> int:
+        return len(self.internal_ids)
+
+    def allows_internal(self, internal_ids: np.ndarray) -> np.ndarray:
+        """
+        :param internal_ids: internal ids of the search index, negative values are treated as missing items
+        :return: a bool array telling which items are allowed
+        """
+        internal_ids = np.asarray(internal_ids, dtype=np.int64)
+        safe = np.maximum(internal_ids, 0)
+        bits = (self._bits[safe >> 3] >> (7 - (safe & 7))) & 1
+        return (bits == 1) & (internal_ids >= 0)
+
+    def allows(self, entity_ids: np.ndarray) -> np.ndarray:
+        """
+        :param entity_ids: entity ids
+        :return: a bool array telling which entities are allowed
+        """
+        return np.isin(entity_ids, self.entity_ids)
+
+
+# a filter is either compiled already, a SPARQL query whose first variable selects entities,
+# a (predicate, object) constraint where object None matches any value, or allowed entity ids
+FilterSpec = Union[IdFilter, str, Tuple['URIRef', Optional['Node']], Iterable[int]]
+
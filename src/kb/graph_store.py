@@ -0,0 +1,231 @@
+import numpy as np
+import os
+import sqlite3
+from functools import lru_cache, partial
+from rdflib import Graph
+from rdflib.store import Store
+from rdflib.term import Node
+from typing import Iterable, Iterator, Optional, Tuple
+from .compact_graph import CompactGraph, key_term, term_key
+from .config import Config
+from .lookup import PackedStrings
+
+
+# a triple of term keys, see compact_graph.term_key
+KeyTriple = Tuple[str, str, str]
+
+
+class SQLiteStore(Store):
+    """
+    A disk-backed rdflib store keeping triples of term keys in an SQLite file, for graphs larger than RAM.
+    It holds a single graph without contexts, which is all the knowledge base needs.
+    Secondary indexes are built on the first read, so that bulk loading does not maintain them
+    """
+    context_aware = False
+    formula_aware = False
+    transaction_aware = False
+    graph_aware = False
+
+    def __init__(self, configuration: Optional[str] = None, identifier: Optional[Node] = None):
+        """
+        :param configuration: a path to the SQLite file, it is created if it does not exist
+        :param identifier: store identifier
+        """
+        self._connection = None
+        self._indexed = False
+        self._namespaces = dict()
+        self._prefixes = dict()
+        self._term = lru_cache(maxsize=Config.TERM_CACHE_SIZE)(key_term)
+        super().__init__(configuration=configuration, identifier=identifier)
+
+    @classmethod
+    def graph(cls, path: str) -> Graph:
+        """
+        :param path: a path to the SQLite file
+        :return: an rdflib graph backed by a new store
+        """
+        return Graph(store=cls(path))
+
+    def open(self, configuration: str, create: bool = True) -> int:
+        if not create and not os.path.exists(configuration):
+            return -1
+        # the file is a scratch copy of data kept elsewhere, so durability is traded for load speed
+        self._connection = sqlite3.connect(configuration, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=OFF")
+        self._connection.execute("PRAGMA synchronous=OFF")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS triples "
+                                 "(s TEXT, p TEXT, o TEXT, PRIMARY KEY (s, p, o)) WITHOUT ROWID")
+        self._indexed = False
+        return 1
+
+    def close(self, commit_pending_transaction: bool = False):
+        if self._connection is not None:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
+
+    def add(self, triple: Tuple[Node, Node, Node], context: Optional[Graph] = None, quoted: bool = False):
+        self._connection.execute("INSERT OR IGNORE INTO triples VALUES (?, ?, ?)", tuple(map(term_key, triple)))
+
+    def addN(self, quads: Iterable[Tuple[Node, Node, Node, Graph]]):
+        self.add_keys(tuple(map(term_key, (s, p, o))) for s, p, o, _ in quads)
+
+    def add_keys(self, triples: Iterable[KeyTriple]):
+        """
+        A method to insert triples of term keys in bulk
+        :param triples: (subject, predicate, object) term keys
+        """
+        self._connection.executemany("INSERT OR IGNORE INTO triples VALUES (?, ?, ?)", triples)
+        self._connection.commit()
+
+    def remove(self, triple: Tuple[Optional[Node], Optional[Node], Optional[Node]], context: Optional[Graph] = None):
+        where, args = self._where(triple)
+        self._connection.execute(f"DELETE FROM triples{where}", args)
+
+    def triples(self, triple: Tuple[Optional[Node], Optional[Node], Optional[Node]], context: Optional[Graph] = None) \
+            -> Iterator[Tuple[Tuple[Node, Node, Node], Iterator[Graph]]]:
+        for s, p, o in self.keys(triple):
+            yield (self._term(s), self._term(p), self._term(o)), iter(())
+
+    def keys(self, triple: Tuple[Optional[Node], Optional[Node], Optional[Node]] = (None, None, None)) \
+            -> Iterator[KeyTriple]:
+        """
+        A method to select triples matching a pattern without decoding terms
+        :param triple: (subject, predicate, object) pattern, None matches any term
+        :return: an iterator over triples of term keys
+        """
+        self._create_indexes()
+        where, args = self._where(triple)
+        cursor = self._connection.execute(f"SELECT s, p, o FROM triples{where}", args)
+        # rows are fetched in batches to bound memory. SQLite does not define results of a query whose table
+        # changes meanwhile, so the store should not be changed until iteration is over
+        rows = cursor.fetchmany(Config.GRAPH_STORE_BATCH)
+        while rows:
+            yield from rows
+            rows = cursor.fetchmany(Config.GRAPH_STORE_BATCH)
+
+    def to_compact_graph(self, directory: str) -> CompactGraph:
+        """
+        A method to dictionary-encode stored triples in bounded memory. SQLite sorts distinct terms,
+        spilling to its temp files, and arrays of the compact graph are written to memory-mapped files
+        :param directory: a directory to write arrays to, e.g. the temp directory of an archive being written
+        :return: CompactGraph instance backed by the memory-mapped arrays
+        """
+        # with indexes by predicate and by object, distinct terms are merged from sorted scans
+        self._create_indexes()
+        connection = self._connection
+        connection.execute("DROP TABLE IF EXISTS terms")
+        # terms are inserted in key order, so a term id is its rowid - 1, and ids sort the same way keys do
+        connection.execute("CREATE TABLE terms (id INTEGER PRIMARY KEY, key TEXT UNIQUE)")
+        connection.execute("INSERT INTO terms (key) "
+                           "SELECT s FROM triples UNION SELECT p FROM triples UNION SELECT o FROM triples ORDER BY 1")
+        n_terms, n_bytes = connection.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(key AS BLOB))), 0) "
+                                              "FROM terms").fetchone()
+        open_memmap = np.lib.format.open_memmap
+        data = open_memmap(os.path.join(directory, 'terms_data.npy'), mode='w+', dtype=np.uint8,
+                           shape=(n_bytes,))
+        offsets = open_memmap(os.path.join(directory, 'terms_offsets.npy'), mode='w+', dtype=np.int64,
+                              shape=(n_terms + 1,))
+        offsets[0] = 0
+        n_read, end = 0, 0
+        cursor = connection.execute("SELECT CAST(key AS BLOB) FROM terms ORDER BY id")
+        for rows in iter(partial(cursor.fetchmany, Config.GRAPH_STORE_BATCH), []):
+            keys = [x for x, in rows]
+            ends = end + np.cumsum([len(x) for x in keys])
+            data[end:ends[-1]] = np.frombuffer(b''.join(keys), dtype=np.uint8)
+            offsets[n_read + 1:n_read + 1 + len(keys)] = ends
+            n_read, end = n_read + len(keys), int(ends[-1])
+
+        # triples are read in primary key order, which is the order of their term ids as well
+        dtype = np.int32 if n_terms < np.iinfo(np.int32).max else np.int64
+        triples = open_memmap(os.path.join(directory, 'triples.npy'), mode='w+', dtype=dtype, shape=(len(self), 3))
+        n_read = 0
+        cursor = connection.execute("SELECT ts.id - 1, tp.id - 1, tobj.id - 1 FROM triples "
+                                    "JOIN terms AS ts ON ts.key = triples.s "
+                                    "JOIN terms AS tp ON tp.key = triples.p "
+                                    "JOIN terms AS tobj ON tobj.key = triples.o "
+                                    "ORDER BY triples.s, triples.p, triples.o")
+        for rows in iter(partial(cursor.fetchmany, Config.GRAPH_STORE_BATCH), []):
+            triples[n_read:n_read + len(rows)] = rows
+            n_read += len(rows)
+        connection.execute("DROP TABLE terms")
+        connection.commit()
+        for array in (data, offsets, triples):
+            array.flush()
+        return CompactGraph(PackedStrings(data, offsets), triples)
+
+    def __len__(self, context: Optional[Graph] = None) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM triples").fetchone()[0]
+
+    def contexts(self, triple: Optional[Tuple[Node, Node, Node]] = None) -> Iterator[Graph]:
+        return iter(())
+
+    def bind(self, prefix: str, namespace: Node, override: bool = True, replace: bool = False):
+        if not override and namespace in self._prefixes:
+            return
+        self._prefixes.pop(self._namespaces.get(prefix), None)
+        self._namespaces[prefix] = namespace
+        self._prefixes[namespace] = prefix
+
+    def namespace(self, prefix: str) -> Optional[Node]:
+        return self._namespaces.get(prefix)
+
+    def prefix(self, namespace: Node) -> Optional[str]:
+        return self._prefixes.get(namespace)
+
+    def namespaces(self) -> Iterator[Tuple[str, Node]]:
+        return iter(list(self._namespaces.items()))
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def _create_indexes(self):
+        """
+        A method to index triples by predicate and by object, the primary key serves subject lookups
+        """
+        if self._indexed:
+            return
+        self._connection.execute("CREATE INDEX IF NOT EXISTS triples_pos ON triples (p, o, s)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS triples_osp ON triples (o, s, p)")
+        self._connection.commit()
+        self._indexed = True
+
+    @staticmethod
+    def _where(triple: Tuple[Optional[Node], Optional[Node], Optional[Node]]) -> Tuple[str, tuple]:
+        """
+        :param triple: (subject, predicate, object) pattern, None matches any term
+        :return: SQL where clause and its arguments
+        """
+        conditions, args = [], []
+        for column, term in zip('spo', triple):
+            if term is not None:
+                conditions.append(f"{column} = ?")
+                args.append(term_key(term))
+        if not conditions:
+            return "", ()
+        return " WHERE " + " AND ".join(conditions), tuple(args)
+
+
+def add_key_triples(graph: Graph, triples: Iterable[KeyTriple]):
+    """
+    A function to add triples of term keys to a graph, disk-backed graphs take keys as they are
+    :param graph: rdflib graph
+    :param triples: (subject, predicate, object) term keys
+    """
+    if isinstance(graph.store, SQLiteStore):
+        graph.store.add_keys(triples)
+    else:
+        graph.addN((key_term(s), key_term(p), key_term(o), graph) for s, p, o in triples)
+
+
+def key_triples(graph: Graph) -> Iterator[KeyTriple]:
+    """
+    :param graph: rdflib graph
+    :return: an iterator over (subject, predicate, object) term keys of the graph
+    """
+    if isinstance(graph.store, SQLiteStore):
+        return graph.store.keys()
+    return (tuple(map(term_key, triple)) for triple in graph)
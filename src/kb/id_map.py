@@ -0,0 +1,101 @@
+import numpy as np
+from typing import Iterable, Optional, Union, BinaryIO
+
+
+class IdMap:
+    """
+    A compact bidirectional map between external entity ids (the numeric names
+    of embedding files) and dense internal ids 0..N-1 used by the search index
+    """
+    def __init__(self, external_ids: Optional[Iterable[int]] = None, n_items: int = 0):
+        """
+        :param external_ids: external ids in internal id order, i.e. external_ids[i] is the external
+            id of internal id i. If None, the map is an identity map over n_items ids, which is
+            what archives created before dense numbering rely on
+        :param n_items: number of items in an identity map, ignored otherwise
+        """
+        if external_ids is None:
+            self._external = None
+            self._sorted = None
+            self._order = None
+            self._n_items = n_items
+            return
+
+        self._external = np.asarray(external_ids, dtype=np.int64).ravel()
+        self._n_items = len(self._external)
+        # sorted copy of external ids and the permutation to get back to internal ids
+        # these make reverse lookups a binary search instead of a python dict
+        self._order = np.argsort(self._external, kind='stable')
+        self._sorted = self._external[self._order]
+        duplicates = self._sorted[1:][self._sorted[1:] == self._sorted[:-1]]
+        if len(duplicates):
+            raise ValueError(f"duplicate entity ids: {duplicates[:10].tolist()}")
+
+    def __len__(self) -> int:
+        return self._n_items
+
+    @property
+    def identity(self) -> bool:
+        return self._external is None
+
+    @property
+    def external_ids(self) -> np.ndarray:
+        """
+        :return: external ids in internal id order
+        """
+        if self.identity:
+            return np.arange(self._n_items, dtype=np.int64)
+        return self._external
+
+    def to_internal(self, external_id: int) -> int:
+        """
+        :param external_id: external entity id
+        :return: internal id or -1 if the entity is not in the map
+        """
+        return int(self.to_internal_many([external_id])[0])
+
+    def to_internal_many(self, external_ids: Union[Iterable[int], np.ndarray]) -> np.ndarray:
+        """
+        :param external_ids: external entity ids
+        :return: an int64 array of internal ids, -1 for entities which are not in the map
+        """
+        external_ids = np.asarray(external_ids, dtype=np.int64).ravel()
+        if self.identity:
+            return np.where((external_ids >= 0) & (external_ids < self._n_items), external_ids, -1)
+        if not self._n_items:
+            return np.full(len(external_ids), -1, dtype=np.int64)
+        positions = np.searchsorted(self._sorted, external_ids)
+        positions = np.minimum(positions, self._n_items - 1)
+        found = self._sorted[positions] == external_ids
+        return np.where(found, self._order[positions], -1)
+
+    def to_external(self, internal_id: int) -> int:
+        """
+        :param internal_id: internal id
+        :return: external entity id
+        """
+        return int(self.to_external_many([internal_id])[0])
+
+    def to_external_many(self, internal_ids: Union[Iterable[int], np.ndarray]) -> np.ndarray:
+        """
+        :param internal_ids: internal ids, negative values are treated as padding
+        :return: an int64 array of external ids, padding is kept as -1
+        """
+        internal_ids = np.asarray(internal_ids, dtype=np.int64)
+        if self.identity:
+            return np.where(internal_ids >= 0, internal_ids, -1)
+        return np.where(internal_ids >= 0, self._external[np.maximum(internal_ids, 0)], -1)
+
+    def save(self, file: BinaryIO):
+        """
+        :param file: a binary file object to write the map to in .npy format
+        """
+        np.save(file, self.external_ids, allow_pickle=False)
+
+    @classmethod
+    def load(cls, file: BinaryIO) -> 'IdMap':
+        """
+        :param file: a binary file object with a map in .npy format
+        :return: IdMap instance
+        """
+        return cls(np.load(file, allow_pickle=False))
@@ -0,0 +1,120 @@
+import numpy as np
+from collections import OrderedDict
+from io import BytesIO
+from threading import Lock
+from typing import Hashable, Optional, Sequence
+from .config import Config
+from .imports import import_module
+
+
+def decode_image(data: bytes) -> np.ndarray:
+    """
+    A function to decode image file contents to RGB or RGBA floats in [0, 1], as matplotlib reads PNG files.
+    Images with transparency keep an alpha channel
+    :param data: contents of an image file
+    :return: a read-only float32 array of shape (height, width, 3) or (height, width, 4)
+    """
+    with import_module('PIL.Image').open(BytesIO(data)) as image:
+        if image.mode.startswith('I;16'):
+            # 16-bit greyscale would be clipped by convert(), so scale it here
+            grey = np.divide(image, 2 ** 16 - 1, dtype=np.float32)
+            array = np.repeat(grey[:, :, None], 3, axis=2)
+        else:
+            # palette images become RGBA like matplotlib reads them, greyscale ones become RGB
+            has_alpha = 'A' in image.mode or image.mode == 'P' or 'transparency' in image.info
+            mode = 'RGBA' if has_alpha else 'RGB'
+            array = np.divide(image if image.mode == mode else image.convert(mode), 2 ** 8 - 1, dtype=np.float32)
+    array.setflags(write=False)
+    return array
+
+
+def make_thumbnail(data: bytes, size: int) -> bytes:
+    """
+    A function to downscale an image keeping its aspect ratio and file format
+    :param data: contents of an image file
+    :param size: maximum width and height of the thumbnail
+    :return: contents of the thumbnail file
+    """
+    with import_module('PIL.Image').open(BytesIO(data)) as image:
+        image_format = image.format or 'PNG'
+        image.thumbnail((size, size))
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        out = BytesIO()
+        image.save(out, format=image_format)
+    return out.getvalue()
+
+
+class ImageCache:
+    """
+    A bounded LRU cache of decoded images, bounded by total size of arrays in bytes. Safe to share between threads
+    """
+    def __init__(self, max_bytes: int = Config.IMAGE_CACHE_BYTES):
+        """
+        :param max_bytes: maximum total size of cached arrays
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._arrays = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._arrays)
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            array = self._arrays.get(key)
+            if array is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._arrays.move_to_end(key)
+            return array
+
+    def put(self, key: Hashable, array: np.ndarray):
+        if array.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._arrays:
+                self.n_bytes -= self._arrays.pop(key).nbytes
+            self._arrays[key] = array
+            self.n_bytes += array.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self._arrays.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+
+    def info(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._arrays),
+                    'bytes': self.n_bytes, 'max_bytes': self.max_bytes}
+
+
+def render_grid(images: Sequence[Optional[np.ndarray]],
+                titles: Sequence[str],
+                title: str = "",
+                n_cols: int = Config.GRID_COLUMNS):
+    """
+    A function to draw images on a single matplotlib figure
+    :param images: decoded images, None draws an empty cell
+    :param titles: titles of images
+    :param title: title of the figure
+    :param n_cols: number of columns of the grid
+    :return: matplotlib figure
+    """
+    plt = import_module('matplotlib.pyplot')
+    n_cols = max(1, min(n_cols, len(images)))
+    n_rows = max(1, -(-len(images) // n_cols))
+    figure, axes = plt.subplots(n_rows, n_cols, squeeze=False,
+                                figsize=(Config.GRID_CELL_SIZE * n_cols, Config.GRID_CELL_SIZE * n_rows))
+    if title:
+        figure.suptitle(title, fontsize=Config.FONTSIZE, fontweight='bold')
+    for cell, ax in enumerate(axes.ravel()):
+        ax.axis('off')
+        if cell < len(images):
+            if images[cell] is not None:
+                ax.imshow(images[cell])
+            ax.set_title(titles[cell], fontsize=Config.FONTSIZE * 0.75)
+    figure.tight_layout()
+    return figure
@@ -0,0 +1,51 @@
+import importlib
+import sys
+import time
+from types import ModuleType
+from typing import Any, Callable
+
+
+def import_module(name: str) -> ModuleType:
+    """
+    A function to import a heavy dependency when it is first needed rather than when kb is imported.
+    The time the first import takes is reported through the logger
+    :param name: absolute module name, e.g. matplotlib.pyplot
+    :return: the module
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    # log imports config, which creates lazy terms with this module, so the logger is imported here
+    from .log import Log
+    Log.get_logger().info(f"imported {name} in {time.perf_counter() - start:.3f}s")
+    return module
+
+
+class LazyAttribute:
+    """
+    A class attribute computed on first access, e.g. an rdflib term of Config which should not import rdflib
+    along with the class
+    """
+    def __init__(self, factory: Callable[[], Any]):
+        """
+        :param factory: a callable making the value
+        """
+        self._factory = factory
+        self._value = None
+
+    def __get__(self, instance: Any, owner: type) -> Any:
+        if self._value is None:
+            self._value = self._factory()
+        return self._value
+
+
+def rdf_term(kind: str, *args) -> LazyAttribute:
+    """
+    A function to declare an rdflib term which is made when it is first used
+    :param kind: name of rdflib class making the term, e.g. URIRef, Literal or Namespace
+    :param args: arguments of the class
+    :return: a lazy class attribute
+    """
+    return LazyAttribute(lambda: getattr(import_module('rdflib'), kind)(*args))
@@ -0,0 +1,146 @@
+import gzip
+import re
+from itertools import islice
+from pathlib import Path
+from rdflib import BNode, Dataset, Graph, URIRef
+from rdflib.term import Node
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+from .compact_graph import term_key
+from .config import Config
+from .graph_store import KeyTriple
+from .parallel import imap_prefetch, resolve_n_jobs
+
+
+# rdflib parser names of file extensions
+RDF_FORMATS = {'.ttl': 'turtle', '.nt': 'nt', '.nq': 'nquads', '.n3': 'n3', '.trig': 'trig',
+               '.rdf': 'xml', '.xml': 'xml', '.owl': 'xml', '.jsonld': 'json-ld'}
+# formats with one statement per line, which are split into chunks and parsed in parallel
+LINE_FORMATS = ('nt', 'nquads')
+
+# blank node labels are turned into IRIs with this prefix before a chunk is parsed and back afterwards,
+# since parsers rename blank nodes and the same label must stay one node across chunks
+_BNODE_PREFIX = 'urn:x-kb-bnode:'
+_BNODE = re.compile(rb'(?<![^\s])_:([^\s<>".]+(?:\.+[^\s<>".]+)*)')
+_SKOLEM_IRI = b'<' + _BNODE_PREFIX.encode('utf-8') + rb'\1>'
+
+
+def rdf_format(path: str) -> str:
+    """
+    A function to guess RDF serialization of a file from its extension, .gz files are compressed with gzip.
+    Files with unknown extensions are read as turtle
+    :param path: a path to RDF file
+    :return: rdflib parser name
+    """
+    suffixes = [x.lower() for x in Path(path).suffixes]
+    if suffixes and suffixes[-1] == '.gz':
+        suffixes.pop()
+    return RDF_FORMATS.get(suffixes[-1] if suffixes else '', 'turtle')
+
+
+def open_rdf(path: str) -> BinaryIO:
+    """
+    A function to open RDF file for reading, decompressing .gz files on the fly
+    :param path: a path to RDF file
+    :return: a binary file object
+    """
+    if Path(path).suffix.lower() == '.gz':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def parse_graph(path: str) -> Graph:
+    """
+    A function to read RDF file into an in-memory graph, contexts of N-Quads are merged
+    :param path: a path to RDF file
+    :return: rdflib graph
+    """
+    rdf = rdf_format(path)
+    with open_rdf(path) as f:
+        if rdf not in LINE_FORMATS:
+            graph = Graph()
+            graph.parse(file=f, format=rdf)
+            return graph
+        triples = _parse_lines(f.read(), rdf)
+    graph = Graph()
+    graph.addN((s, p, o, graph) for s, p, o in triples)
+    return graph
+
+
+def read_key_chunks(path: str,
+                    n_jobs: Optional[int] = None,
+                    chunk_lines: int = Config.PARSE_CHUNK_LINES) -> Iterator[List[KeyTriple]]:
+    """
+    A function to stream triples of RDF file as term keys. N-Triples and N-Quads are read in chunks of lines
+    which are parsed in parallel processes, a bounded number of chunks is read ahead. Other formats
+    are parsed in memory at once. Contexts of N-Quads are dropped
+    :param path: a path to RDF file
+    :param n_jobs: number of processes parsing chunks
+    :param chunk_lines: number of lines parsed at once
+    :return: an iterator over lists of (subject, predicate, object) term keys
+    """
+    rdf = rdf_format(path)
+    if rdf not in LINE_FORMATS:
+        keys = (tuple(map(term_key, triple)) for triple in parse_graph(path))
+        yield from iter(lambda: list(islice(keys, chunk_lines)), [])
+        return
+
+    with open_rdf(path) as f:
+        chunks = ((b''.join(lines), rdf) for lines in iter(lambda: list(islice(f, chunk_lines)), []))
+        yield from imap_prefetch(_parse_chunk, chunks, n_jobs=n_jobs, processes=resolve_n_jobs(n_jobs) > 1)
+
+
+def _parse_chunk(chunk: tuple) -> List[KeyTriple]:
+    """
+    A function to parse a chunk of N-Triples or N-Quads lines, it runs in worker processes
+    :param chunk: (lines, rdflib parser name) tuple
+    :return: (subject, predicate, object) term keys
+    """
+    return [tuple(map(term_key, triple)) for triple in _parse_lines(*chunk)]
+
+
+def _parse_lines(data: bytes, rdf: str) -> List[Tuple[Node, Node, Node]]:
+    """
+    A function to parse N-Triples or N-Quads keeping labels of blank nodes
+    :param data: N-Triples or N-Quads lines
+    :param rdf: rdflib parser name
+    :return: unique (subject, predicate, object) triples, contexts of N-Quads are dropped
+    """
+    if rdf == 'nquads':
+        dataset = Dataset()
+        dataset.parse(data=_skolemize(data).decode('utf-8'), format=rdf)
+        triples = {(s, p, o) for s, p, o, _ in dataset.quads((None, None, None, None))}
+    else:
+        triples = Graph()
+        triples.parse(data=_skolemize(data).decode('utf-8'), format=rdf)
+    return [tuple(map(_unskolemize, triple)) for triple in triples]
+
+
+def _skolemize(data: bytes) -> bytes:
+    """
+    :param data: N-Triples or N-Quads lines
+    :return: lines with blank nodes replaced by IRIs, literals are left intact
+    """
+    if b'_:' not in data:
+        return data
+    lines = data.split(b'\n')
+    for i, line in enumerate(lines):
+        if b'_:' not in line:
+            continue
+        # a line has at most one literal, blank nodes can only be before or after it
+        first, last = line.find(b'"'), line.rfind(b'"')
+        if first < 0:
+            lines[i] = _BNODE.sub(_SKOLEM_IRI, line)
+        else:
+            lines[i] = _BNODE.sub(_SKOLEM_IRI, line[:first]) + line[first:last + 1] + \
+                _BNODE.sub(_SKOLEM_IRI, line[last + 1:])
+    return b'\n'.join(lines)
+
+
+def _unskolemize(term: Node) -> Node:
+    """
+    :param term: a parsed term
+    :return: a blank node if the term is an IRI made by _skolemize, the term itself otherwise
+    """
+    if isinstance(term, URIRef) and term.startswith(_BNODE_PREFIX):
+        return BNode(term[len(_BNODE_PREFIX):])
+    return term
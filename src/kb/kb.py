@@ -1,10 +1,21 @@
-from rdflib import Literal
+from __future__ import annotations
 from .log import Log
 from .kbio import KBIO
-from typing import List
+from typing import Dict, List, Optional, Sequence, Tuple, Union, TYPE_CHECKING
 from .config import Config
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
+from .delta import merge_results
+from .filters import FilterSpec, IdFilter
+from .backends import BruteForceBackend
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+from .images import decode_image, render_grid
+from .imports import import_module
+from .metrics import hit_rate, measured
+from .parallel import resolve_n_jobs
+
+if TYPE_CHECKING:
+    from rdflib import URIRef
 
 
 log = Log.get_logger()
@@ -19,69 +30,668 @@ class KB(KBIO):
 
     @property
     def graph(self):
-        return self._graph
+        return self._get_graph()
 
-    def select_similar(self, entity_id: int, k_nearest: int = 10) -> List[int]:
+    @measured('select_similar')
+    def select_similar(self,
+                       entity_id: int,
+                       k_nearest: int = 10,
+                       search_k: Optional[int] = None,
+                       include_distances: bool = False,
+                       filter_by: Optional[FilterSpec] = None) -> Union[List[int], Tuple[List[int], List[float]]]:
         """
         A method to select k nearest to the entity with the given integer id
         :param entity_id: entity id whose closest neighbors we want
         :param k_nearest: a number of neighbors we want
-        :return: a list of int ids of closest neighbors
+        :param search_k: number of nodes to inspect during search, trades latency for recall.
+            Defaults to the value stored with the knowledge base
+        :param include_distances: whether to return distances along with ids
+        :param filter_by: optional, restricts neighbors to a set of entity ids, to entities matching
+            a (predicate, object) pattern (object may be None to match any value), or to entities selected
+            by the first variable of a SPARQL query. See compile_filter()
+        :return: a list of int ids of closest neighbors or a tuple of (ids, distances) lists
         """
-        # check whether entity with a given id exists
-        entity = None
-        for s, p, o in self._graph.triples((None, self._meta_dict['ENTITY_PREDICATE'], Literal(entity_id))):
-            entity = s
-        if not entity:
-            log.warning(f"entity with id `{entity_id}` does not exist")
-            return []
+        search_k = self._search_k(search_k)
+        use_table = filter_by is None and self._knn_table_covers(k_nearest, search_k)
 
-        # check whether it has an embedding
-        emb = None
-        for s, p, o in self._graph.triples((entity, Config.HAS_EMBEDDING, None)):
-            emb = o
-        if not emb:
+        # results of popular entities are answered from cache unless the neighbors table has them
+        key = (entity_id, k_nearest, search_k)
+        use_cache = filter_by is None and not use_table
+        if use_cache:
+            with self._cache_lock:
+                cached = self._result_cache.get(key)
+                if cached is not None:
+                    self._result_cache_hits += 1
+                    self._result_cache.move_to_end(key)
+                else:
+                    self._result_cache_misses += 1
+            if cached is not None:
+                return self._format_result(*cached, include_distances)
+
+        # check whether entity with a given id exists and has an embedding
+        exists, has_embedding = self._resolve_entities(np.array([entity_id]))
+        if not exists[0]:
+            log.warning(f"entity with id `{entity_id}` does not exist")
+            self._metrics.count('missing.entities')
+            return self._format_result([], [], include_distances)
+        if not has_embedding[0]:
             log.warning(f"entity with id `{entity_id}` does not have corresponding embeddings")
-            return []
+            self._metrics.count('missing.embeddings')
+            return self._format_result([], [], include_distances)
+
+        if use_table:
+            # a row of the neighbors table, closest neighbors come first
+            internal_id = self._id_map.to_internal(entity_id)
+            ids = self._id_map.to_external_many(self._knn_ids[internal_id, :k_nearest])
+            distances = self._knn_distances[internal_id, :k_nearest]
+        elif self._delta or filter_by is not None:
+            ids, distances = self._search(entity_ids=np.array([entity_id]), k_nearest=k_nearest, search_k=search_k,
+                                          allowed=self._filter(filter_by))
+            ids, distances = ids[0], distances[0]
+        else:
+            # query search index and translate results back to entity ids
+            nearest, distances = self._index.get_nns_by_item(self._id_map.to_internal(entity_id), k_nearest,
+                                                             search_k=search_k,
+                                                             include_distances=True)
+            ids = self._id_map.to_external_many(nearest)
+
+        if use_cache:
+            with self._cache_lock:
+                self._result_cache[key] = (np.asarray(ids), np.asarray(distances))
+                if len(self._result_cache) > Config.RESULT_CACHE_SIZE:
+                    self._result_cache.popitem(last=False)
+        return self._format_result(ids, distances, include_distances)
+
+    @measured('select_similar_by_uri')
+    def select_similar_by_uri(self,
+                              entity: URIRef,
+                              k_nearest: int = 10,
+                              search_k: Optional[int] = None,
+                              include_distances: bool = False,
+                              filter_by: Optional[FilterSpec] = None) \
+            -> Union[List[int], Tuple[List[int], List[float]]]:
+        """
+        A method to select k nearest to the entity with the given URI
+        :param entity: URIRef of the entity whose closest neighbors we want
+        :param k_nearest: a number of neighbors we want
+        :param search_k: number of nodes to inspect during search, defaults to the knowledge base value
+        :param include_distances: whether to return distances along with ids
+        :param filter_by: optional, restricts neighbors, see select_similar()
+        :return: a list of int ids of closest neighbors or a tuple of (ids, distances) lists
+        """
+        entity_id = self._entity_id(entity)
+        if entity_id is None:
+            log.warning(f"entity `{entity}` does not exist")
+            self._metrics.count('missing.entities')
+            return self._format_result([], [], include_distances)
+        return self.select_similar(entity_id=entity_id,
+                                   k_nearest=k_nearest,
+                                   search_k=search_k,
+                                   include_distances=include_distances,
+                                   filter_by=filter_by)
+
+    @measured('select_similar_by_vector')
+    def select_similar_by_vector(self,
+                                 vector: Union[Sequence[float], np.ndarray],
+                                 k_nearest: int = 10,
+                                 search_k: Optional[int] = None,
+                                 include_distances: bool = False,
+                                 filter_by: Optional[FilterSpec] = None) \
+            -> Union[List[int], Tuple[List[int], List[float]]]:
+        """
+        A method to select k nearest to an arbitrary vector, e.g. a freshly computed embedding
+        :param vector: query vector, its length should match the knowledge base embeddings
+        :param k_nearest: a number of neighbors we want
+        :param search_k: number of nodes to inspect during search, defaults to the knowledge base value
+        :param include_distances: whether to return distances along with ids
+        :param filter_by: optional, restricts neighbors, see select_similar()
+        :return: a list of int ids of closest neighbors or a tuple of (ids, distances) lists
+        """
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        if len(vector) != self._meta_dict['VECTOR_LENGTH']:
+            raise ValueError(f"query vector should have length {self._meta_dict['VECTOR_LENGTH']}, got {len(vector)}")
+
+        if self._delta or filter_by is not None:
+            ids, distances = self._search(vectors=vector[None], k_nearest=k_nearest, search_k=search_k,
+                                          allowed=self._filter(filter_by))
+            return self._format_result(ids[0], distances[0], include_distances)
+
+        nearest, distances = self._index.get_nns_by_vector(vector, k_nearest,
+                                                           search_k=self._search_k(search_k),
+                                                           include_distances=True)
+        return self._format_result(self._id_map.to_external_many(nearest), distances, include_distances)
+
+    @measured('select_similar_many')
+    def select_similar_many(self,
+                            entity_ids: Optional[Union[Sequence[int], np.ndarray]] = None,
+                            k_nearest: int = 10,
+                            vectors: Optional[np.ndarray] = None,
+                            search_k: Optional[int] = None,
+                            n_jobs: Optional[int] = None,
+                            filter_by: Optional[FilterSpec] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to select k nearest neighbors for many entities or query vectors at once.
+        Exactly one of entity_ids and vectors should be given
+        :param entity_ids: a sequence or array of entity ids whose closest neighbors we want
+        :param k_nearest: a number of neighbors we want per query
+        :param vectors: a 2-D array of query vectors, one per row
+        :param search_k: number of nodes to inspect during search, defaults to the knowledge base value
+        :param n_jobs: number of threads to spread queries over, defaults to Config.N_JOBS
+        :param filter_by: optional, restricts neighbors, see select_similar()
+        :return: a tuple of (ids, distances) arrays of shape (n_queries, k_nearest).
+            Rows of missing entities and slots without a neighbor hold -1 in ids and nan in distances
+        """
+        if (entity_ids is None) == (vectors is None):
+            raise ValueError("exactly one of `entity_ids` and `vectors` should be provided")
+
+        if entity_ids is not None:
+            entity_ids = np.asarray(entity_ids, dtype=np.int64).ravel()
+            exists, valid = self._resolve_entities(entity_ids)
+            missing = entity_ids[~valid]
+            if len(missing):
+                log.warning(f"{len(missing)} of {len(entity_ids)} entities do not exist or do not have "
+                            f"corresponding embeddings, first of them: {missing[:10].tolist()}")
+                self._metrics.count('missing.entities', int((~exists).sum()))
+                self._metrics.count('missing.embeddings', int((exists & ~valid).sum()))
+        else:
+            vectors = np.asarray(vectors, dtype=np.float32)
+            if vectors.ndim != 2 or vectors.shape[1] != self._meta_dict['VECTOR_LENGTH']:
+                raise ValueError(f"`vectors` should be a 2-D array with {self._meta_dict['VECTOR_LENGTH']} "
+                                 f"columns, got shape {vectors.shape}")
+
+        return self._search(entity_ids=entity_ids, vectors=vectors, k_nearest=k_nearest,
+                            search_k=search_k, n_jobs=n_jobs, allowed=self._filter(filter_by))
+
+    @measured('get_embeddings')
+    def get_embeddings(self, entity_ids: Union[Sequence[int], np.ndarray]) -> np.ndarray:
+        """
+        A method to get embeddings of many entities at once
+        :param entity_ids: a sequence or array of entity ids
+        :return: a 2-D array with one embedding per row, rows of entities without embeddings are filled with nan
+        """
+        entity_ids = np.asarray(entity_ids, dtype=np.int64).ravel()
+        embeddings, valid = self._get_vectors(entity_ids)
+        if not valid.all():
+            missing = entity_ids[~valid]
+            log.warning(f"{len(missing)} of {len(entity_ids)} entities do not have corresponding embeddings, "
+                        f"first of them: {missing[:10].tolist()}")
+            self._metrics.count('missing.embeddings', len(missing))
+        return embeddings
 
-        # query search index and return results
-        return self._index.get_nns_by_item(entity_id, k_nearest)
+    @measured('get_embeddings_by_query')
+    def get_embeddings_by_query(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to get embeddings of entities selected by a SPARQL query over the graph
+        :param query: SPARQL query, entities are taken from the first variable of every result row
+        :return: a tuple of (entity ids, embeddings) arrays, entities without embeddings are skipped
+        """
+        entity_ids = []
+        seen = set()
+        for row in self.graph.query(query):
+            entity_id = self._entity_id(row[0])
+            if entity_id is not None and entity_id not in seen:
+                seen.add(entity_id)
+                entity_ids.append(entity_id)
+
+        entity_ids = np.array(entity_ids, dtype=np.int64)
+        embeddings, valid = self._get_vectors(entity_ids)
+        return entity_ids[valid], embeddings[valid]
+
+    def result_cache_info(self) -> Dict[str, int]:
+        """
+        A method to get statistics of select_similar result cache since the knowledge base last changed
+        :return: a dict with `hits`, `misses`, `size` and `max_size`
+        """
+        with self._cache_lock:
+            return {'hits': self._result_cache_hits,
+                    'misses': self._result_cache_misses,
+                    'size': len(self._result_cache),
+                    'max_size': Config.RESULT_CACHE_SIZE}
+
+    def metrics_snapshot(self) -> dict:
+        """
+        A method to get recorded timings and counters along with current cache statistics and sizes,
+        see metrics.Metrics.snapshot(). Recording is enabled with kb.metrics.enable()
+        :return: a dict with `stages`, `latency`, `counters`, `profiles`, `caches` and `sizes`
+        """
+        snapshot = self._metrics.snapshot()
+        with self._cache_lock:
+            filter_info = {'hits': self._filter_cache_hits, 'misses': self._filter_cache_misses,
+                           'size': len(self._filter_cache), 'max_size': Config.FILTER_CACHE_SIZE}
+        caches = {'result': self.result_cache_info(),
+                  'image': self.image_cache_info(),
+                  'filter': filter_info}
+        for info in caches.values():
+            info['hit_rate'] = hit_rate(info['hits'], info['misses'])
+        snapshot['caches'] = caches
+
+        sizes = {'index_items': len(self._id_map) if self._id_map is not None else 0,
+                 'embeddings_bytes': int(self._embeddings.nbytes) if self._embeddings is not None else 0,
+                 'delta_items': len(self._delta.ids) if self._delta is not None else 0,
+                 'delta_removed': len(self._delta.tombstones) if self._delta is not None else 0}
+        if self._archive is not None:
+            sizes['archive_bytes'] = os.path.getsize(self._archive_path)
+            if self._index is not None and self._index.FILE_NAME in self._archive.NameToInfo:
+                sizes['index_bytes'] = self._archive.getinfo(self._index.FILE_NAME).file_size
+        if self._compact_graph is not None:
+            sizes['graph_triples'] = len(self._compact_graph)
+        if self._lookup is not None:
+            sizes['lookup_entities'] = len(self._lookup)
+        snapshot['sizes'] = sizes
+        return snapshot
+
+    @measured('compile_filter')
+    def compile_filter(self, filter_by: FilterSpec) -> IdFilter:
+        """
+        A method to turn a filter into a set of allowed entities with a bitmap over search index ids.
+        Compiled filters are cached until the knowledge base changes, so repeated searches with the same
+        filter do not query the graph again. The result may also be passed to select_similar() as is
+        :param filter_by: a set of entity ids, a (predicate, object) pattern where object None matches
+            any value, or a SPARQL query whose first variable selects entities
+        :return: IdFilter instance
+        """
+        if isinstance(filter_by, IdFilter):
+            return filter_by
 
-    def select_similar_image(self, entity_id: int, k_nearest: int = 10):
+        entity_ids = None
+        if isinstance(filter_by, str):
+            key = ('query', filter_by)
+        elif isinstance(filter_by, tuple) and len(filter_by) == 2 and \
+                isinstance(filter_by[0], import_module('rdflib').URIRef):
+            key = ('pattern',) + filter_by
+        else:
+            if not isinstance(filter_by, np.ndarray):
+                filter_by = list(filter_by)
+            entity_ids = np.unique(np.asarray(filter_by, dtype=np.int64))
+            key = ('ids', entity_ids.tobytes())
+
+        with self._cache_lock:
+            compiled = self._filter_cache.get(key)
+            if compiled is not None:
+                self._filter_cache_hits += 1
+                self._filter_cache.move_to_end(key)
+            else:
+                self._filter_cache_misses += 1
+        if compiled is not None:
+            return compiled
+
+        if key[0] == 'query':
+            subjects = (row[0] for row in self.graph.query(filter_by))
+        elif key[0] == 'pattern':
+            subjects = self._graph_view().subjects(filter_by[0], filter_by[1])
+        if entity_ids is None:
+            entity_ids = [x for x in map(self._entity_id, subjects) if x is not None]
+        compiled = IdFilter(entity_ids, self._id_map)
+        log.info(f"compiled filter allowing {len(compiled)} entities, {compiled.n_indexed} of them in search index")
+
+        with self._cache_lock:
+            self._filter_cache[key] = compiled
+            if len(self._filter_cache) > Config.FILTER_CACHE_SIZE:
+                self._filter_cache.popitem(last=False)
+        return compiled
+
+    def _filter(self, filter_by: Optional[FilterSpec]) -> Optional[IdFilter]:
+        return None if filter_by is None else self.compile_filter(filter_by)
+
+    def _entity_id(self, subject: URIRef) -> Optional[int]:
+        """
+        :param subject: subject URI
+        :return: entity id or None if the subject is not a known entity
+        """
+        if self._delta is not None:
+            entity_id = self._delta.lookup.entity_id(subject)
+            if entity_id is not None:
+                return entity_id
+        entity_id = self._get_lookup().entity_id(subject)
+        if entity_id is None or (self._delta is not None and self._delta.is_removed([entity_id])[0]):
+            return None
+        return entity_id
+
+    def _resolve_entities(self, entity_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to check entities against lookup tables and changes made since the archive was built
+        :param entity_ids: an array of entity ids
+        :return: a tuple of bool arrays telling whether entities exist and whether they have embeddings
+        """
+        lookup = self._get_lookup()
+        positions = lookup.positions(entity_ids)
+        exists = positions >= 0
+        has_embedding = lookup.has_embedding_at(positions) & (self._id_map.to_internal_many(entity_ids) >= 0)
+        if self._delta is not None:
+            removed = self._delta.is_removed(entity_ids)
+            exists = (exists & ~removed) | (self._delta.lookup.positions(entity_ids) >= 0)
+            has_embedding = (has_embedding & ~removed) | (self._delta.id_map.to_internal_many(entity_ids) >= 0)
+        return exists, has_embedding
+
+    def _get_vectors(self, entity_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param entity_ids: an array of entity ids
+        :return: a tuple of (embeddings, valid) arrays, rows of entities without embeddings are filled with nan
         """
-        A method to get the nearest neighbors to the given entity
+        internal_ids = self._id_map.to_internal_many(entity_ids)
+        in_main = internal_ids >= 0
+        delta_rows = np.full(len(entity_ids), -1, dtype=np.int64)
+        if self._delta is not None:
+            # embeddings in delta replace ones in the main archive
+            in_main &= ~np.isin(entity_ids, self._delta.shadowed)
+            delta_rows = self._delta.id_map.to_internal_many(entity_ids)
+        in_delta = delta_rows >= 0
+
+        dtype = self._embeddings.dtype if self._embeddings is not None else np.float32
+        embeddings = np.full((len(entity_ids), self._meta_dict['VECTOR_LENGTH']), np.nan, dtype=dtype)
+        embeddings[in_main] = self._main_vectors(internal_ids[in_main])
+        if in_delta.any():
+            embeddings[in_delta] = self._delta.vectors[delta_rows[in_delta]]
+        return embeddings, in_main | in_delta
+
+    def _main_vectors(self, internal_ids: np.ndarray) -> np.ndarray:
+        """
+        :param internal_ids: search index ids
+        :return: a 2-D array of vectors of the main archive
+        """
+        if self._embeddings is not None:
+            # fancy indexing on a memory-mapped matrix reads only the requested rows
+            return self._embeddings[internal_ids]
+        # older archives keep vectors only in the search index
+        vectors = np.empty((len(internal_ids), self._meta_dict['VECTOR_LENGTH']), dtype=np.float32)
+        for row, internal_id in enumerate(internal_ids.tolist()):
+            vectors[row] = self._index.get_item_vector(internal_id)
+        return vectors
+
+    def _search(self,
+                entity_ids: Optional[np.ndarray] = None,
+                vectors: Optional[np.ndarray] = None,
+                k_nearest: int = 10,
+                search_k: Optional[int] = None,
+                n_jobs: Optional[int] = None,
+                allowed: Optional[IdFilter] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to find neighbors of entities or vectors in the main index and in the delta.
+        Main index results of removed and replaced entities are hidden, and the delta is searched
+        exactly, then both results are merged by distance
+        :param entity_ids: an array of entity ids, rows of entities without embeddings are left empty
+        :param vectors: a 2-D float32 array of query vectors, used if entity_ids is None
+        :param k_nearest: a number of neighbors we want per query
+        :param search_k: number of nodes to inspect during search, defaults to the knowledge base value
+        :param n_jobs: number of threads
+        :param allowed: optional, entities allowed in results
+        :return: a tuple of (entity ids, distances) arrays of shape (n_queries, k_nearest) padded with -1 and nan
+        """
+        search_k = self._search_k(search_k)
+        if not self._delta and allowed is None:
+            if entity_ids is not None:
+                _, valid = self._resolve_entities(entity_ids)
+                internal_ids = np.where(valid, self._id_map.to_internal_many(entity_ids), -1)
+                if self._knn_table_covers(k_nearest, search_k):
+                    rows = np.maximum(internal_ids, 0)
+                    ids = np.where(valid[:, None], self._knn_ids[rows, :k_nearest], -1)
+                    distances = np.where(valid[:, None], self._knn_distances[rows, :k_nearest],
+                                         np.nan).astype(np.float32)
+                else:
+                    ids, distances = self._index.get_nns_by_items(internal_ids, k_nearest, search_k=search_k,
+                                                                   n_jobs=n_jobs)
+            else:
+                ids, distances = self._index.get_nns_by_vectors(vectors, k_nearest, search_k=search_k,
+                                                                 n_jobs=n_jobs)
+            return self._id_map.to_external_many(ids), distances
+
+        if entity_ids is not None:
+            vectors, valid = self._get_vectors(entity_ids)
+        else:
+            valid = np.ones(len(vectors), dtype=bool)
+        rows = np.flatnonzero(valid)
+        queries = np.asarray(vectors[rows], dtype=np.float32)
+
+        merged_ids, merged_distances = self._search_main(queries, k_nearest, search_k, n_jobs, allowed)
+        if self._delta and len(self._delta.ids):
+            # delta is small, with a filter all of it is ranked and then filtered
+            delta_ids, delta_distances = self._delta.search(queries, k_nearest if allowed is None
+                                                            else len(self._delta.ids))
+            if allowed is not None:
+                delta_ids[~allowed.allows(delta_ids)] = -1
+            merged_ids, merged_distances = merge_results(self._index.metric,
+                                                         (merged_ids, delta_ids),
+                                                         (merged_distances, delta_distances),
+                                                         k_nearest)
+
+        ids = np.full((len(vectors), k_nearest), -1, dtype=np.int64)
+        distances = np.full((len(vectors), k_nearest), np.nan, dtype=np.float32)
+        ids[rows], distances[rows] = merged_ids, merged_distances
+        return ids, distances
+
+    def _search_main(self,
+                     queries: np.ndarray,
+                     k_nearest: int,
+                     search_k: int,
+                     n_jobs: Optional[int] = None,
+                     allowed: Optional[IdFilter] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to query the main index leaving out entities hidden by the delta or rejected by a filter.
+        Neighbors are over-requested in proportion to the share of accepted items, and the request
+        grows for queries which still have less than k_nearest accepted neighbors. search_k grows along
+        with the request, otherwise the index would inspect as many nodes for every request and return
+        as few candidates. Filters allowing fewer items than would be requested are searched exactly,
+        as are queries which are short of neighbors once the whole index would be requested
+        :param queries: a 2-D float32 array of query vectors
+        :param k_nearest: a number of neighbors we want per query
+        :param search_k: number of nodes to inspect during search
+        :param n_jobs: number of threads
+        :param allowed: optional, entities allowed in results
+        :return: a tuple of (entity ids, distances) arrays of shape (n_queries, k_nearest) padded with -1 and nan
+        """
+        n_items = self._index.get_n_items()
+        hidden = self._delta.shadowed if self._delta else np.zeros(0, dtype=np.int64)
+        n_hidden = int((self._id_map.to_internal_many(hidden) >= 0).sum())
+        n_request = k_nearest + n_hidden
+        if allowed is not None:
+            n_request = int(np.ceil(n_request * n_items / max(allowed.n_indexed, 1)))
+            if allowed.n_indexed == 0:
+                return (np.full((len(queries), k_nearest), -1, dtype=np.int64),
+                        np.full((len(queries), k_nearest), np.nan, dtype=np.float32))
+            if allowed.n_indexed <= n_request:
+                return self._search_allowed(queries, k_nearest, allowed, hidden, n_hidden)
+        n_request = min(n_request, n_items)
+
+        ids = np.full((len(queries), k_nearest), -1, dtype=np.int64)
+        distances = np.full((len(queries), k_nearest), np.nan, dtype=np.float32)
+        pending = np.arange(len(queries))
+        while len(pending):
+            if allowed is not None and n_request >= n_items:
+                ids[pending], distances[pending] = self._search_allowed(queries[pending], k_nearest, allowed,
+                                                                        hidden, n_hidden)
+                break
+            request_search_k = search_k
+            if n_request >= n_items:
+                request_search_k = -1
+            elif search_k > 0:
+                request_search_k = int(np.ceil(search_k * n_request / k_nearest))
+            found, found_distances = self._index.get_nns_by_vectors(queries[pending], n_request,
+                                                                    search_k=request_search_k, n_jobs=n_jobs)
+            rejected = None if allowed is None else ~allowed.allows_internal(found)
+            found, found_distances = self._accept(found, found_distances, hidden, k_nearest, rejected)
+            done = ((found >= 0).sum(axis=1) == k_nearest) | (n_request >= n_items)
+            ids[pending[done]], distances[pending[done]] = found[done], found_distances[done]
+            pending = pending[~done]
+            n_request = min(n_request * Config.FILTER_GROWTH, n_items)
+        return ids, distances
+
+    def _search_allowed(self,
+                        queries: np.ndarray,
+                        k_nearest: int,
+                        allowed: IdFilter,
+                        hidden: np.ndarray,
+                        n_hidden: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to search vectors of allowed entities exactly
+        :param queries: a 2-D float32 array of query vectors
+        :param k_nearest: a number of neighbors we want per query
+        :param allowed: entities allowed in results
+        :param hidden: entity ids to drop
+        :param n_hidden: number of hidden entities in the main index
+        :return: a tuple of (entity ids, distances) arrays of shape (n_queries, k_nearest) padded with -1 and nan
+        """
+        if allowed.exact_index is None:
+            allowed.exact_index = BruteForceBackend.from_matrix(self._main_vectors(allowed.internal_ids),
+                                                                self._index.metric)
+        found, distances = allowed.exact_index.get_nns_by_vectors(queries, k_nearest + n_hidden)
+        found = np.where(found >= 0, allowed.internal_ids[np.maximum(found, 0)], -1)
+        return self._accept(found, distances, hidden, k_nearest)
+
+    def _accept(self,
+                found: np.ndarray,
+                distances: np.ndarray,
+                hidden: np.ndarray,
+                k_nearest: int,
+                rejected: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to drop hidden and rejected neighbors and keep the first k_nearest of the rest
+        :param found: search index ids of neighbors ordered by distance, -1 marks empty slots
+        :param distances: distances to neighbors
+        :param hidden: entity ids to drop
+        :param k_nearest: a number of neighbors to keep
+        :param rejected: optional, a bool array marking other neighbors to drop
+        :return: a tuple of (entity ids, distances) arrays of shape (n_queries, k_nearest) padded with -1 and nan
+        """
+        found = self._id_map.to_external_many(found)
+        accepted = found >= 0
+        if len(hidden):
+            accepted &= ~np.isin(found, hidden)
+        if rejected is not None:
+            accepted &= ~rejected
+        # move accepted neighbors to the front keeping their order
+        order = np.argsort(~accepted, axis=1, kind='stable')[:, :k_nearest]
+        accepted = np.take_along_axis(accepted, order, axis=1)
+        ids = np.full((len(found), k_nearest), -1, dtype=np.int64)
+        kept_distances = np.full((len(found), k_nearest), np.nan, dtype=np.float32)
+        ids[:, :order.shape[1]] = np.where(accepted, np.take_along_axis(found, order, axis=1), -1)
+        kept_distances[:, :order.shape[1]] = np.where(accepted, np.take_along_axis(distances, order, axis=1), np.nan)
+        return ids, kept_distances
+
+    def _knn_table_covers(self, k_nearest: int, search_k: int) -> bool:
+        """
+        :param k_nearest: a number of neighbors we want
+        :param search_k: number of nodes to inspect during search
+        :return: whether the query can be answered from the neighbors table
+        """
+        return (self._knn_ids is not None and not self._delta
+                and k_nearest <= self._meta_dict['KNN_K'] and search_k == self._meta_dict['KNN_SEARCH_K'])
+
+    def _search_k(self, search_k: Optional[int] = None) -> int:
+        """
+        :param search_k: requested search_k or None
+        :return: requested search_k or the knowledge base default
+        """
+        if search_k is None:
+            return self._meta_dict.get('SEARCH_K', Config.SEARCH_K)
+        return search_k
+
+    @staticmethod
+    def _format_result(nearest: Union[List[int], np.ndarray],
+                       distances: Union[List[float], np.ndarray],
+                       include_distances: bool) -> Union[List[int], Tuple[List[int], List[float]]]:
+        """
+        :param nearest: entity ids of neighbors, -1 marks empty slots
+        :param distances: distances to neighbors
+        :param include_distances: whether to return distances along with ids
+        :return: a list of entity ids or a tuple of (entity ids, distances) lists
+        """
+        nearest = np.asarray(nearest, dtype=np.int64)
+        found = nearest >= 0
+        ids = nearest[found].tolist()
+        if include_distances:
+            return ids, np.asarray(distances, dtype=np.float64)[found].tolist()
+        return ids
+
+    @measured('get_image_bytes')
+    def get_image_bytes(self, entity_id: int, thumbnail: bool = False) -> Optional[bytes]:
+        """
+        A method to get image file contents of an entity, e.g. to serve it as is
+        :param entity_id: entity id
+        :param thumbnail: whether to get a downscaled copy
+        :return: contents of the image file or None if the entity has no image
+        """
+        return self._read_image(entity_id, thumbnail=thumbnail)
+
+    def get_image(self, entity_id: int, thumbnail: bool = False) -> Optional[np.ndarray]:
+        """
+        A method to get a decoded image of an entity, recently decoded images are cached
+        :param entity_id: entity id
+        :param thumbnail: whether to get a downscaled copy
+        :return: a read-only RGB or RGBA float array of shape (height, width, channels)
+            or None if the entity has no image
+        """
+        return self.get_images([entity_id], thumbnail=thumbnail)[0]
+
+    @measured('get_images')
+    def get_images(self,
+                   entity_ids: Union[Sequence[int], np.ndarray],
+                   thumbnail: bool = False,
+                   n_jobs: Optional[int] = None) -> List[Optional[np.ndarray]]:
+        """
+        A method to get decoded images of many entities, images which are not cached are decoded in parallel
+        :param entity_ids: a sequence or array of entity ids
+        :param thumbnail: whether to get downscaled copies
+        :param n_jobs: number of threads reading and decoding images, defaults to Config.N_JOBS
+        :return: a list of read-only arrays, None for entities without images
+        """
+        keys = [(int(x), thumbnail) for x in entity_ids]
+        images = [self._image_cache.get(key) for key in keys]
+        missing = [i for i, image in enumerate(images) if image is None]
+
+        def read(i: int) -> Optional[np.ndarray]:
+            data = self._read_image(keys[i][0], thumbnail=thumbnail)
+            return None if data is None else decode_image(data)
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(len(missing), resolve_n_jobs(n_jobs))) as pool:
+                for i, image in zip(missing, pool.map(read, missing)):
+                    if image is not None:
+                        self._image_cache.put(keys[i], image)
+                    images[i] = image
+        return images
+
+    def image_cache_info(self) -> Dict[str, int]:
+        """
+        A method to get statistics of decoded image cache since the knowledge base last changed
+        :return: a dict with `hits`, `misses`, `size`, `bytes` and `max_bytes`
+        """
+        return self._image_cache.info()
+
+    def show_images(self,
+                    entity_ids: Union[Sequence[int], np.ndarray],
+                    titles: Optional[Sequence[str]] = None,
+                    title: str = "",
+                    thumbnail: bool = False,
+                    n_cols: int = Config.GRID_COLUMNS):
+        """
+        A method to show images of entities on a single figure
+        :param entity_ids: a sequence or array of entity ids
+        :param titles: optional, titles of images, entity ids by default
+        :param title: title of the figure
+        :param thumbnail: whether to show downscaled copies, which are faster to read and decode
+        :param n_cols: number of columns of the grid
+        :return: matplotlib figure, shows it in cell output if using Jupyter
+        """
+        images = self.get_images(entity_ids, thumbnail=thumbnail)
+        missing = [int(x) for x, image in zip(entity_ids, images) if image is None]
+        if missing:
+            log.warning(f"{len(missing)} entities do not have corresponding images, first of them: {missing[:10]}")
+        if titles is None:
+            titles = [f"id: {x}" for x in entity_ids]
+        return render_grid(images, titles, title=title, n_cols=n_cols)
+
+    def select_similar_image(self, entity_id: int, k_nearest: int = 10, thumbnail: bool = False):
+        """
+        A method to show images of the given entity and of its nearest neighbors
         :param entity_id: entity which we want to get neighbors for
         :param k_nearest: number of neighbors
-        :return: None, prints images to cell output if using Jupyter
+        :param thumbnail: whether to show downscaled copies
+        :return: matplotlib figure, shows it in cell output if using Jupyter
         """
         similar_ids = self.select_similar(entity_id=entity_id, k_nearest=k_nearest)
-        self._show_image(entity_id=entity_id, title=f"showing image with requested id `{entity_id}`")
-        for enum, id_ in enumerate(similar_ids):
-            self._show_image(entity_id=id_, title=f"showing neighbor photo. Rank: `{enum + 1}`, id: {id_}")
-
-    def _show_image(self, entity_id: int, title: str):
-        """
-        A method to show a single image for a given entity
-        :param entity_id: entity to show image for
-        :param title: title to show above the image
-        :return: None, prints images to cell output if using Jupyter
-        """
-        for s, p, o in self._graph.triples((None, self._meta_dict['ENTITY_PREDICATE'], Literal(entity_id))):
-            entity = s
-
-        # check whether it has an embedding
-        img = None
-        for s, p, o in self._graph.triples((entity, Config.HAS_IMAGE, None)):
-            img = o
-        if not img:
-            log.warning(f"entity with id `{entity_id}` does not have corresponding images")
-        else:
-            # read image from archive
-            name = f"{Config.IMAGES_FOLDER}/{img}"
-            image = self._archive.open(name)
-            img_array = mpimg.imread(image)
-
-            # plot it with matplotlib
-            plt.figure()
-            plt.suptitle(title, fontsize=Config.FONTSIZE, fontweight='bold')
-            plt.imshow(img_array)
+        titles = [f"requested id: {entity_id}"]
+        titles += [f"rank: {enum + 1}, id: {id_}" for enum, id_ in enumerate(similar_ids)]
+        return self.show_images([entity_id] + similar_ids,
+                                titles=titles,
+                                title=f"neighbors of entity with id `{entity_id}`",
+                                thumbnail=thumbnail)
@@ -1,10 +1,14 @@
-from rdflib import Literal, RDF, URIRef, RDFS
-import rdflib
+from __future__ import annotations
 import os
 from pathlib import Path
 from .config import Config
+from .imports import import_module
 from .log import Log
-from typing import List
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import rdflib
+    from rdflib import URIRef
 
 
 log = Log.get_logger()
@@ -22,75 +26,110 @@ class KBReificationInterface:
                emb_path: str,
                has_id_name: URIRef,
                entity_type: URIRef,
-               img_path: str = "") -> rdflib.Graph:
+               img_path: str = "",
+               emb_names: Optional[Dict[int, str]] = None,
+               img_names: Optional[Dict[int, str]] = None,
+               report: Optional[Dict[str, int]] = None) -> rdflib.Graph:
         """
         :param graph: a graph to reify
         :param emb_path: a path to embeddings folder
         :param has_id_name: a predicate which leads to reified entity is
         :param entity_type: a typed of entities to reify
         :param img_path: a path to images folder
+        :param emb_names: optional, entity id -> embedding name. If given, emb_path is not listed
+        :param img_names: optional, entity id -> image name. If given, img_path is not listed
+        :param report: optional, a dictionary to put counts of matched entities, entities without embeddings
+            and entities sharing an id with another entity to
         :return: a reified graph
         """
-
-        # list of entity ids
-        entity_ids = []
-        # list of entities
-        entities = []
-
-        # select entity ids and entities
-        for s, p, o in graph.triples((None, RDF.type, entity_type)):
-            entity = s
-            for s_, p_, o_ in graph.triples((entity, has_id_name, None)):
-                entity_ids.append(o_.value)
-                entities.append(entity)
+        # select entities and their ids in one pass over each of the two predicates
+        entities = cls._select_entities(graph, has_id_name, entity_type)
+        entity_ids = [_id for _, _id in entities]
+        n_duplicates = len(entity_ids) - len(set(entity_ids))
+        if n_duplicates:
+            log.warning(f"{n_duplicates} entities have an id used by another entity")
 
         log.info("Reifying graph with embeddings")
-        graph = cls._reify_with_external_entity(graph=graph,
-                                                path=emb_path,
-                                                entity_list=entities,
-                                                entity_id_list=entity_ids,
-                                                predicate=Config.HAS_EMBEDDING)
+        if emb_names is None:
+            emb_names = cls.list_external(emb_path)
+        n_matched = cls._reify_with_external_entity(graph=graph,
+                                                    entities=entities,
+                                                    predicate=Config.HAS_EMBEDDING,
+                                                    names=emb_names)
 
         # if images provided then enrich with images
-        if img_path:
+        n_images = 0
+        if img_path or img_names is not None:
             log.info("Reifying graph with images")
-            graph = cls._reify_with_external_entity(graph=graph,
-                                                    path=img_path,
-                                                    entity_list=entities,
-                                                    entity_id_list=entity_ids,
-                                                    predicate=Config.HAS_IMAGE)
+            if img_names is None:
+                img_names = cls.list_external(img_path)
+            n_images = cls._reify_with_external_entity(graph=graph,
+                                                       entities=entities,
+                                                       predicate=Config.HAS_IMAGE,
+                                                       names=img_names)
+
+        log.info(f"reified {len(entities)} entities: {n_matched} with embeddings, "
+                 f"{len(entities) - n_matched} without embeddings, {n_images} with images, "
+                 f"{n_duplicates} with duplicate ids")
+        if report is not None:
+            report.update({'entities': len(entities),
+                           'matched': n_matched,
+                           'no_embedding': len(entities) - n_matched,
+                           'images': n_images,
+                           'duplicate_ids': n_duplicates})
 
         # add metadata about images and embeddings
         graph = cls._reify_with_metadata(graph)
 
         return graph
 
+    @staticmethod
+    def list_external(path: str) -> Dict[int, str]:
+        """
+        A method to list external entities of a folder in a single pass
+        :param path: a path with external entities where names of files are entity ids
+        :return: entity id -> file name
+        """
+        names = dict()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                stem = Path(entry.name).stem
+                if stem.isnumeric() and entry.is_file():
+                    names[int(stem)] = entry.name
+        return names
+
+    @staticmethod
+    def _select_entities(graph: rdflib.Graph,
+                         has_id_name: URIRef,
+                         entity_type: URIRef) -> List[Tuple[rdflib.URIRef, int]]:
+        """
+        A method to select typed entities with their ids
+        :param graph: a graph to select entities from
+        :param has_id_name: a predicate which leads to entity id
+        :param entity_type: a type of entities to select
+        :return: (entity, id) tuples, an entity with several ids is listed once per id
+        """
+        typed = set(graph.subjects(import_module('rdflib').RDF.type, entity_type))
+        return [(s, o.value) for s, o in graph.subject_objects(has_id_name) if s in typed]
+
     @staticmethod
     def _reify_with_external_entity(graph: rdflib.Graph,
-                                    path: str,
-                                    entity_list: List[rdflib.URIRef],
-                                    entity_id_list: List[int],
-                                    predicate: rdflib.URIRef) -> rdflib.Graph:
+                                    entities: List[Tuple[rdflib.URIRef, int]],
+                                    predicate: rdflib.URIRef,
+                                    names: Dict[int, str]) -> int:
         """
-        A method to reify a graph entities with links to external objects
-        :param graph: a graph to reify
-        :param path: a path with external entities where names of files correspond with
-            the names of entities to reify and both are integers
-        :param entity_list: a list of entities to check whether they are eligible for reification
-        :param entity_id_list: a list of entities ids. Each id corresponds to one in entity_list
+        A method to reify a graph entities with links to external objects. Triples are added in bulk
+        :param graph: a graph to reify, it is changed in place
+        :param entities: (entity, id) tuples of entities eligible for reification
         :param predicate: a URIRef - a predicate to use when creating a link between a reified entity
             and an external entity
-        :return: reified graph
+        :param names: external entity id -> name
+        :return: number of reified entities
         """
-        # list all external entities with correct names
-        external_entities_ids = {int(Path(x).stem) for x in os.listdir(path) if Path(x).stem.isnumeric()}
-        external_entities_names_dct = {int(Path(x).stem): x for x in os.listdir(path) if Path(x).stem.isnumeric()}
-
-        for _id, entity in zip(entity_id_list, entity_list):
-            if _id in external_entities_ids:
-                graph.add((entity, predicate, Literal(external_entities_names_dct[_id])))
-
-        return graph
+        literal = import_module('rdflib').Literal
+        quads = [(entity, predicate, literal(names[_id]), graph) for entity, _id in entities if _id in names]
+        graph.addN(quads)
+        return len(quads)
 
     @staticmethod
     def _reify_with_metadata(graph: rdflib.Graph) -> rdflib.Graph:
@@ -100,13 +139,14 @@ class KBReificationInterface:
         :param graph: RDFLib graph object
         :return: RDFLib graph object
         """
+        rdflib = import_module('rdflib')
 
         # add metadata about embeddings
-        graph.add((Config.EMBEDDING, RDF.type, RDFS.Class))
+        graph.add((Config.EMBEDDING, rdflib.RDF.type, rdflib.RDFS.Class))
         graph.add((Config.EMBEDDING, Config.LOCATED_AT, Config.EMBEDDING_LOCATION))
 
         # add metadata about images
-        graph.add((Config.IMAGE, RDF.type, RDFS.Class))
+        graph.add((Config.IMAGE, rdflib.RDF.type, rdflib.RDFS.Class))
         graph.add((Config.IMAGE, Config.LOCATED_AT, Config.IMAGE_LOCATION_GRAPH))
 
         return graph
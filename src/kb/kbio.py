@@ -1,16 +1,36 @@
-from annoy import AnnoyIndex
+from __future__ import annotations
 import numpy as np
 import os
-from rdflib import Graph, URIRef, Literal
 import pickle
+import time
 from .log import Log
 from .config import Config
 import shutil
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED
 from .kb_reification_interface import KBReificationInterface
+from .id_map import IdMap
+from .lookup import EntityLookup
+from .backends import get_backend, SearchBackend, BuildOptions, BruteForceBackend
+from .tuning import auto_tune
+from .archive import open_member, read_npy, verify_archive, write_manifest, write_npy
+from .cache import file_sha256, remove_cached
+from .embeddings import EmbeddingSource
+from .delta import DeltaSegment
+from .images import ImageCache, make_thumbnail
+from .imports import import_module
+from .metrics import Metrics, measured
+from .parallel import imap_prefetch
 from pathlib import Path
+from typing import BinaryIO, Callable, Iterator, List, Optional, Sequence, Tuple, Union, TYPE_CHECKING
+from functools import partial
+from collections import OrderedDict
 from io import BytesIO
-from random import randint
+from threading import Lock
+import tempfile
+
+if TYPE_CHECKING:
+    from rdflib import Graph, URIRef
+    from .compact_graph import CompactGraph
 
 
 log = Log.get_logger()
@@ -22,172 +42,829 @@ class KBIO(KBReificationInterface):
     """
     def __init__(self):
         self._graph = None
+        self._compact_graph = None
+        # whether rdflib graph is kept in a disk-backed store, and a temp directory of the store built for queries
+        self._on_disk_graph = False
+        self._graph_dir = None
         self._index = None
         self._tmp_dir = None
+        # temp directory with the file of an index built by this instance, kept while the index maps it
+        self._index_dir = None
         self._archive = None
+        self._archive_path = None
+        self._embeddings = None
+        # precomputed neighbors table, internal ids and distances of the nearest items of every item
+        self._knn_ids = None
+        self._knn_distances = None
+        self._id_map = None
+        self._lookup = None
+        self._delta = None
         self._meta_dict = dict()
+        # timings and counters, recording is off unless enabled
+        self._metrics = Metrics()
+        # guards result and filter caches, searches may run in many threads
+        self._cache_lock = Lock()
+        self._reset_caches()
+
+    @property
+    def metrics(self) -> Metrics:
+        """
+        Timings and counters of this knowledge base, e.g. kb.metrics.enable() to start recording them
+        """
+        return self._metrics
 
+    @measured('read_raw')
     def read_raw(self,
                  data_ttl_path: str,
-                 embeddings_dir_path: str,
+                 embeddings_dir_path: Union[str, np.ndarray, EmbeddingSource],
                  out_bk_path_dir: str,
                  entity_to_enrich: URIRef,
                  entity_predicate: URIRef,
-                 images_dir_path: str = ""):
+                 images_dir_path: str = "",
+                 search_k: int = Config.SEARCH_K,
+                 backend: str = Config.INDEX_BACKEND,
+                 embedding_dtype: str = Config.EMBEDDING_DTYPE,
+                 embedding_ids: Optional[Union[str, Sequence[int], np.ndarray]] = None,
+                 n_jobs: Optional[int] = None,
+                 build_options: Optional[BuildOptions] = None,
+                 image_names: Optional[Sequence[str]] = None,
+                 thumbnail_size: Optional[int] = None,
+                 on_disk_graph: bool = False):
         """
         A method to read raw directories and make a knowledge bae of it
         :param out_bk_path_dir: out path to save the knowledge base
-        :param data_ttl_path: a path to .ttl RDF file
+        :param data_ttl_path: a path to RDF file: .ttl, N-Triples .nt or N-Quads .nq, optionally gzip-compressed .gz.
+            N-Triples and N-Quads are parsed in chunks by n_jobs processes
         :param embeddings_dir_path: a path to embeddings directory. Each embedding should be
             a .npy numpy file containing a single array. A name of .npy file should match its
-            source entity
+            source entity. Alternatively a path to a stacked .npy matrix, a .npz file with
+            `vectors` and `ids` arrays, a 2-D numpy array / np.memmap, or an EmbeddingSource
         :param entity_to_enrich: an rdflib.URIRef pointing to entity class we would enrich with info
             about embeddings
         :param entity_predicate: an rdflib.URIRef pointing to entity id predicate we would enrich with info
             about embeddings
         :param images_dir_path:  optional, a path to images directory. A name of image file should match
             its source entity
+        :param search_k: default number of nodes to inspect during search for this knowledge base
+        :param backend: search backend to use, one of backends.BACKENDS keys
+        :param embedding_dtype: dtype of the embedding matrix stored in the archive, "float32" or "float16"
+        :param embedding_ids: entity ids of rows of a stacked embedding matrix, an array or a path to .npy file
+        :param n_jobs: number of threads used to read embedding files, defaults to Config.N_JOBS
+        :param build_options: search index build options: threads, on-disk build and auto tuning
+        :param image_names: optional, names of files of images_dir_path to store, defaults to all of them
+        :param thumbnail_size: optional, maximum width and height of downscaled copies of images to store
+            along with them
+        :param on_disk_graph: whether to keep the graph in a disk-backed store instead of memory,
+            for graphs larger than RAM. It also applies to the graph built for queries later
         :return:
         """
-        # read turtle file and make a graph
-        self._read_ttl_file(data_ttl_path=data_ttl_path)
+        self._tmp_dir = tempfile.mkdtemp(prefix='_tmp_kb_', dir=out_bk_path_dir)
+        self._on_disk_graph = on_disk_graph
+
+        # read RDF file and make a graph
+        with self._metrics.stage('read_raw.parse'):
+            self._read_ttl_file(data_ttl_path=data_ttl_path, n_jobs=n_jobs)
 
         # remember entity class and it's predicate to metadata dictionary
-        self._meta_dict['ENTITY'] = entity_to_enrich
-        self._meta_dict['ENTITY_PREDICATE'] = entity_predicate
+        # as strings, so that reading metadata does not import rdflib
+        self._meta_dict['ENTITY'] = str(entity_to_enrich)
+        self._meta_dict['ENTITY_PREDICATE'] = str(entity_predicate)
+        # remember default search precision along with other index parameters
+        self._meta_dict['SEARCH_K'] = search_k
+        self._meta_dict['BACKEND'] = get_backend(backend).NAME
+        self._meta_dict['INDEX_METRIC'] = Config.INDEX_METRIC
+        self._meta_dict['EMBEDDING_DTYPE'] = np.dtype(embedding_dtype).name
+        if thumbnail_size:
+            self._meta_dict['THUMBNAIL_SIZE'] = thumbnail_size
+
+        with self._metrics.stage('read_raw.list'):
+            # list and validate embeddings input, vectors are read later while building the index
+            embeddings = embeddings_dir_path
+            if not isinstance(embeddings, EmbeddingSource):
+                embeddings = EmbeddingSource(embeddings_dir_path, ids=embedding_ids, n_jobs=n_jobs)
+
+            # list images once, both to reify the graph and to copy them to the archive
+            img_names = None
+            if image_names is not None:
+                img_names = {int(Path(x).stem): x for x in image_names if Path(x).stem.isnumeric()}
+            elif images_dir_path:
+                img_names = self.list_external(images_dir_path)
 
         # enrich graph with metadata info about embeddings
-        self._graph = self.enrich(graph=self._graph,
-                                  emb_path=embeddings_dir_path,
-                                  has_id_name=entity_predicate,
-                                  entity_type=entity_to_enrich,
-                                  img_path=images_dir_path)
+        report = dict()
+        with self._metrics.stage('read_raw.enrich'):
+            self._graph = self.enrich(graph=self._graph,
+                                      emb_path=embeddings_dir_path if isinstance(embeddings_dir_path, str) else "",
+                                      has_id_name=entity_predicate,
+                                      entity_type=entity_to_enrich,
+                                      emb_names=embeddings.names,
+                                      img_names=img_names,
+                                      report=report)
+        for name, count in report.items():
+            self._metrics.count(f"enrich.{name}", count)
+
+        # precompute entity lookup tables so that queries do not need to scan the graph
+        with self._metrics.stage('read_raw.lookup'):
+            self._build_lookup()
 
         # read embeddings and build search index
-        self._build_annoy_index(embeddings_dir_path=embeddings_dir_path)
+        with self._metrics.stage('read_raw.index'):
+            self._build_index(embeddings=embeddings,
+                              embedding_dtype=embedding_dtype,
+                              build_options=build_options or BuildOptions())
 
         # write loaded info to disk
-        self._write_ttlplus(out_path=out_bk_path_dir,
-                            img_path=images_dir_path)
+        images = None
+        if img_names is not None:
+            images = [(x, partial(open, os.path.join(images_dir_path, x), 'rb')) for x in img_names.values()]
+        with self._metrics.stage('read_raw.write'):
+            self._write_ttlplus(out_path=out_bk_path_dir,
+                                img_path=images_dir_path,
+                                images=images)
 
-    def read_ttlplus(self, ttlplus_path: str):
+    @measured('read_ttlplus')
+    def read_ttlplus(self,
+                     ttlplus_path: str,
+                     verify: bool = False,
+                     on_disk_graph: bool = False,
+                     lazy: bool = False):
         """
         A method to read existing ttlplus file
         :param ttlplus_path: a path to .ttlplus file
+        :param verify: whether to verify checksums of all archive sections, otherwise only section
+            offsets and sizes are checked against the manifest
+        :param on_disk_graph: whether to build rdflib graph for queries in a disk-backed store instead of memory
+        :param lazy: whether to read only metadata, the id map and the search index. The graph and entity lookup
+            tables are read when they are first needed, e.g. on first access of KB.graph or of images,
+            so that similarity search starts fast
         """
+        start = time.perf_counter()
         log.info(f"reading file {ttlplus_path}")
-        self._archive = ZipFile(ttlplus_path, 'r')
-
-        # read graph
-        self._graph = self._archive.open('graph.p')
-        self._graph = pickle.load(self._graph)
+        with self._metrics.stage('read_ttlplus.verify'):
+            self._archive = ZipFile(ttlplus_path, 'r')
+            self._archive_path = ttlplus_path
+            verify_archive(self._archive, ttlplus_path, full=verify)
 
         # read metadict
-        self._meta_dict = self._archive.open('metadict.p')
-        self._meta_dict = pickle.load(self._meta_dict)
+        with self._metrics.stage('read_ttlplus.metadata'):
+            self._meta_dict = self._archive.open('metadict.p')
+            self._meta_dict = pickle.load(self._meta_dict)
+
+        # graph and entity lookup tables are read on first use. Compact graph is memory-mapped
+        # and turned into rdflib graph on demand, older archives have a pickled rdflib graph
+        self._drop_graph()
+        self._on_disk_graph = on_disk_graph
+        self._compact_graph = None
+        self._lookup = None
+        if not lazy:
+            with self._metrics.stage('read_ttlplus.graph'):
+                if self._get_compact_graph() is None:
+                    self._get_graph()
+            with self._metrics.stage('read_ttlplus.lookup'):
+                self._get_lookup()
+
+        # read index without extracting it next to the archive
+        index_start = time.perf_counter()
+        with self._metrics.stage('read_ttlplus.index'):
+            self._load_index()
+
+            # read id map, archives created before dense numbering used external ids as index ids
+            if Config.ID_MAP_FILE in self._archive.namelist():
+                with self._archive.open(Config.ID_MAP_FILE) as f:
+                    self._id_map = IdMap.load(f)
+            else:
+                log.info("archive has no id map, using entity ids as index ids")
+                self._id_map = IdMap(n_items=self._index.get_n_items())
+        log.info(f"read search index and id map of {len(self._id_map)} items "
+                 f"in {time.perf_counter() - index_start:.3f}s")
+
+        with self._metrics.stage('read_ttlplus.embeddings'):
+            # memory-map embedding matrix, older archives keep vectors only in the index
+            self._embeddings = None
+            if Config.EMBEDDINGS_FILE in self._archive.namelist():
+                self._embeddings = read_npy(self._archive, ttlplus_path, Config.EMBEDDINGS_FILE)
+
+            # memory-map neighbors table if the knowledge base was built with it
+            self._knn_ids, self._knn_distances = None, None
+            if Config.KNN_IDS_FILE in self._archive.namelist():
+                self._knn_ids = read_npy(self._archive, ttlplus_path, Config.KNN_IDS_FILE)
+                self._knn_distances = read_npy(self._archive, ttlplus_path, Config.KNN_DISTANCES_FILE)
+
+        # read changes made since the archive was built, if any
+        self._delta = None
+        delta_path = DeltaSegment.path_for(ttlplus_path)
+        if os.path.exists(delta_path):
+            with self._metrics.stage('read_ttlplus.delta'):
+                self._delta = DeltaSegment.load(delta_path, **self._delta_params())
+            log.info(f"read delta with {len(self._delta.ids)} added embeddings "
+                     f"and {len(self._delta.tombstones)} removed entities")
+        self._reset_caches()
+        log.info(f"read knowledge base{' lazily' if lazy else ''} in {time.perf_counter() - start:.3f}s")
+
+    @measured('update')
+    def update(self,
+               data_ttl_path: str = "",
+               embeddings_path: Optional[Union[str, np.ndarray]] = None,
+               embedding_ids: Optional[Union[str, Sequence[int], np.ndarray]] = None,
+               images_dir_path: str = "",
+               remove_ids: Optional[Union[Sequence[int], np.ndarray]] = None,
+               n_jobs: Optional[int] = None):
+        """
+        A method to add and remove entities without rebuilding the knowledge base.
+        Changes are saved to a delta archive next to .ttlplus file: added embeddings are searched
+        exactly and merged with the main index results, removed entities are hidden from results.
+        Use compact() to fold changes into a rebuilt archive
+        :param data_ttl_path: optional, a path to RDF file with triples of added entities,
+            in any format read_raw accepts
+        :param embeddings_path: optional, embeddings of added or changed entities in any form read_raw accepts
+        :param embedding_ids: entity ids of rows of a stacked embedding matrix
+        :param images_dir_path: optional, a path to images directory of added entities
+        :param remove_ids: optional, ids of entities to remove. Removal is applied before additions,
+            so an entity may be removed and added back along with its triples in one call.
+            Embeddings and images of entities which neither exist nor are added raise ValueError
+        :param n_jobs: number of threads used to read embedding files
+        """
+        if self._archive_path is None:
+            raise ValueError("knowledge base should be written or read from .ttlplus file before updating it")
+        if self._delta is None:
+            self._delta = DeltaSegment(**self._delta_params())
+        entity_predicate = self._entity_term('ENTITY_PREDICATE')
+
+        # list and validate embeddings input
+        embeddings = None
+        if embeddings_path is not None:
+            embeddings = EmbeddingSource(embeddings_path, ids=embedding_ids, n_jobs=n_jobs)
+            if embeddings.vector_length != self._meta_dict['VECTOR_LENGTH']:
+                raise ValueError(f"embeddings should have length {self._meta_dict['VECTOR_LENGTH']}, "
+                                 f"got {embeddings.vector_length}")
+
+        # read added triples and enrich them the same way read_raw does
+        from .ingest import parse_graph
+        rdflib = import_module('rdflib')
+        graph = parse_graph(data_ttl_path) if data_ttl_path else rdflib.Graph()
+        emb_names = embeddings.names if embeddings is not None else dict()
+        img_names = self.list_external(images_dir_path) if images_dir_path else dict()
+        graph = self.enrich(graph=graph,
+                            emb_path="",
+                            has_id_name=entity_predicate,
+                            entity_type=self._entity_term('ENTITY'),
+                            emb_names=emb_names,
+                            img_names=img_names)
+
+        # embeddings and images need an entity to belong to, either among added triples or among entities
+        # which are kept, otherwise they would be found by search without an entity behind them
+        removed = set() if remove_ids is None else set(np.asarray(remove_ids, dtype=np.int64).ravel().tolist())
+        added = EntityLookup.from_graph(graph, entity_predicate)
+
+        def kept(entity_id: int) -> bool:
+            if entity_id in removed:
+                return False
+            if self._delta.lookup.exists(entity_id):
+                return True
+            return not self._delta.is_removed([entity_id])[0] and self._get_lookup().exists(entity_id)
+
+        orphans = [x for x in sorted(set(emb_names) | set(img_names)) if not added.exists(x) and not kept(x)]
+        if orphans:
+            raise ValueError(f"{len(orphans)} embeddings or images belong to entities which do not exist or are "
+                             f"removed, their triples should be added too. First of them: {orphans[:10]}")
 
-        # read index, we will need temp folder for that
-        self._tmp_dir = os.path.join(os.path.dirname(ttlplus_path), f'_tmp_kb_{str(randint(100, 999))}')
-        if os.path.exists(self._tmp_dir):
-            shutil.rmtree(self._tmp_dir)
-        os.mkdir(self._tmp_dir)
-        log.info(f"creating tmp dir {self._tmp_dir}")
-        self._archive.extract('kb_index.ann', path=self._tmp_dir)
-        self._index = AnnoyIndex(self._meta_dict['VECTOR_LENGTH'], Config.INDEX_METRIC)
-        self._index.load(os.path.join(self._tmp_dir, 'kb_index.ann'))
+        # tombstone removed entities
+        removed_subjects = []
+        if remove_ids is not None:
+            remove_ids = np.unique(np.asarray(remove_ids, dtype=np.int64))
+            delta_subjects = dict()
+            for entity_id in remove_ids.tolist():
+                subject = self._delta.lookup.subject(entity_id)
+                if subject is not None:
+                    delta_subjects[entity_id] = subject
+                removed_subjects += [x for x in (subject, self._get_lookup().subject(entity_id)) if x is not None]
+            self._delta.remove(remove_ids, delta_subjects)
+            log.info(f"removed {len(remove_ids)} entities")
 
-    def _write_ttlplus(self, out_path: str, img_path: str = ""):
+        # entities which already exist get new embeddings and images without repeating their triples
+        for entity_id in set(emb_names) | set(img_names):
+            if added.exists(entity_id):
+                continue
+            subject = self._delta.lookup.subject(entity_id)
+            if subject is None and not self._delta.is_removed([entity_id])[0]:
+                subject = self._get_lookup().subject(entity_id)
+            if subject is None:
+                continue
+            graph.add((subject, entity_predicate, rdflib.Literal(entity_id)))
+            if entity_id in emb_names:
+                graph.add((subject, Config.HAS_EMBEDDING, rdflib.Literal(emb_names[entity_id])))
+            if entity_id in img_names:
+                graph.add((subject, Config.HAS_IMAGE, rdflib.Literal(img_names[entity_id])))
+        self._delta.add_graph(graph)
+
+        if embeddings is not None:
+            self._delta.add_vectors(embeddings.ids, np.concatenate([x for _, x in embeddings.chunks()]))
+        for name in img_names.values():
+            self._delta.add_image(name, os.path.join(images_dir_path, name))
+
+        # keep rdflib graph in sync if it was already built
+        if self._graph is not None:
+            for subject in removed_subjects:
+                self._graph.remove((subject, None, None))
+            self._graph += graph
+
+        self._delta.save(DeltaSegment.path_for(self._archive_path))
+        self._reset_caches()
+        log.info(f"knowledge base delta has {len(self._delta.ids)} added embeddings "
+                 f"and {len(self._delta.tombstones)} removed entities")
+
+    @measured('compact')
+    def compact(self, out_bk_path_dir: str = "", n_jobs: Optional[int] = None):
+        """
+        A method to fold changes made with update() into a rebuilt search index and archive
+        :param out_bk_path_dir: optional, out path to save the knowledge base, defaults to the directory
+            of the current .ttlplus file which is then replaced
+        :param n_jobs: number of threads used to build the search index
+        """
+        if self._delta is None or not len(self._delta):
+            log.info("knowledge base has no changes to compact")
+            return
+        out_bk_path_dir = out_bk_path_dir or os.path.dirname(os.path.abspath(self._archive_path))
+        delta = self._delta
+
+        # graph with changes applied
+        self._get_graph()
+
+        # embeddings which were neither removed nor replaced, followed by added ones
+        main_ids = self._id_map.external_ids
+        keep = np.flatnonzero(~np.isin(main_ids, delta.shadowed))
+        if self._embeddings is not None:
+            main_vectors = np.asarray(self._embeddings[keep], dtype=np.float32)
+        else:
+            main_vectors = np.array([self._index.get_item_vector(int(x)) for x in keep], dtype=np.float32)
+        main_vectors = main_vectors.reshape(len(keep), self._meta_dict['VECTOR_LENGTH'])
+        embeddings = EmbeddingSource(np.concatenate([main_vectors, delta.vectors]),
+                                     ids=np.concatenate([main_ids[keep], delta.ids]))
+
+        # images of removed entities are dropped, images in delta replace ones with the same name
+        removed_images = {self._get_lookup().image(x) for x in delta.tombstones.tolist()}
+        delta_images = delta.image_names()
+        images = [(x[len(Config.IMAGES_FOLDER) + 1:], partial(self._archive.open, x))
+                  for x in self._archive.namelist() if x.startswith(f"{Config.IMAGES_FOLDER}/")]
+        images = [(name, open_image) for name, open_image in images
+                  if name not in removed_images and name not in delta_images]
+        images += [(name, partial(delta.open_image, name)) for name in sorted(delta_images)]
+
+        log.info(f"compacting knowledge base with {len(embeddings)} embeddings")
+        self._build_lookup()
+        self._tmp_dir = tempfile.mkdtemp(prefix='_tmp_kb_', dir=out_bk_path_dir)
+        self._build_index(embeddings=embeddings,
+                          embedding_dtype=self._meta_dict.get('EMBEDDING_DTYPE', Config.EMBEDDING_DTYPE),
+                          build_options=BuildOptions(n_trees=self._meta_dict.get('N_TREES', Config.N_TREES),
+                                                     n_jobs=Config.N_JOBS if n_jobs is None else n_jobs,
+                                                     knn_k=self._meta_dict.get('KNN_K', 0)))
+        self._write_ttlplus(out_path=out_bk_path_dir, images=images)
+        delta.close()
+
+    def _write_ttlplus(self,
+                       out_path: str,
+                       img_path: str = "",
+                       images: Optional[List[Tuple[str, Callable[[], BinaryIO]]]] = None):
         """
         A method to write kb files to disk
         :param out_path: a path where to write .ttlplus file
         :param img_path: a path where images located
+        :param images: optional, (image name, a callable opening image contents) tuples to use instead of img_path
         :return:
         """
-        # make temp directory to write annoy file
-        self._tmp_dir = os.path.join(out_path, f'_tmp_kb_{str(randint(100, 999))}')
-        if os.path.exists(self._tmp_dir):
-            shutil.rmtree(self._tmp_dir)
-        os.mkdir(self._tmp_dir)
-        log.info(f"creating tmp directory: {self._tmp_dir}")
+        # make unique temp directory to write index file
+        if self._tmp_dir is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix='_tmp_kb_', dir=out_path)
+            log.info(f"creating tmp directory: {self._tmp_dir}")
 
         # save index to folder
-        self._index.save(os.path.join(self._tmp_dir, 'kb_index.ann'))
+        index_path = os.path.join(self._tmp_dir, self._index.FILE_NAME)
+        self._index.save(index_path)
+        # content hash lets readers share one cached copy of the index
+        outdated_digest = self._meta_dict.get('INDEX_SHA256')
+        self._meta_dict['INDEX_SHA256'] = file_sha256(index_path)
         log.info(f"saving index to tmp directory")
 
-        # serialize graph
-        with open(os.path.join(self._tmp_dir, 'graph.p'), 'wb') as f:
-            pickle.dump(self._graph, f)
-        log.info(f"saving serialized graph to tmp directory")
+        # dictionary-encode graph
+        from .compact_graph import CompactGraph
+        from .graph_store import SQLiteStore, key_triples
+        if isinstance(self._graph.store, SQLiteStore):
+            # disk-backed graphs are encoded by SQLite, so that encoding does not need the graph in RAM
+            compact_graph = self._graph.store.to_compact_graph(self._tmp_dir)
+        else:
+            compact_graph = CompactGraph.from_keys(key_triples(self._graph))
+        log.info(f"encoded graph with {len(compact_graph)} triples")
+
+        # serialize entity lookup tables, np.savez needs a seekable file so it is buffered
+        buffer_lookup = BytesIO()
+        self._get_lookup().save(buffer_lookup)
 
-        # serialize metadata dictionary
-        buffer_meta_dict = BytesIO()
-        pickle.dump(self._meta_dict, buffer_meta_dict)
+        if images is None and img_path:
+            images = [(x, partial(open, os.path.join(img_path, x), 'rb')) for x in os.listdir(img_path)]
 
-        # create archive
+        # create archive. It is written next to the target and moved in place when complete,
+        # so that an archive being read, e.g. while compacting, is never truncated
         log.info(f"saving knowledge base contents to the archive five")
-        with ZipFile(os.path.join(out_path, 'kb.ttlplus'), 'w') as zip_file:
-            # add index, metadict and graph to it
-            zip_file.write(os.path.join(self._tmp_dir, 'graph.p'), arcname='graph.p')
-            zip_file.write(os.path.join(self._tmp_dir, 'kb_index.ann'), arcname='kb_index.ann')
-            zip_file.writestr('metadict.p', buffer_meta_dict.getvalue())
+        archive_path = os.path.join(out_path, 'kb.ttlplus')
+        tmp_archive_path = os.path.join(self._tmp_dir, 'kb.ttlplus')
+        with ZipFile(tmp_archive_path, 'w') as zip_file:
+            # add index, metadict and graph to it, sections are streamed into the archive
+            compact_graph.save(zip_file)
+            # index is stored uncompressed, so it can be memory-mapped or copied to cache as is
+            zip_file.write(index_path, arcname=self._index.FILE_NAME, compress_type=ZIP_STORED)
+            with open_member(zip_file, 'metadict.p') as f:
+                pickle.dump(self._meta_dict, f)
+            with open_member(zip_file, Config.ID_MAP_FILE) as f:
+                self._id_map.save(f)
+            zip_file.writestr(Config.LOOKUP_FILE, buffer_lookup.getvalue())
+            write_npy(zip_file, Config.EMBEDDINGS_FILE, self._embeddings)
+            if self._knn_ids is not None:
+                write_npy(zip_file, Config.KNN_IDS_FILE, self._knn_ids)
+                write_npy(zip_file, Config.KNN_DISTANCES_FILE, self._knn_distances)
             # add images
-            if img_path:
+            if images:
                 log.info(f"adding provided images to the knowledge base")
                 log.info(f"please stand by, this may take a while")
-                for image in os.listdir(img_path):
-                    zip_file.write(os.path.join(img_path, image),
-                                   arcname=os.path.join(Config.IMAGES_FOLDER, image))
+                # images are read and downscaled on a thread pool while the archive is written
+                for name, contents, thumbnail in self._read_images(images):
+                    with open_member(zip_file, f"{Config.IMAGES_FOLDER}/{name}") as f:
+                        f.write(contents)
+                    if thumbnail is not None:
+                        with open_member(zip_file, f"{Config.THUMBNAILS_FOLDER}/{name}", ZIP_STORED) as f:
+                            f.write(thumbnail)
+            write_manifest(zip_file, tmp_archive_path)
+        # arrays of the compact graph may be memory-mapped from temp files which are removed below
+        del compact_graph
+        replaced = self._archive_path is not None and \
+            os.path.abspath(self._archive_path) == os.path.abspath(archive_path)
+        os.replace(tmp_archive_path, archive_path)
         log.info(f"permanent knowledge base archive file successfully created")
+        if replaced and outdated_digest and outdated_digest != self._meta_dict['INDEX_SHA256']:
+            # nobody reads the replaced index from this archive anymore
+            remove_cached(outdated_digest)
 
         # set archive in case if we need to access images
-        self._archive = ZipFile(os.path.join(out_path, 'kb.ttlplus'), 'r')
+        if self._archive:
+            self._archive.close()
+        self._archive_path = archive_path
+        self._archive = ZipFile(self._archive_path, 'r')
+        # and swap in-memory embeddings for the memory-mapped ones
+        self._embeddings = read_npy(self._archive, self._archive_path, Config.EMBEDDINGS_FILE)
+        if self._knn_ids is not None:
+            self._knn_ids = read_npy(self._archive, self._archive_path, Config.KNN_IDS_FILE)
+            self._knn_distances = read_npy(self._archive, self._archive_path, Config.KNN_DISTANCES_FILE)
+        self._compact_graph = CompactGraph.load(self._archive, self._archive_path)
+        if isinstance(self._graph.store, SQLiteStore):
+            # the store is in the temp directory, the graph is built from the compact graph again when needed
+            self._drop_graph()
+
+        # a freshly written archive has no changes yet
+        self._delta = None
+        if os.path.exists(DeltaSegment.path_for(self._archive_path)):
+            log.info(f"removing outdated delta of {self._archive_path}")
+            os.remove(DeltaSegment.path_for(self._archive_path))
+        self._reset_caches()
 
-    def _read_ttl_file(self, data_ttl_path: str):
+        # the index is reloaded from its file in the temp directory rather than from the shared cache,
+        # so that rebuilds do not leave copies of outdated indexes behind. Other temp files are not needed anymore
+        self._index.unload()
+        self._index.load(index_path)
+        self._remove_index_dir()
+        self._index_dir, self._tmp_dir = self._tmp_dir, None
+        for name in os.listdir(self._index_dir):
+            path = os.path.join(self._index_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif name != self._index.FILE_NAME:
+                os.remove(path)
+
+    def _read_ttl_file(self, data_ttl_path: str, n_jobs: Optional[int] = None):
+        """
+        A method to read RDF data. Line-based formats are streamed into the graph chunk by chunk
+        :param data_ttl_path: a path to RDF file
+        :param n_jobs: number of processes parsing N-Triples or N-Quads
         """
-        A method to read RDF data
-        :param data_ttl_path: a path to ttl file
+        log.info(f"reading RDF file: {data_ttl_path}")
+        from .graph_store import add_key_triples
+        from .ingest import LINE_FORMATS, parse_graph, rdf_format, read_key_chunks
+        if not self._on_disk_graph and rdf_format(data_ttl_path) not in LINE_FORMATS:
+            self._graph = parse_graph(data_ttl_path)
+        else:
+            self._graph = self._new_graph(self._tmp_dir)
+            for triples in read_key_chunks(data_ttl_path, n_jobs=n_jobs):
+                add_key_triples(self._graph, triples)
+        log.info(f"done reading RDF file, {len(self._graph)} triples")
+
+    def _new_graph(self, directory: str) -> Graph:
         """
-        log.info(f"reading ttl file: {data_ttl_path}")
-        self._graph = Graph()
-        self._graph.parse(data_ttl_path, format="ttl")
-        log.info("done reading ttl file")
+        :param directory: a directory to keep a disk-backed store in
+        :return: an empty rdflib graph, disk-backed if the knowledge base keeps its graph on disk
+        """
+        if self._on_disk_graph:
+            from .graph_store import SQLiteStore
+            return SQLiteStore.graph(os.path.join(directory, Config.GRAPH_STORE_FILE))
+        return import_module('rdflib').Graph()
+
+    def _drop_graph(self):
+        """
+        A method to release rdflib graph along with its disk-backed store if any
+        """
+        if self._graph is not None:
+            # closing an in-memory graph does nothing, closing a disk-backed one releases its file
+            self._graph.close()
+        self._graph = None
+        if self._graph_dir is not None:
+            shutil.rmtree(self._graph_dir, ignore_errors=True)
+            self._graph_dir = None
 
-    def _build_annoy_index(self,
-                           embeddings_dir_path: str):
+    def _get_graph(self) -> Graph:
         """
-        A method to read embeddings and build search index
-        :param embeddings_dir_path: a path to directory with .npy vectors
+        A method to get rdflib graph, building it from the compact graph on first access
         """
-        log.info(f"reading embedding directory: {embeddings_dir_path}")
-        # read directory
-        files = [x for x in os.listdir(embeddings_dir_path) if Path(x).stem.isnumeric()]
-        names = [int(Path(x).stem) for x in os.listdir(embeddings_dir_path) if Path(x).stem.isnumeric()]
-        # read one vector to determine the required size for index
-        sample_vector = np.load(os.path.join(embeddings_dir_path, files[0]))
+        if self._graph is not None:
+            return self._graph
 
+        start = time.perf_counter()
+        compact_graph = self._get_compact_graph()
+        if compact_graph is not None:
+            log.info(f"building rdflib graph from {len(compact_graph)} compact triples")
+            if self._on_disk_graph:
+                from .graph_store import add_key_triples
+                self._graph_dir = tempfile.mkdtemp(prefix='_tmp_kb_graph_',
+                                                   dir=os.path.dirname(os.path.abspath(self._archive_path)))
+                self._graph = self._new_graph(self._graph_dir)
+                add_key_triples(self._graph, compact_graph.key_triples())
+            else:
+                self._graph = compact_graph.to_graph()
+        elif self._archive is not None and 'graph.p' in self._archive.namelist():
+            # older archives have a pickled rdflib graph
+            with self._archive.open('graph.p') as f:
+                self._graph = pickle.load(f)
+        else:
+            return None
+        if self._delta:
+            # apply changes made since the archive was built
+            for entity_id in self._delta.tombstones.tolist():
+                subject = self._get_lookup().subject(entity_id)
+                if subject is not None:
+                    self._graph.remove((subject, None, None))
+            self._graph += self._delta.graph
+        self._metrics.add_stage('load.graph', time.perf_counter() - start)
+        log.info(f"read rdflib graph with {len(self._graph)} triples in {time.perf_counter() - start:.3f}s")
+        return self._graph
+
+    def _get_compact_graph(self) -> Optional[CompactGraph]:
+        """
+        A method to get compact graph, memory-mapping it from the archive on first access
+        :return: compact graph or None if the archive has none
+        """
+        if self._compact_graph is None and self._archive is not None:
+            from .compact_graph import CompactGraph
+            if CompactGraph.in_archive(self._archive):
+                start = time.perf_counter()
+                with self._metrics.stage('load.compact_graph'):
+                    self._compact_graph = CompactGraph.load(self._archive, self._archive_path)
+                log.info(f"read compact graph with {len(self._compact_graph)} triples "
+                         f"in {time.perf_counter() - start:.3f}s")
+        return self._compact_graph
+
+    def _get_lookup(self) -> EntityLookup:
+        """
+        A method to get entity lookup tables, reading them from the archive on first access
+        """
+        if self._lookup is None and self._archive is not None:
+            start = time.perf_counter()
+            with self._metrics.stage('load.lookup'):
+                # older archives do not have lookup tables so build them from graph
+                if Config.LOOKUP_FILE in self._archive.namelist():
+                    with self._archive.open(Config.LOOKUP_FILE) as f:
+                        self._lookup = EntityLookup.load(f)
+                else:
+                    self._build_lookup()
+            log.info(f"read entity lookup tables in {time.perf_counter() - start:.3f}s")
+        return self._lookup
+
+    def _graph_view(self):
+        """
+        A method to get a graph for read-only lookups without building rdflib graph if possible
+        :return: rdflib graph if it is already in memory, compact graph otherwise
+        """
+        if self._graph is not None or self._delta or self._get_compact_graph() is None:
+            return self._get_graph()
+        return self._compact_graph
+
+    def _build_lookup(self):
+        """
+        A method to build entity lookup tables from the graph
+        """
+        log.info("building entity lookup tables")
+        self._lookup = EntityLookup.from_graph(graph=self._graph_view(),
+                                               entity_predicate=self._entity_term('ENTITY_PREDICATE'))
+        log.info(f"entity lookup tables built for {len(self._lookup)} entities")
+
+    def _reset_caches(self):
+        """
+        A method to drop everything computed from the search index and the graph, called whenever they change
+        """
+        # decoded images
+        self._image_cache = ImageCache()
+        with self._cache_lock:
+            # compiled search filters
+            self._filter_cache = OrderedDict()
+            # (entity id, k_nearest, search_k) -> (entity ids, distances) of select_similar results
+            self._result_cache = OrderedDict()
+            self._result_cache_hits = 0
+            self._result_cache_misses = 0
+            self._filter_cache_hits = 0
+            self._filter_cache_misses = 0
+
+    def _entity_term(self, key: str) -> URIRef:
+        """
+        :param key: ENTITY or ENTITY_PREDICATE
+        :return: rdflib term of the entity class or of its id predicate. Metadata keeps them as strings,
+            archives written before hold rdflib terms
+        """
+        return import_module('rdflib').URIRef(self._meta_dict[key])
+
+    def _delta_params(self) -> dict:
+        return dict(vector_length=self._meta_dict['VECTOR_LENGTH'],
+                    entity_predicate=self._entity_term('ENTITY_PREDICATE'),
+                    metric=self._meta_dict.get('INDEX_METRIC', Config.INDEX_METRIC))
+
+    def _read_images(self, images: List[Tuple[str, Callable[[], BinaryIO]]]) \
+            -> Iterator[Tuple[str, bytes, Optional[bytes]]]:
+        """
+        A method to read and downscale images on a thread pool, a bounded number of images is read ahead
+        :param images: (image name, a callable opening image contents) tuples
+        :return: an iterator over (image name, image contents, thumbnail contents or None) tuples
+            in the order of images
+        """
+        thumbnail_size = self._meta_dict.get('THUMBNAIL_SIZE')
+
+        def read(image: Tuple[str, Callable[[], BinaryIO]]) -> Tuple[str, bytes, Optional[bytes]]:
+            name, open_image = image
+            with open_image() as f:
+                contents = f.read()
+            return name, contents, make_thumbnail(contents, thumbnail_size) if thumbnail_size else None
+
+        return imap_prefetch(read, images)
+
+    def _read_image(self, entity_id: int, thumbnail: bool = False) -> Optional[bytes]:
+        """
+        A method to read image file contents of an entity, images added with update() take precedence
+        :param entity_id: entity id
+        :param thumbnail: whether to read a downscaled copy, it is made on the fly if the archive has none
+        :return: contents of the image file or None if the entity has no image
+        """
+        thumbnail_size = self._meta_dict.get('THUMBNAIL_SIZE', Config.THUMBNAIL_SIZE)
+        if self._delta is not None:
+            image = self._delta.lookup.image(entity_id)
+            file = self._delta.open_image(image) if image else None
+            if file is not None:
+                with file:
+                    data = file.read()
+                return make_thumbnail(data, thumbnail_size) if thumbnail else data
+            if self._delta.is_removed([entity_id])[0]:
+                return None
+
+        image = self._get_lookup().image(entity_id)
+        if not image:
+            return None
+        if thumbnail:
+            if f"{Config.THUMBNAILS_FOLDER}/{image}" in self._archive.NameToInfo:
+                return self._archive.read(f"{Config.THUMBNAILS_FOLDER}/{image}")
+            return make_thumbnail(self._archive.read(f"{Config.IMAGES_FOLDER}/{image}"), thumbnail_size)
+        return self._archive.read(f"{Config.IMAGES_FOLDER}/{image}")
+
+    def _make_index(self) -> SearchBackend:
+        """
+        A method to create an empty search index as recorded in metadata.
+        Archives created before backends were pluggable always use annoy
+        """
+        backend = get_backend(self._meta_dict.get('BACKEND', Config.INDEX_BACKEND))
+        return backend(self._meta_dict['VECTOR_LENGTH'], self._meta_dict.get('INDEX_METRIC', Config.INDEX_METRIC))
+
+    def _load_index(self):
+        """
+        A method to load search index from the archive. Annoy needs a file path, so its index
+        is shared through a content-addressed cache, brute force index is memory-mapped from the archive
+        """
+        self._index = self._make_index()
+        self._index.load_from_archive(self._archive, self._archive_path, self._meta_dict.get('INDEX_SHA256'))
+        self._remove_index_dir()
+
+    def _remove_index_dir(self):
+        """
+        A method to remove the temp directory of an index built by this instance once the index is replaced
+        """
+        if self._index_dir is not None:
+            shutil.rmtree(self._index_dir, ignore_errors=True)
+            self._index_dir = None
+
+    def _build_index(self,
+                     embeddings: EmbeddingSource,
+                     embedding_dtype: str = Config.EMBEDDING_DTYPE,
+                     build_options: BuildOptions = BuildOptions()):
+        """
+        A method to stream embeddings into search index and embedding matrix
+        :param embeddings: embeddings source
+        :param embedding_dtype: dtype of the embedding matrix
+        :param build_options: search index build options
+        """
         # we need to remember this permanently in order to reconstruct index later
-        self._meta_dict['VECTOR_LENGTH'] = len(sample_vector)
+        self._meta_dict['VECTOR_LENGTH'] = embeddings.vector_length
         # and add this info to the graph
-        self._graph.add((Config.EMBEDDING, Config.HAS_LENGTH, Literal(len(sample_vector))))
+        length = import_module('rdflib').Literal(embeddings.vector_length)
+        self._graph.add((Config.EMBEDDING, Config.HAS_LENGTH, length))
 
-        self._index = AnnoyIndex(self._meta_dict['VECTOR_LENGTH'], Config.INDEX_METRIC)
+        self._index = self._make_index()
+        # annoy allocates storage for every item id up to the largest one,
+        # so vectors are numbered densely and entity ids are kept in a separate map
+        self._id_map = IdMap(embeddings.ids)
+        # embedding matrix rows are aligned with internal ids
+        shape = (len(embeddings), embeddings.vector_length)
+        if build_options.on_disk:
+            # both index and embedding matrix live in files of temp directory instead of memory
+            log.info(f"building search index on disk in {self._tmp_dir}")
+            self._index.on_disk_build(os.path.join(self._tmp_dir, self._index.FILE_NAME))
+            self._embeddings = np.lib.format.open_memmap(os.path.join(self._tmp_dir, Config.EMBEDDINGS_FILE),
+                                                         mode='w+', dtype=embedding_dtype, shape=shape)
+        else:
+            self._embeddings = np.empty(shape, dtype=embedding_dtype)
 
-        log.info(f"adding vectors to search index")
-        for file, name in zip(files, names):
-            # filename without extension. Will be a key for searching
-            vector = np.load(os.path.join(embeddings_dir_path, file))
-            # add vector along with its key
-            self._index.add_item(name, vector)
+        log.info(f"adding {len(embeddings)} vectors to search index")
+        for start, vectors in embeddings.chunks():
+            for internal_id, vector in enumerate(vectors, start=start):
+                # add vector along with its dense key
+                self._index.add_item(internal_id, vector)
+            self._embeddings[start:start + len(vectors)] = vectors
 
-        self._index.build(Config.N_TREES)
+        if build_options.auto_tune and not isinstance(self._index, BruteForceBackend):
+            log.info(f"tuning search index for recall@{build_options.recall_k} of {build_options.target_recall}")
+            tuned = auto_tune(self._index, self._embeddings, build_options)
+            # tuned search_k becomes the default of this knowledge base
+            self._meta_dict['N_TREES'] = tuned['n_trees']
+            self._meta_dict['SEARCH_K'] = tuned['search_k']
+            self._meta_dict['RECALL_K'] = build_options.recall_k
+            self._meta_dict['MEASURED_RECALL'] = tuned['recall']
+            self._meta_dict['MEASURED_LATENCY_MS'] = tuned['latency_ms']
+        else:
+            n_trees = build_options.n_trees or Config.N_TREES
+            self._index.build(n_trees, n_jobs=build_options.n_jobs)
+            self._meta_dict['N_TREES'] = n_trees
         log.info("search index built successfully")
 
+        self._knn_ids, self._knn_distances = None, None
+        self._meta_dict.pop('KNN_K', None)
+        if build_options.knn_k > 0:
+            self._build_knn_table(build_options.knn_k, build_options.n_jobs, build_options.on_disk)
+
+    def _build_knn_table(self, k: int, n_jobs: int = Config.N_JOBS, on_disk: bool = False):
+        """
+        A method to precompute nearest neighbors of every item, so that similarity queries of
+        known entities become a row lookup
+        :param k: number of neighbors per item
+        :param n_jobs: number of threads
+        :param on_disk: whether to write the table to files of temp directory instead of memory
+        """
+        n_items = self._index.get_n_items()
+        k = min(k, n_items)
+        search_k = self._meta_dict.get('SEARCH_K', Config.SEARCH_K)
+        if on_disk:
+            self._knn_ids = np.lib.format.open_memmap(os.path.join(self._tmp_dir, Config.KNN_IDS_FILE),
+                                                      mode='w+', dtype=np.int32, shape=(n_items, k))
+            self._knn_distances = np.lib.format.open_memmap(os.path.join(self._tmp_dir, Config.KNN_DISTANCES_FILE),
+                                                            mode='w+', dtype=np.float32, shape=(n_items, k))
+        else:
+            self._knn_ids = np.empty((n_items, k), dtype=np.int32)
+            self._knn_distances = np.empty((n_items, k), dtype=np.float32)
+
+        log.info(f"computing {k} nearest neighbors of {n_items} items")
+        for start in range(0, n_items, Config.KNN_BLOCK):
+            items = np.arange(start, min(start + Config.KNN_BLOCK, n_items))
+            ids, distances = self._index.get_nns_by_items(items, k, search_k=search_k, n_jobs=n_jobs)
+            self._knn_ids[items] = ids
+            self._knn_distances[items] = distances
+        # the table answers queries made with the same search_k and up to k neighbors
+        self._meta_dict['KNN_K'] = k
+        self._meta_dict['KNN_SEARCH_K'] = search_k
+        log.info("nearest neighbors table built successfully")
+
     def __del__(self):
         # do need this step to overcome a glitch
         # will get permission error unless there are no links to index
         # this is probably due to the fact that .ann file is mmapped into memory
         # as a part of Annoy optimisation
+        # index files in the shared cache are left in place for other processes,
+        # temp directory only remains if writing the archive failed
         self._index = None
+        self._embeddings = None
+        self._knn_ids = None
+        self._knn_distances = None
+        if self._delta is not None:
+            self._delta.close()
+        self._drop_graph()
+        self._remove_index_dir()
         if self._tmp_dir:
             if os.path.exists(self._tmp_dir):
                 log.info(f"performing cleanup, removing {self._tmp_dir}")
@@ -0,0 +1,194 @@
+from __future__ import annotations
+import numpy as np
+from .config import Config
+from .imports import import_module
+from typing import Dict, Iterable, Optional, BinaryIO, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import rdflib
+    from rdflib import URIRef
+
+
+class PackedStrings:
+    """
+    An immutable array of strings stored as a single utf-8 buffer plus offsets.
+    Takes a fraction of the memory of a list of python strings or a numpy unicode array
+    """
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        """
+        :param data: uint8 array with concatenated utf-8 encoded strings
+        :param offsets: int64 array of len(strings) + 1 offsets into data
+        """
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, strings: Iterable[str]) -> 'PackedStrings':
+        """
+        :param strings: strings to pack
+        :return: PackedStrings instance
+        """
+        encoded = [x.encode('utf-8') for x in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(data, offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class EntityLookup:
+    """
+    Lookup tables over knowledge base entities keyed by entity id: subject URI,
+    whether an entity has an embedding and the name of its image.
+    Lets the query path avoid scanning graph triples
+    """
+    def __init__(self,
+                 entity_ids: np.ndarray,
+                 subjects: PackedStrings,
+                 has_embedding: np.ndarray,
+                 images: PackedStrings):
+        """
+        :param entity_ids: sorted int64 array of entity ids
+        :param subjects: subject URIs aligned with entity_ids
+        :param has_embedding: bitset (np.packbits) aligned with entity_ids
+        :param images: image names aligned with entity_ids, empty string if an entity has no image
+        """
+        self._entity_ids = entity_ids
+        self._subjects = subjects
+        self._has_embedding = has_embedding
+        self._images = images
+        # reverse subject lookup is only needed by URIRef based queries, so it is built on demand
+        self._subject_to_id = None
+
+    def __len__(self) -> int:
+        return len(self._entity_ids)
+
+    @property
+    def entity_ids(self) -> np.ndarray:
+        return self._entity_ids
+
+    @classmethod
+    def from_graph(cls,
+                   graph: rdflib.Graph,
+                   entity_predicate: URIRef) -> 'EntityLookup':
+        """
+        A method to build lookup tables from a reified graph in a single pass per predicate
+        :param graph: reified graph
+        :param entity_predicate: a predicate which leads to entity id
+        :return: EntityLookup instance
+        """
+        entities = dict()
+        for s, o in graph.subject_objects(entity_predicate):
+            value = getattr(o, 'value', None)
+            if isinstance(value, int) and not isinstance(value, bool):
+                entities.setdefault(value, s)
+
+        with_embedding = set(graph.subjects(Config.HAS_EMBEDDING, None))
+        images = {s: str(o) for s, o in graph.subject_objects(Config.HAS_IMAGE)}
+
+        entity_ids = np.array(sorted(entities), dtype=np.int64)
+        subjects = [entities[x] for x in entity_ids.tolist()]
+        has_embedding = np.packbits(np.array([s in with_embedding for s in subjects], dtype=bool))
+        return cls(entity_ids=entity_ids,
+                   subjects=PackedStrings.from_list(str(s) for s in subjects),
+                   has_embedding=has_embedding,
+                   images=PackedStrings.from_list(images.get(s, '') for s in subjects))
+
+    def position(self, entity_id: int) -> int:
+        """
+        :param entity_id: entity id
+        :return: position of entity in lookup tables or -1 if entity does not exist
+        """
+        return int(self.positions([entity_id])[0])
+
+    def positions(self, entity_ids: Iterable[int]) -> np.ndarray:
+        """
+        :param entity_ids: entity ids
+        :return: an int64 array of positions in lookup tables, -1 for entities which do not exist
+        """
+        entity_ids = np.asarray(entity_ids, dtype=np.int64).ravel()
+        if not len(self._entity_ids):
+            return np.full(len(entity_ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._entity_ids, entity_ids), len(self._entity_ids) - 1)
+        return np.where(self._entity_ids[positions] == entity_ids, positions, -1)
+
+    def has_embedding_at(self, positions: np.ndarray) -> np.ndarray:
+        """
+        :param positions: positions in lookup tables, negative values are treated as missing entities
+        :return: a bool array telling whether entities at given positions have embeddings
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        safe = np.maximum(positions, 0)
+        bits = (self._has_embedding[safe >> 3] >> (7 - (safe & 7))) & 1
+        return (bits == 1) & (positions >= 0)
+
+    def exists(self, entity_id: int) -> bool:
+        return self.position(entity_id) >= 0
+
+    def has_embedding(self, entity_id: int) -> bool:
+        return bool(self.has_embedding_at(np.array([self.position(entity_id)]))[0])
+
+    def subject(self, entity_id: int) -> Optional[URIRef]:
+        """
+        :param entity_id: entity id
+        :return: subject URI of the entity or None if entity does not exist
+        """
+        position = self.position(entity_id)
+        if position < 0:
+            return None
+        return import_module('rdflib').URIRef(self._subjects[position])
+
+    def image(self, entity_id: int) -> Optional[str]:
+        """
+        :param entity_id: entity id
+        :return: image name of the entity or None if the entity has no image
+        """
+        position = self.position(entity_id)
+        if position < 0:
+            return None
+        return self._images[position] or None
+
+    def entity_id(self, subject: URIRef) -> Optional[int]:
+        """
+        :param subject: subject URI
+        :return: entity id or None if the subject is not a known entity
+        """
+        if self._subject_to_id is None:
+            self._subject_to_id = self._reverse_subjects()
+        return self._subject_to_id.get(str(subject))
+
+    def _reverse_subjects(self) -> Dict[str, int]:
+        return {subject: entity_id for subject, entity_id in zip(self._subjects, self._entity_ids.tolist())}
+
+    def save(self, file: BinaryIO):
+        """
+        :param file: a binary file object to write lookup tables to in .npz format
+        """
+        np.savez(file,
+                 entity_ids=self._entity_ids,
+                 subjects_data=self._subjects.data,
+                 subjects_offsets=self._subjects.offsets,
+                 has_embedding=self._has_embedding,
+                 images_data=self._images.data,
+                 images_offsets=self._images.offsets)
+
+    @classmethod
+    def load(cls, file: BinaryIO) -> 'EntityLookup':
+        """
+        :param file: a binary file object with lookup tables in .npz format
+        :return: EntityLookup instance
+        """
+        with np.load(file, allow_pickle=False) as arrays:
+            return cls(entity_ids=arrays['entity_ids'],
+                       subjects=PackedStrings(arrays['subjects_data'], arrays['subjects_offsets']),
+                       has_embedding=arrays['has_embedding'],
+                       images=PackedStrings(arrays['images_data'], arrays['images_offsets']))
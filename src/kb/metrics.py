@@ -0,0 +1,302 @@
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence
+from .config import Config
+from .log import Log
+
+log = Log.get_logger()
+
+
+# a callback receiving every recorded value: kind ("stage", "latency", "count" or "profile"), name and value
+MetricsHook = Callable[[str, str, Any], None]
+
+# profiling modes of Metrics.profile_calls
+PROFILE_MODES = ('cpu', 'memory', 'all')
+
+
+class LatencyHistogram:
+    """
+    A histogram of durations with fixed bucket bounds, percentiles are estimated from buckets
+    """
+    def __init__(self, bounds_ms: Sequence[float] = Config.LATENCY_BUCKETS_MS):
+        """
+        :param bounds_ms: increasing upper bounds of buckets in milliseconds, one more bucket holds larger values
+        """
+        self._bounds = list(bounds_ms)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, value_ms: float):
+        self._counts[bisect_left(self._bounds, value_ms)] += 1
+        self.count += 1
+        self.total_ms += value_ms
+        self.max_ms = max(self.max_ms, value_ms)
+
+    def percentile(self, q: float) -> float:
+        """
+        :param q: percentile in [0, 100]
+        :return: upper bound of the bucket holding the percentile, the largest value for the last bucket
+        """
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(self._bounds, self._counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def snapshot(self) -> dict:
+        buckets = {f"le_{bound:g}ms": count for bound, count in zip(self._bounds, self._counts) if count}
+        if self._counts[-1]:
+            buckets['inf'] = self._counts[-1]
+        return {'count': self.count,
+                'mean_ms': self.total_ms / self.count if self.count else 0.0,
+                'p50_ms': self.percentile(50),
+                'p90_ms': self.percentile(90),
+                'p99_ms': self.percentile(99),
+                'max_ms': self.max_ms,
+                'buckets': buckets}
+
+
+class Metrics:
+    """
+    A class to record stage timings, call latencies and counters of a knowledge base.
+    Recording is disabled by default, a disabled instance only checks a flag, so it costs next to nothing.
+    Values are available as a snapshot dict and are passed to hooks as they are recorded
+    """
+    def __init__(self, enabled: bool = Config.METRICS_ENABLED):
+        """
+        :param enabled: whether to record values
+        """
+        self.enabled = enabled
+        self.profile_calls = None
+        self._hooks = []
+        self._lock = Lock()
+        # held by the call being profiled
+        self._profile_lock = Lock()
+        self.reset()
+
+    def enable(self, enabled: bool = True, profile_calls: Optional[str] = None):
+        """
+        :param enabled: whether to record values
+        :param profile_calls: optional, profile every measured call: "cpu" with cProfile, "memory" with
+            tracemalloc or "all". Reports of the last call of every method are kept in the snapshot
+        """
+        if profile_calls is not None and profile_calls not in PROFILE_MODES:
+            raise ValueError(f"`profile_calls` should be one of {PROFILE_MODES}, got {profile_calls}")
+        self.enabled = enabled
+        self.profile_calls = profile_calls if enabled else None
+
+    def reset(self):
+        """
+        A method to drop recorded values
+        """
+        with self._lock:
+            self._stages = dict()
+            self._latencies = dict()
+            self._counters = dict()
+            self._profiles = dict()
+
+    def add_hook(self, hook: MetricsHook):
+        """
+        :param hook: a callable receiving (kind, name, value) of every recorded value
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: MetricsHook):
+        self._hooks.remove(hook)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        A context manager to time a stage of a long operation, e.g. index build in read_raw
+        :param name: stage name
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name: str, seconds: float):
+        """
+        :param name: stage name
+        :param seconds: duration of the stage measured by the caller
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            stage = self._stages.setdefault(name, {'count': 0, 'total_s': 0.0, 'last_s': 0.0})
+            stage['count'] += 1
+            stage['total_s'] += seconds
+            stage['last_s'] = seconds
+        self._notify('stage', name, seconds)
+
+    def observe(self, name: str, seconds: float):
+        """
+        :param name: name of a call
+        :param seconds: its duration
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._latencies.get(name)
+            if histogram is None:
+                histogram = self._latencies[name] = LatencyHistogram()
+            histogram.add(seconds * 1000)
+        self._notify('latency', name, seconds)
+
+    def count(self, name: str, value: int = 1):
+        """
+        :param name: counter name
+        :param value: increment
+        """
+        if not self.enabled or not value:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        self._notify('count', name, value)
+
+    def snapshot(self) -> dict:
+        """
+        :return: a dict with `stages` timings in seconds, `latency` histograms in milliseconds, `counters`
+            and `profiles` of the last profiled calls
+        """
+        with self._lock:
+            return {'enabled': self.enabled,
+                    'stages': {name: dict(x) for name, x in self._stages.items()},
+                    'latency': {name: x.snapshot() for name, x in self._latencies.items()},
+                    'counters': dict(self._counters),
+                    'profiles': dict(self._profiles)}
+
+    def call(self, name: str, func: Callable, *args, **kwargs) -> Any:
+        """
+        A method to measure a call, profiling it if profile_calls is set
+        :param name: name of the call
+        :param func: a callable
+        :return: result of the call
+        """
+        # profilers trace the whole process and can not be nested, so one call is profiled at a time.
+        # Calls made meanwhile, by other threads or by the profiled call itself, are only timed
+        if self.profile_calls is None or not self._profile_lock.acquire(blocking=False):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - start)
+
+        cpu, memory = self.profile_calls in ('cpu', 'all'), self.profile_calls in ('memory', 'all')
+        report = dict()
+        start = time.perf_counter()
+        try:
+            with profile(cpu=cpu, memory=memory) as report:
+                return func(*args, **kwargs)
+        finally:
+            self._profile_lock.release()
+            self.observe(name, time.perf_counter() - start)
+            with self._lock:
+                self._profiles[name] = report
+            self._notify('profile', name, report)
+
+    def _notify(self, kind: str, name: str, value: Any):
+        for hook in list(self._hooks):
+            # a failing hook should not fail the call it observes
+            try:
+                hook(kind, name, value)
+            except Exception:
+                log.exception(f"metrics hook {hook} failed on {kind} `{name}`")
+
+
+def measured(name: str) -> Callable[[Callable], Callable]:
+    """
+    A decorator to record latency of a method of an object with a `_metrics` attribute.
+    With metrics disabled the method is called right away
+    :param name: name the latency is recorded under
+    """
+    def decorator(method: Callable) -> Callable:
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self._metrics.enabled:
+                return method(self, *args, **kwargs)
+            return self._metrics.call(name, method, self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def profile(cpu: bool = True, memory: bool = False, top: int = Config.PROFILE_TOP) -> Iterator[dict]:
+    """
+    A context manager to profile a block of code, e.g. a single knowledge base call:
+        with profile(memory=True) as report:
+            kb.select_similar_many(ids)
+    :param cpu: whether to collect cProfile statistics
+    :param memory: whether to trace allocations with tracemalloc
+    :param top: number of functions and allocation sites to report
+    :return: a dict filled on exit with `cpu`, the top functions by cumulative time as text,
+        and `memory` with `peak_bytes` and `top` allocation sites
+    """
+    report = dict()
+    profiler = cProfile.Profile() if cpu else None
+    tracing = memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    if memory:
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        before = _take_snapshot()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield report
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        # allocations are taken before cpu statistics are formatted, so that they do not show up
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            stats = _take_snapshot().compare_to(before, 'lineno')[:top]
+            report['memory'] = {'peak_bytes': peak, 'current_bytes': current,
+                                'top': [str(x) for x in stats]}
+            if tracing:
+                tracemalloc.stop()
+        if profiler is not None:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+            report['cpu'] = stream.getvalue()
+
+
+def _take_snapshot() -> tracemalloc.Snapshot:
+    """
+    :return: traced allocations except the ones of tracemalloc itself
+    """
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def hit_rate(hits: int, misses: int) -> float:
+    """
+    :return: share of hits among lookups, 0 if there were none
+    """
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+def stage_times(snapshot: dict, prefix: str) -> Dict[str, float]:
+    """
+    :param snapshot: a snapshot made by Metrics.snapshot()
+    :param prefix: stage name prefix, e.g. "read_raw."
+    :return: last duration of stages with the prefix, keyed by the rest of their names
+    """
+    return {name[len(prefix):]: x['last_s'] for name, x in snapshot['stages'].items() if name.startswith(prefix)}
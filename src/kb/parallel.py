@@ -0,0 +1,74 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+from .config import Config
+
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def resolve_n_jobs(n_jobs: Optional[int] = None) -> int:
+    """
+    A function to turn a user supplied worker count into an actual one
+    :param n_jobs: number of workers. None means Config.N_JOBS, -1 means all cores
+    :return: a positive number of workers
+    """
+    if n_jobs is None:
+        n_jobs = Config.N_JOBS
+    if n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+    return max(1, n_jobs)
+
+
+def map_chunks(n_rows: int,
+               func: Callable[[int, int], None],
+               n_jobs: Optional[int] = None,
+               chunks_per_worker: int = 4):
+    """
+    A function to process rows [0, n_rows) in contiguous chunks on a thread pool.
+    func is called with (start, stop) of every chunk and is expected to write its results itself
+    :param n_rows: number of rows to process
+    :param func: a callable processing rows from start (inclusive) to stop (exclusive)
+    :param n_jobs: number of threads
+    :param chunks_per_worker: number of chunks per thread, more chunks balance load better
+    """
+    n_jobs = resolve_n_jobs(n_jobs)
+    if n_jobs == 1 or n_rows <= 1:
+        func(0, n_rows)
+        return
+
+    n_chunks = min(n_rows, n_jobs * chunks_per_worker)
+    bounds = [n_rows * i // n_chunks for i in range(n_chunks + 1)]
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        # consume results to re-raise exceptions from workers
+        list(pool.map(lambda i: func(bounds[i], bounds[i + 1]), range(n_chunks)))
+
+
+def imap_prefetch(func: Callable[[T], R],
+                  items: Iterable[T],
+                  n_jobs: Optional[int] = None,
+                  prefetch: Optional[int] = None,
+                  processes: bool = False) -> Iterator[R]:
+    """
+    A function to map func over items on a thread pool yielding results in order of items.
+    At most prefetch results are computed ahead of the consumer, so they need not fit in memory at once
+    :param func: a callable to apply to every item
+    :param items: items to process
+    :param n_jobs: number of workers
+    :param prefetch: number of results to compute ahead, defaults to twice the number of workers
+    :param processes: whether to use a process pool, func and items should be picklable then
+    :return: an iterator over results
+    """
+    n_jobs = resolve_n_jobs(n_jobs)
+    prefetch = prefetch or 2 * n_jobs
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor(max_workers=n_jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,377 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable, List, Optional, Tuple, Union
+from .config import Config
+from .kb import KB
+from .log import Log
+from .sharded import ShardedKB
+
+log = Log.get_logger()
+
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class MicroBatcher:
+    """
+    A class to collect concurrent queries into batches. Queries with the same key arriving within a time window
+    are concatenated, answered by one call and the results are split back between them
+    """
+    def __init__(self,
+                 func: Callable[[Hashable, np.ndarray], Tuple[np.ndarray, ...]],
+                 window: float = Config.BATCH_WINDOW,
+                 max_batch: int = Config.MAX_BATCH,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        """
+        :param func: a callable taking a key and queries stacked along the first axis and returning
+            a tuple of arrays whose rows are aligned with the queries
+        :param window: time in seconds to wait for more queries after the first one of a batch
+        :param max_batch: number of query rows which are answered without waiting for the window to end
+        :param executor: an executor to run func on, so that the event loop keeps accepting queries
+        """
+        self._func = func
+        self._window = window
+        self._max_batch = max_batch
+        self.executor = executor
+        self._pending = dict()
+
+    async def submit(self, key: Hashable, queries: np.ndarray) -> Tuple[np.ndarray, ...]:
+        """
+        :param key: queries are batched only with queries of the same key, e.g. the same k_nearest
+        :param queries: an array of queries, one per row
+        :return: a tuple of arrays with rows of the given queries
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = []
+            loop.call_later(self._window, self._flush, key, batch)
+        batch.append((queries, future))
+        if sum(len(x) for x, _ in batch) >= self._max_batch:
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key: Hashable, batch: List[Tuple[np.ndarray, asyncio.Future]]):
+        """
+        A method to answer a batch unless it was answered already because it grew large enough
+        """
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+        asyncio.ensure_future(self._run(key, batch))
+
+    async def _run(self, key: Hashable, batch: List[Tuple[np.ndarray, asyncio.Future]]):
+        queries = np.concatenate([x for x, _ in batch])
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self._func, key, queries)
+        except Exception as e:
+            if len(batch) > 1:
+                # a bad query should fail only its own request, so members of a failed batch are retried one by one
+                log.warning(f"batch of {len(batch)} requests failed, answering them one at a time: {e}")
+                await asyncio.gather(*(self._run(key, [member]) for member in batch))
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        start = 0
+        for x, future in batch:
+            if not future.done():
+                future.set_result(tuple(result[start:start + len(x)] for result in results))
+            start += len(x)
+
+
+class KBServer:
+    """
+    A class to serve a loaded knowledge base over a local HTTP API with JSON bodies:
+        GET /health
+        GET /metrics
+        POST /select_similar {"entity_ids": [...], "k_nearest": 10, "search_k": null, "filter_by": null}
+        POST /select_similar_by_vector {"vectors": [[...]], "k_nearest": 10, "search_k": null, "filter_by": null}
+        POST /embeddings {"entity_ids": [...]}
+    filter_by is a list of entity ids or a SPARQL query. Neighbors are returned as `ids` and `distances` lists
+    padded with -1 and null, embeddings of missing entities are filled with null.
+    Concurrent requests are answered in micro-batches. Worker processes are forked after the knowledge base
+    is read, so they share its memory-mapped index and embeddings and the pages of its lookup tables
+    """
+    def __init__(self,
+                 kb: Union[KB, ShardedKB],
+                 host: str = Config.SERVER_HOST,
+                 port: int = Config.SERVER_PORT,
+                 n_workers: int = Config.SERVER_WORKERS,
+                 batch_window: float = Config.BATCH_WINDOW,
+                 max_batch: int = Config.MAX_BATCH,
+                 n_jobs: Optional[int] = None):
+        """
+        :param kb: a knowledge base which was read already. Lazily read knowledge bases should be read fully,
+            otherwise every worker loads lookup tables itself
+        :param host: host to listen on
+        :param port: port to listen on, 0 picks a free port, see address
+        :param n_workers: number of worker processes, more than one requires os.fork
+        :param batch_window: time in seconds concurrent requests are collected for
+        :param max_batch: number of queries answered at once without waiting for the window to end
+        :param n_jobs: number of threads every batch is spread over, see KB.select_similar_many()
+        """
+        if n_workers < 1:
+            raise ValueError(f"`n_workers` should be positive, got {n_workers}")
+        if n_workers > 1 and not hasattr(os, 'fork'):
+            log.warning("worker processes require os.fork, serving from a single process")
+            n_workers = 1
+        self._kb = kb
+        self._n_workers = n_workers
+        self._batch_window = batch_window
+        self._max_batch = max_batch
+        self._n_jobs = n_jobs
+        self._process = None
+
+        # the socket is bound before workers are forked, so that all of them accept connections on it
+        # and clients may connect as soon as the server is created
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen(socket.SOMAXCONN)
+        self.address = self._socket.getsockname()[:2]
+
+    def serve_forever(self):
+        """
+        A method to serve requests until the process is interrupted or terminated
+        """
+        log.info(f"serving knowledge base on http://{self.address[0]}:{self.address[1]} "
+                 f"with {self._n_workers} worker(s)")
+        if self._n_workers == 1:
+            self._run_worker()
+            return
+
+        pids = []
+        for _ in range(self._n_workers):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self._run_worker()
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        def stop(signum=None, frame=None):
+            for x in pids:
+                try:
+                    os.kill(x, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            for pid in pids:
+                os.waitpid(pid, 0)
+        except KeyboardInterrupt:
+            stop()
+            for pid in pids:
+                os.waitpid(pid, 0)
+
+    def start(self) -> 'KBServer':
+        """
+        A method to serve requests from a background process, e.g. for tests. Requires os.fork
+        :return: the server itself
+        """
+        self._process = multiprocessing.get_context('fork').Process(target=self.serve_forever)
+        self._process.start()
+        return self
+
+    def stop(self):
+        """
+        A method to stop the background process started by start() and close the socket
+        """
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+        self._socket.close()
+
+    def __enter__(self) -> 'KBServer':
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _run_worker(self):
+        """
+        A method to run the event loop of one worker process
+        """
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def _serve(self):
+        # knowledge base methods are not thread safe, one thread answers all batches of a worker
+        executor = ThreadPoolExecutor(max_workers=1)
+        self._batcher = MicroBatcher(self._answer, self._batch_window, self._max_batch, executor)
+        server = await asyncio.start_server(self._handle, sock=self._socket, limit=Config.MAX_REQUEST_BYTES)
+        log.info(f"worker {os.getpid()} is ready")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        A method to serve HTTP/1.1 requests of one connection, connections are kept alive
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, version = (line.decode('latin-1').split() + ['', '', ''])[:3]
+                headers = dict()
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > Config.MAX_REQUEST_BYTES:
+                    status, response = 413, {'error': f"request body should be at most "
+                                                      f"{Config.MAX_REQUEST_BYTES} bytes"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, response = await self._dispatch(method, path, body)
+                    keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+
+                data = json.dumps(response).encode('utf-8')
+                writer.write(f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+                             f"Content-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, path: str, body: bytes) -> Tuple[int, dict]:
+        """
+        :return: a tuple of (HTTP status, response body)
+        """
+        routes = {'/health': ('GET', self._health),
+                  '/metrics': ('GET', self._metrics),
+                  '/select_similar': ('POST', self._select_similar),
+                  '/select_similar_by_vector': ('POST', self._select_similar_by_vector),
+                  '/embeddings': ('POST', self._embeddings)}
+        if path not in routes:
+            return 404, {'error': f"unknown path {path}"}
+        if method != routes[path][0]:
+            return 405, {'error': f"{path} expects {routes[path][0]} requests"}
+        try:
+            request = json.loads(body) if body else dict()
+            if not isinstance(request, dict):
+                raise ValueError("request body should be a JSON object")
+            return 200, await routes[path][1](request)
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            log.exception(f"failed to answer {path}")
+            return 500, {'error': str(e)}
+
+    async def _health(self, request: dict) -> dict:
+        return {'status': 'ok', 'pid': os.getpid()}
+
+    async def _metrics(self, request: dict) -> dict:
+        # metrics are recorded per worker process
+        if not hasattr(self._kb, 'metrics_snapshot'):
+            raise ValueError("sharded knowledge bases do not record metrics")
+        snapshot = await asyncio.get_running_loop().run_in_executor(self._batcher.executor,
+                                                                    self._kb.metrics_snapshot)
+        snapshot['pid'] = os.getpid()
+        return snapshot
+
+    async def _select_similar(self, request: dict) -> dict:
+        entity_ids = np.asarray(request.get('entity_ids', []), dtype=np.int64).ravel()
+        ids, distances = await self._batcher.submit(('entity_ids',) + self._search_key(request), entity_ids)
+        return {'ids': ids.tolist(), 'distances': _to_json(distances)}
+
+    async def _select_similar_by_vector(self, request: dict) -> dict:
+        vectors = np.asarray(request.get('vectors', []), dtype=np.float32)
+        if vectors.ndim != 2:
+            raise ValueError(f"`vectors` should be a 2-D array, got shape {vectors.shape}")
+        # vectors of different lengths are not batched together, so that only the wrong ones fail
+        ids, distances = await self._batcher.submit(('vectors', vectors.shape[1]) + self._search_key(request),
+                                                    vectors)
+        return {'ids': ids.tolist(), 'distances': _to_json(distances)}
+
+    async def _embeddings(self, request: dict) -> dict:
+        entity_ids = np.asarray(request.get('entity_ids', []), dtype=np.int64).ravel()
+        embeddings, = await self._batcher.submit(('embeddings',), entity_ids)
+        return {'embeddings': _to_json(embeddings)}
+
+    @staticmethod
+    def _search_key(request: dict) -> tuple:
+        """
+        :param request: a search request
+        :return: (k_nearest, search_k, filter_by) of the request, they should be equal within a batch
+        """
+        k_nearest = request.get('k_nearest', 10)
+        # JSON true and false are ints to isinstance
+        if not isinstance(k_nearest, int) or isinstance(k_nearest, bool) or k_nearest < 1:
+            raise ValueError(f"`k_nearest` should be a positive integer, got {k_nearest}")
+        search_k = request.get('search_k')
+        if search_k is not None and (not isinstance(search_k, int) or isinstance(search_k, bool)):
+            raise ValueError(f"`search_k` should be an integer, got {search_k}")
+        filter_by = request.get('filter_by')
+        if isinstance(filter_by, list):
+            filter_by = tuple(sorted(set(int(x) for x in filter_by)))
+        elif filter_by is not None and not isinstance(filter_by, str):
+            raise ValueError("`filter_by` should be a list of entity ids or a SPARQL query")
+        return k_nearest, search_k, filter_by
+
+    def _answer(self, key: tuple, queries: np.ndarray) -> Tuple[np.ndarray, ...]:
+        """
+        A method to answer a batch of queries, it runs on the executor thread
+        :param key: batch key made by the request handlers
+        :param queries: entity ids or query vectors
+        :return: arrays with one row per query
+        """
+        if key[0] == 'embeddings':
+            return self._kb.get_embeddings(queries),
+        k_nearest, search_k, filter_by = key[-3:]
+        if len(queries) == 0:
+            return np.empty((0, k_nearest), dtype=np.int64), np.empty((0, k_nearest), dtype=np.float32)
+        queries = {'entity_ids' if key[0] == 'entity_ids' else 'vectors': queries}
+        return self._kb.select_similar_many(k_nearest=k_nearest, search_k=search_k, n_jobs=self._n_jobs,
+                                            filter_by=filter_by, **queries)
+
+
+def _to_json(array: np.ndarray) -> List[List[Optional[float]]]:
+    """
+    :param array: a 2-D float array
+    :return: nested lists with nan replaced by None, since JSON has no nan
+    """
+    return [[None if x != x else x for x in row] for row in array.astype(np.float64).tolist()]
+
+
+def read_kb(path: str, lazy: bool = False) -> Union[KB, ShardedKB]:
+    """
+    A function to read a knowledge base to serve
+    :param path: a path to a .ttlplus file or to a manifest of a sharded knowledge base
+    :param lazy: whether to read the graph and lookup tables on first use, see KBIO.read_ttlplus()
+    :return: the knowledge base
+    """
+    if path.endswith('.json'):
+        kb = ShardedKB()
+        kb.read_manifest(path)
+        return kb
+    kb = KB()
+    kb.read_ttlplus(path, lazy=lazy)
+    return kb
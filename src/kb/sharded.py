@@ -0,0 +1,397 @@
+from __future__ import annotations
+import json
+import pickle
+import numpy as np
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple, Union, TYPE_CHECKING
+from .backends import BuildOptions
+from .config import Config
+from .delta import merge_results
+from .embeddings import EmbeddingSource
+from .filters import FilterSpec
+from .kb import KB
+from .log import Log
+from .parallel import resolve_n_jobs
+
+if TYPE_CHECKING:
+    from rdflib import URIRef
+
+log = Log.get_logger()
+
+
+def _build_shard(data_ttl_path: str,
+                 embeddings: EmbeddingSource,
+                 out_bk_path_dir: str,
+                 entity_to_enrich: URIRef,
+                 entity_predicate: URIRef,
+                 images_dir_path: str,
+                 image_names: List[str],
+                 read_raw_args: dict) -> str:
+    """
+    A function to build one shard, it runs in a worker process
+    :return: a path to the shard .ttlplus file
+    """
+    kb = KB()
+    kb.read_raw(data_ttl_path=data_ttl_path,
+                embeddings_dir_path=embeddings,
+                out_bk_path_dir=out_bk_path_dir,
+                entity_to_enrich=entity_to_enrich,
+                entity_predicate=entity_predicate,
+                images_dir_path=images_dir_path,
+                image_names=image_names,
+                **read_raw_args)
+    return os.path.join(out_bk_path_dir, 'kb.ttlplus')
+
+
+class ShardedKB:
+    """
+    A knowledge base split into several .ttlplus shards partitioned by entity id.
+    A manifest file lists the shards, every query is sent to all of them concurrently
+    and their results are merged into a global top-k by distance
+    """
+    def __init__(self):
+        self._shards = []
+        self._manifest = dict()
+        self._pool = None
+        self._pool_pid = None
+
+    @property
+    def shards(self) -> List[KB]:
+        return self._shards
+
+    def read_raw(self,
+                 data_ttl_path: str,
+                 embeddings_dir_path: Union[str, np.ndarray],
+                 out_bk_path_dir: str,
+                 entity_to_enrich: URIRef,
+                 entity_predicate: URIRef,
+                 n_shards: int,
+                 images_dir_path: str = "",
+                 embedding_ids: Optional[Union[str, Sequence[int], np.ndarray]] = None,
+                 n_jobs: Optional[int] = None,
+                 processes: bool = True,
+                 search_k: int = Config.SEARCH_K,
+                 backend: str = Config.INDEX_BACKEND,
+                 embedding_dtype: str = Config.EMBEDDING_DTYPE,
+                 build_options: Optional[BuildOptions] = None,
+                 on_disk_graph: bool = False):
+        """
+        A method to read raw data once and write it as several shards in parallel.
+        An entity goes to shard number entity_id % n_shards along with the triples it is the subject of,
+        triples about other subjects, e.g. classes and categories, are copied to every shard
+        :param data_ttl_path: a path to RDF file in any format KB.read_raw accepts
+        :param embeddings_dir_path: embeddings in any form KB.read_raw accepts
+        :param out_bk_path_dir: out path to save shards and the manifest
+        :param entity_to_enrich: an rdflib.URIRef pointing to entity class we would enrich with info about embeddings
+        :param entity_predicate: an rdflib.URIRef pointing to entity id predicate
+        :param n_shards: number of shards
+        :param images_dir_path: optional, a path to images directory
+        :param embedding_ids: entity ids of rows of a stacked embedding matrix
+        :param n_jobs: number of shards built at once, defaults to Config.N_JOBS
+        :param processes: whether to build shards in worker processes rather than threads
+        :param search_k: default number of nodes to inspect during search
+        :param backend: search backend to use
+        :param embedding_dtype: dtype of embedding matrices stored in shards
+        :param build_options: search index build options of every shard
+        :param on_disk_graph: whether shards keep their graphs in disk-backed stores, see KB.read_raw
+        """
+        embeddings = EmbeddingSource(embeddings_dir_path, ids=embedding_ids, n_jobs=n_jobs)
+        shard_dirs = [os.path.join(out_bk_path_dir, Config.SHARD_FOLDER.format(i)) for i in range(n_shards)]
+        for shard_dir in shard_dirs:
+            os.makedirs(shard_dir, exist_ok=True)
+
+        image_names = [[] for _ in range(n_shards)]
+        if images_dir_path:
+            for name in os.listdir(images_dir_path):
+                if Path(name).stem.isnumeric():
+                    image_names[int(Path(name).stem) % n_shards].append(name)
+
+        tmp_dir = tempfile.mkdtemp(prefix='_tmp_kb_', dir=out_bk_path_dir)
+        try:
+            ttl_paths = self._partition_graph(data_ttl_path, entity_predicate, n_shards, tmp_dir, n_jobs=n_jobs)
+            shard_of = embeddings.ids % n_shards
+            read_raw_args = dict(search_k=search_k, backend=backend, embedding_dtype=embedding_dtype,
+                                 build_options=build_options, on_disk_graph=on_disk_graph)
+            if processes:
+                # shards are built in parallel already, and worker processes should not start their own
+                read_raw_args['n_jobs'] = 1
+
+            log.info(f"building {n_shards} shards")
+            executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+            with executor(max_workers=min(n_shards, resolve_n_jobs(n_jobs))) as pool:
+                futures = [pool.submit(_build_shard, ttl_paths[i], embeddings.subset(shard_of == i), shard_dirs[i],
+                                       entity_to_enrich, entity_predicate, images_dir_path, image_names[i],
+                                       read_raw_args)
+                           for i in range(n_shards)]
+                shard_paths = [x.result() for x in futures]
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        manifest = {'n_shards': n_shards,
+                    'partition': 'entity_id % n_shards',
+                    'entity': str(entity_to_enrich),
+                    'entity_predicate': str(entity_predicate),
+                    'shards': [os.path.relpath(x, out_bk_path_dir) for x in shard_paths]}
+        manifest_path = os.path.join(out_bk_path_dir, Config.SHARD_MANIFEST_FILE)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        log.info(f"sharded knowledge base manifest written to {manifest_path}")
+        self.read_manifest(manifest_path)
+
+    @staticmethod
+    def _partition_graph(data_ttl_path: str,
+                         entity_predicate: URIRef,
+                         n_shards: int,
+                         out_dir: str,
+                         n_jobs: Optional[int] = None) -> List[str]:
+        """
+        A method to split RDF data into N-Triples files, one per shard. Data is streamed: parsed chunks are
+        spilled to a temp file while entity ids are collected, then routed to shards
+        :param data_ttl_path: a path to RDF file in any format KB.read_raw accepts
+        :param entity_predicate: entity id predicate
+        :param n_shards: number of shards
+        :param out_dir: a directory to write files to
+        :param n_jobs: number of processes parsing N-Triples or N-Quads
+        :return: paths to N-Triples files
+        """
+        from .compact_graph import key_term, term_key
+        from .ingest import read_key_chunks
+
+        log.info(f"reading RDF file: {data_ttl_path}")
+        predicate_key = term_key(entity_predicate)
+        shard_of = dict()
+        spill_path = os.path.join(out_dir, 'triples.p')
+        n_triples = 0
+        with open(spill_path, 'wb') as spill:
+            for triples in read_key_chunks(data_ttl_path, n_jobs=n_jobs):
+                for s, p, o in triples:
+                    if p == predicate_key:
+                        shard_of[s] = int(key_term(o)) % n_shards
+                pickle.dump(triples, spill, protocol=pickle.HIGHEST_PROTOCOL)
+                n_triples += len(triples)
+
+        paths = [os.path.join(out_dir, f"shard_{i}.nt") for i in range(n_shards)]
+        files = [open(x, 'w', encoding='utf-8') for x in paths]
+        try:
+            with open(spill_path, 'rb') as spill:
+                while True:
+                    try:
+                        triples = pickle.load(spill)
+                    except EOFError:
+                        break
+                    for triple in triples:
+                        line = " ".join(key_term(x).n3() for x in triple) + " .\n"
+                        shard = shard_of.get(triple[0])
+                        if shard is None:
+                            for f in files:
+                                f.write(line)
+                        else:
+                            files[shard].write(line)
+        finally:
+            for f in files:
+                f.close()
+            os.remove(spill_path)
+        log.info(f"partitioned {n_triples} triples of {len(shard_of)} entities into {n_shards} shards")
+        return paths
+
+    def read_manifest(self, manifest_path: str):
+        """
+        A method to read shards listed in a manifest file, shards are read concurrently
+        :param manifest_path: a path to the manifest file
+        """
+        with open(manifest_path) as f:
+            self._manifest = json.load(f)
+        root = os.path.dirname(os.path.abspath(manifest_path))
+
+        def read_shard(path: str) -> KB:
+            kb = KB()
+            kb.read_ttlplus(os.path.join(root, path))
+            return kb
+
+        self.close()
+        self._pool = ThreadPoolExecutor(max_workers=len(self._manifest['shards']))
+        self._pool_pid = os.getpid()
+        self._shards = list(self._pool.map(read_shard, self._manifest['shards']))
+        log.info(f"read {len(self._shards)} shards")
+
+    def close(self):
+        """
+        A method to stop the thread pool querying shards
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+            self._pool_pid = None
+
+    def shard_of(self, entity_id: int) -> KB:
+        """
+        :param entity_id: entity id
+        :return: the shard holding the entity
+        """
+        return self._shards[entity_id % self._manifest['n_shards']]
+
+    def select_similar(self,
+                       entity_id: int,
+                       k_nearest: int = 10,
+                       search_k: Optional[int] = None,
+                       include_distances: bool = False,
+                       filter_by: Optional[FilterSpec] = None) -> Union[List[int], Tuple[List[int], List[float]]]:
+        """
+        A method to select k nearest to the entity with the given integer id across all shards
+        :param entity_id: entity id whose closest neighbors we want
+        :param k_nearest: a number of neighbors we want
+        :param search_k: number of nodes to inspect during search in every shard, defaults to shard values
+        :param include_distances: whether to return distances along with ids
+        :param filter_by: optional, restricts neighbors, see KB.select_similar(). Every shard compiles it
+            against its own graph
+        :return: a list of int ids of closest neighbors or a tuple of (ids, distances) lists
+        """
+        exists, has_embedding = self.shard_of(entity_id)._resolve_entities(np.array([entity_id]))
+        if not exists[0]:
+            log.warning(f"entity with id `{entity_id}` does not exist")
+            return KB._format_result([], [], include_distances)
+        if not has_embedding[0]:
+            log.warning(f"entity with id `{entity_id}` does not have corresponding embeddings")
+            return KB._format_result([], [], include_distances)
+
+        ids, distances = self.select_similar_many(entity_ids=[entity_id], k_nearest=k_nearest,
+                                                  search_k=search_k, filter_by=filter_by)
+        return KB._format_result(ids[0], distances[0], include_distances)
+
+    def select_similar_by_uri(self,
+                              entity: URIRef,
+                              k_nearest: int = 10,
+                              search_k: Optional[int] = None,
+                              include_distances: bool = False,
+                              filter_by: Optional[FilterSpec] = None) \
+            -> Union[List[int], Tuple[List[int], List[float]]]:
+        """
+        A method to select k nearest to the entity with the given URI across all shards
+        :param entity: URIRef of the entity whose closest neighbors we want
+        :param k_nearest: a number of neighbors we want
+        :param search_k: number of nodes to inspect during search in every shard
+        :param include_distances: whether to return distances along with ids
+        :param filter_by: optional, restricts neighbors, see KB.select_similar()
+        :return: a list of int ids of closest neighbors or a tuple of (ids, distances) lists
+        """
+        for entity_id in self._map(lambda kb: kb._entity_id(entity)):
+            if entity_id is not None:
+                return self.select_similar(entity_id=entity_id,
+                                           k_nearest=k_nearest,
+                                           search_k=search_k,
+                                           include_distances=include_distances,
+                                           filter_by=filter_by)
+        log.warning(f"entity `{entity}` does not exist")
+        return KB._format_result([], [], include_distances)
+
+    def select_similar_by_vector(self,
+                                 vector: Union[Sequence[float], np.ndarray],
+                                 k_nearest: int = 10,
+                                 search_k: Optional[int] = None,
+                                 include_distances: bool = False,
+                                 filter_by: Optional[FilterSpec] = None) \
+            -> Union[List[int], Tuple[List[int], List[float]]]:
+        """
+        A method to select k nearest to an arbitrary vector across all shards
+        :param vector: query vector, its length should match the knowledge base embeddings
+        :param k_nearest: a number of neighbors we want
+        :param search_k: number of nodes to inspect during search in every shard
+        :param include_distances: whether to return distances along with ids
+        :param filter_by: optional, restricts neighbors, see KB.select_similar()
+        :return: a list of int ids of closest neighbors or a tuple of (ids, distances) lists
+        """
+        ids, distances = self.select_similar_many(vectors=np.asarray(vector, dtype=np.float32).reshape(1, -1),
+                                                  k_nearest=k_nearest, search_k=search_k, filter_by=filter_by)
+        return KB._format_result(ids[0], distances[0], include_distances)
+
+    def select_similar_many(self,
+                            entity_ids: Optional[Union[Sequence[int], np.ndarray]] = None,
+                            k_nearest: int = 10,
+                            vectors: Optional[np.ndarray] = None,
+                            search_k: Optional[int] = None,
+                            n_jobs: Optional[int] = None,
+                            filter_by: Optional[FilterSpec] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A method to select k nearest neighbors for many entities or query vectors at once across all shards.
+        Exactly one of entity_ids and vectors should be given
+        :param entity_ids: a sequence or array of entity ids whose closest neighbors we want
+        :param k_nearest: a number of neighbors we want per query
+        :param vectors: a 2-D array of query vectors, one per row
+        :param search_k: number of nodes to inspect during search in every shard
+        :param n_jobs: number of threads every shard spreads queries over
+        :param filter_by: optional, restricts neighbors, see KB.select_similar()
+        :return: a tuple of (ids, distances) arrays of shape (n_queries, k_nearest).
+            Rows of missing entities and slots without a neighbor hold -1 in ids and nan in distances
+        """
+        if (entity_ids is None) == (vectors is None):
+            raise ValueError("exactly one of `entity_ids` and `vectors` should be provided")
+
+        if entity_ids is not None:
+            entity_ids = np.asarray(entity_ids, dtype=np.int64).ravel()
+            vectors, valid = self._get_vectors(entity_ids)
+            missing = entity_ids[~valid]
+            if len(missing):
+                log.warning(f"{len(missing)} of {len(entity_ids)} entities do not exist or do not have "
+                            f"corresponding embeddings, first of them: {missing[:10].tolist()}")
+        else:
+            vectors = np.asarray(vectors, dtype=np.float32)
+            valid = np.ones(len(vectors), dtype=bool)
+        rows = np.flatnonzero(valid)
+        queries = np.asarray(vectors[rows], dtype=np.float32)
+
+        results = self._map(lambda kb: kb.select_similar_many(vectors=queries, k_nearest=k_nearest,
+                                                              search_k=search_k, n_jobs=n_jobs,
+                                                              filter_by=filter_by))
+        merged_ids, merged_distances = merge_results(self._shards[0]._index.metric,
+                                                     tuple(x[0] for x in results),
+                                                     tuple(x[1] for x in results),
+                                                     k_nearest)
+
+        ids = np.full((len(vectors), k_nearest), -1, dtype=np.int64)
+        distances = np.full((len(vectors), k_nearest), np.nan, dtype=np.float32)
+        ids[rows], distances[rows] = merged_ids, merged_distances
+        return ids, distances
+
+    def get_embeddings(self, entity_ids: Union[Sequence[int], np.ndarray]) -> np.ndarray:
+        """
+        A method to get embeddings of many entities at once from the shards holding them
+        :param entity_ids: a sequence or array of entity ids
+        :return: a 2-D array with one embedding per row, rows of entities without embeddings are filled with nan
+        """
+        embeddings, valid = self._get_vectors(np.asarray(entity_ids, dtype=np.int64).ravel())
+        if not valid.all():
+            log.warning(f"{int((~valid).sum())} of {len(valid)} entities do not have corresponding embeddings")
+        return embeddings
+
+    def _get_vectors(self, entity_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param entity_ids: an array of entity ids
+        :return: a tuple of (embeddings, valid) arrays, rows of entities without embeddings are filled with nan
+        """
+        shard_of = entity_ids % self._manifest['n_shards']
+        embeddings = np.full((len(entity_ids), self._shards[0]._meta_dict['VECTOR_LENGTH']), np.nan, dtype=np.float32)
+        valid = np.zeros(len(entity_ids), dtype=bool)
+        for shard, kb in enumerate(self._shards):
+            rows = np.flatnonzero(shard_of == shard)
+            if len(rows):
+                embeddings[rows], valid[rows] = kb._get_vectors(entity_ids[rows])
+        return embeddings, valid
+
+    def _map(self, func: Callable[[KB], object]) -> list:
+        """
+        A method to call a function on every shard concurrently
+        :param func: a callable taking a shard
+        :return: results in shard order
+        """
+        if self._pool_pid != os.getpid():
+            # a forked process, e.g. a server worker, inherits the pool without its threads
+            self._pool = ThreadPoolExecutor(max_workers=len(self._shards))
+            self._pool_pid = os.getpid()
+        return list(self._pool.map(func, self._shards))
+
+    def __del__(self):
+        self.close()
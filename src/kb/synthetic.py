@@ -0,0 +1,101 @@
+import gzip
+import os
+import numpy as np
+from .imports import import_module
+
+
+# namespace, entity class and id predicate of generated graphs
+SYNTHETIC_NAMESPACE = "http://example.org/word/"
+SYNTHETIC_ENTITY = SYNTHETIC_NAMESPACE + "item"
+SYNTHETIC_PREDICATE = SYNTHETIC_NAMESPACE + "has_article"
+# formats of generated graphs
+SYNTHETIC_FORMATS = ('ttl', 'nt', 'nt.gz')
+
+
+def make_synthetic_kb(directory: str,
+                      n_entities: int = 10000,
+                      vector_length: int = 64,
+                      n_classes: int = 20,
+                      embedding_share: float = 0.95,
+                      image_share: float = 0.1,
+                      image_size: int = 32,
+                      data_format: str = 'ttl',
+                      stacked_embeddings: bool = False,
+                      seed: int = 0) -> dict:
+    """
+    A function to generate raw input of a knowledge base: a graph of typed entities with integer ids,
+    their embeddings and small images. Embeddings are grouped around one center per entity class,
+    so that approximate search has neighbors to find
+    :param directory: a directory to write files to, it is created if it does not exist
+    :param n_entities: number of entities
+    :param vector_length: length of embeddings
+    :param n_classes: number of entity categories, entities of a category have similar embeddings
+    :param embedding_share: share of entities with an embedding
+    :param image_share: share of entities with an image
+    :param image_size: width and height of images in pixels
+    :param data_format: graph serialization, one of SYNTHETIC_FORMATS
+    :param stacked_embeddings: whether to write embeddings as one .npz file with `vectors` and `ids`
+        instead of a .npy file per entity
+    :param seed: random seed
+    :return: a dict of read_raw() arguments: data_ttl_path, embeddings_dir_path, images_dir_path,
+        entity_to_enrich and entity_predicate
+    """
+    if data_format not in SYNTHETIC_FORMATS:
+        raise ValueError(f"`data_format` should be one of {SYNTHETIC_FORMATS}, got {data_format}")
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    entity_ids = rng.choice(np.arange(100000, 100000 + 10 * n_entities), size=n_entities, replace=False)
+    classes = rng.integers(0, n_classes, size=n_entities)
+
+    # graph
+    data_path = os.path.join(directory, 'data.' + data_format)
+    opener = gzip.open if data_format.endswith('.gz') else open
+    with opener(data_path, 'wt', encoding='utf-8') as f:
+        if data_format == 'ttl':
+            f.write(f"@prefix ex: <{SYNTHETIC_NAMESPACE}> .\n"
+                    f"@prefix rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> .\n"
+                    f"@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .\n")
+            for entity_id, category in zip(entity_ids.tolist(), classes.tolist()):
+                f.write(f'ex:e{entity_id} rdf:type ex:item ; ex:has_article {entity_id} ; '
+                        f'ex:category ex:c{category} ; rdfs:label "entity {entity_id}" .\n')
+        else:
+            ns = SYNTHETIC_NAMESPACE
+            integer = "http://www.w3.org/2001/XMLSchema#integer"
+            for entity_id, category in zip(entity_ids.tolist(), classes.tolist()):
+                subject = f"<{ns}e{entity_id}>"
+                f.write(f"{subject} <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <{ns}item> .\n"
+                        f"{subject} <{ns}has_article> \"{entity_id}\"^^<{integer}> .\n"
+                        f"{subject} <{ns}category> <{ns}c{category}> .\n"
+                        f"{subject} <http://www.w3.org/2000/01/rdf-schema#label> \"entity {entity_id}\" .\n")
+
+    # embeddings
+    centers = rng.standard_normal((n_classes, vector_length)).astype(np.float32)
+    with_embedding = np.flatnonzero(rng.random(n_entities) < embedding_share)
+    vectors = centers[classes[with_embedding]] + \
+        0.5 * rng.standard_normal((len(with_embedding), vector_length)).astype(np.float32)
+    if stacked_embeddings:
+        embeddings_path = os.path.join(directory, 'embeddings.npz')
+        np.savez(embeddings_path, vectors=vectors, ids=entity_ids[with_embedding])
+    else:
+        embeddings_path = os.path.join(directory, 'embeddings')
+        os.makedirs(embeddings_path, exist_ok=True)
+        for entity_id, vector in zip(entity_ids[with_embedding].tolist(), vectors):
+            np.save(os.path.join(embeddings_path, f"{entity_id}.npy"), vector)
+
+    # images
+    images_path = ""
+    with_image = np.flatnonzero(rng.random(n_entities) < image_share)
+    if len(with_image):
+        images_path = os.path.join(directory, 'images')
+        os.makedirs(images_path, exist_ok=True)
+        image = import_module('PIL.Image')
+        for entity_id in entity_ids[with_image].tolist():
+            pixels = rng.integers(0, 256, size=(image_size, image_size, 3), dtype=np.uint8)
+            image.fromarray(pixels).save(os.path.join(images_path, f"{entity_id}.png"))
+
+    rdflib = import_module('rdflib')
+    return {'data_ttl_path': data_path,
+            'embeddings_dir_path': embeddings_path,
+            'images_dir_path': images_path,
+            'entity_to_enrich': rdflib.URIRef(SYNTHETIC_ENTITY),
+            'entity_predicate': rdflib.URIRef(SYNTHETIC_PREDICATE)}
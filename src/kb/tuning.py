@@ -0,0 +1,102 @@
+import numpy as np
+import time
+from typing import Dict, Optional
+from .backends import BruteForceBackend, BuildOptions, SearchBackend
+from .config import Config
+from .log import Log
+
+
+log = Log.get_logger()
+
+
+def measure_recall(index: SearchBackend,
+                   queries: np.ndarray,
+                   exact_ids: np.ndarray,
+                   k: int,
+                   search_k: int,
+                   items: Optional[np.ndarray] = None) -> Dict[str, float]:
+    """
+    A function to measure recall@k and average latency of an index against exact neighbors
+    :param index: a built search index
+    :param queries: a 2-D array of query vectors
+    :param exact_ids: an array of exact top-k neighbor ids of queries, top-(k + 1) if items are given
+    :param k: number of neighbors
+    :param search_k: number of nodes to inspect during search
+    :param items: optional, index ids of queries which are indexed items. A query always finds its own item,
+        which would inflate recall, so the item is left out of both exact and found neighbors
+    :return: a dict with `recall` and `latency_ms`
+    """
+    n = k if items is None else k + 1
+    start = time.perf_counter()
+    found = [index.get_nns_by_vector(query, n, search_k=search_k) for query in queries]
+    latency_ms = (time.perf_counter() - start) * 1000 / max(1, len(queries))
+    if items is not None:
+        exact_ids = _without_items(exact_ids, items, k)
+        found = [[x for x in nearest if x != item][:k] for nearest, item in zip(found, items.tolist())]
+
+    hits = 0
+    for nearest, exact in zip(found, exact_ids):
+        hits += len(set(nearest) & set(exact[exact >= 0].tolist()))
+    return {'recall': hits / max(1, int((exact_ids >= 0).sum())), 'latency_ms': latency_ms}
+
+
+def _without_items(ids: np.ndarray, items: np.ndarray, k: int) -> np.ndarray:
+    """
+    :param ids: an array of neighbor ids, one row per query
+    :param items: own item id of every query
+    :param k: number of neighbors to keep
+    :return: first k neighbors of every query other than its own item, padded with -1
+    """
+    keep = ids != items[:, None]
+    order = np.argsort(~keep, axis=1, kind='stable')[:, :k]
+    return np.where(np.take_along_axis(keep, order, axis=1), np.take_along_axis(ids, order, axis=1), -1)
+
+
+def auto_tune(index: SearchBackend, matrix: np.ndarray, options: BuildOptions) -> Dict[str, float]:
+    """
+    A function to build an index with the smallest n_trees and search_k reaching target recall
+    within latency budget. Queries are sampled from indexed vectors and compared against exact search
+    leaving their own items out. If options set n_trees, only search_k is tuned.
+    Items should be added to the index before calling it, the index is left built
+    :param index: search index with all items added
+    :param matrix: indexed vectors, row number is item id
+    :param options: build options with tuning targets
+    :return: a dict with chosen `n_trees` and `search_k` along with measured `recall` and `latency_ms`
+    """
+    k = options.recall_k
+    rng = np.random.default_rng(Config.TUNE_SEED)
+    sample = rng.choice(len(matrix), size=min(options.n_tune_queries, len(matrix)), replace=False)
+    items = np.sort(sample)
+    queries = np.asarray(matrix[items], dtype=np.float32)
+    exact_ids, _ = BruteForceBackend.from_matrix(matrix, index.metric).get_nns_by_vectors(queries, k + 1)
+
+    tried_n_trees = Config.TUNE_N_TREES
+    if options.n_trees is not None:
+        log.info(f"n_trees is set to {options.n_trees}, tuning search_k only")
+        tried_n_trees = (options.n_trees,)
+    best = None
+    for n_trees in tried_n_trees:
+        if best is not None:
+            index.unbuild()
+        index.build(n_trees, n_jobs=options.n_jobs)
+        for multiplier in Config.TUNE_SEARCH_K_MULTIPLIERS:
+            search_k = n_trees * k * multiplier
+            measured = measure_recall(index, queries, exact_ids, k, search_k, items)
+            measured.update({'n_trees': n_trees, 'search_k': search_k})
+            log.info(f"n_trees: {n_trees}, search_k: {search_k}, recall@{k}: {measured['recall']:.3f}, "
+                     f"latency: {measured['latency_ms']:.3f} ms")
+            within_budget = options.latency_budget_ms is None or measured['latency_ms'] <= options.latency_budget_ms
+            if measured['recall'] >= options.target_recall and within_budget:
+                return measured
+            if best is None or measured['recall'] > best['recall']:
+                best = measured
+            if not within_budget:
+                # larger search_k would only be slower
+                break
+
+    log.warning(f"could not reach recall@{k} of {options.target_recall} within latency budget, "
+                f"using n_trees: {best['n_trees']}, search_k: {best['search_k']} with recall {best['recall']:.3f}")
+    if best['n_trees'] != tried_n_trees[-1]:
+        index.unbuild()
+        index.build(best['n_trees'], n_jobs=options.n_jobs)
+    return best
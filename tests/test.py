@@ -1,5 +1,5 @@
 from src.kb import KB
-from rdflib import Graph, Literal, RDF, URIRef, Namespace
+from rdflib import RDF, Namespace
 
 
 def test_create_ttl_from_raw():
@@ -68,4 +68,48 @@ def test_print_image():
     print(kb.select_similar_image(256689))
 
 
-test_enricher()
+def test_get_embeddings():
+    ttplus = r"C:\Users\kiril\Documents\python_scripts\rdf\transformed_input_data\kb.ttlplus"
+    kb = KB()
+    kb.read_ttlplus(ttplus)
+    print(kb.get_embeddings([256689]).shape)
+    ids, embeddings = kb.get_embeddings_by_query("SELECT ?s WHERE { ?s a <http://example.org/word/item> }")
+    print(ids.shape, embeddings.shape)
+
+
+def test_select_similar_filtered():
+    ttplus = r"C:\Users\kiril\Documents\python_scripts\rdf\transformed_input_data\kb.ttlplus"
+    n_e = Namespace("http://example.org/word/")
+    kb = KB()
+    kb.read_ttlplus(ttplus)
+    print(kb.select_similar(256689, filter_by=(RDF.type, n_e.item)))
+    print(kb.select_similar(256689, filter_by={256689, 256690}))
+    print(kb.select_similar(256689, filter_by="SELECT ?s WHERE { ?s a <http://example.org/word/item> }"))
+
+
+def test_lazy_read():
+    ttplus = r"C:\Users\kiril\Documents\python_scripts\rdf\transformed_input_data\kb.ttlplus"
+    kb = KB()
+    kb.read_ttlplus(ttplus, lazy=True)
+    print(kb.select_similar(256689))
+    print(len(kb.graph))
+
+
+def test_metrics():
+    ttplus = r"C:\Users\kiril\Documents\python_scripts\rdf\transformed_input_data\kb.ttlplus"
+    kb = KB()
+    kb.metrics.enable()
+    kb.metrics.add_hook(lambda kind, name, value: print(kind, name, value) if kind == 'stage' else None)
+    kb.read_ttlplus(ttplus)
+    kb.select_similar(256689)
+    kb.select_similar_many([256689, 0], k_nearest=5)
+    snapshot = kb.metrics_snapshot()
+    print(snapshot['latency']['select_similar'], snapshot['counters'], snapshot['caches'], snapshot['sizes'])
+
+    kb.metrics.enable(profile_calls='all')
+    kb.get_embeddings([256689])
+    print(kb.metrics.snapshot()['profiles']['get_embeddings']['cpu'])
+
+
+if __name__ == "__main__":
+    test_enricher()
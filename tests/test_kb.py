@@ -0,0 +1,740 @@
+import asyncio
+import json
+import matplotlib.pyplot as plt
+import numpy as np
+import os
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import BadZipFile, ZipFile, ZIP_DEFLATED, ZIP_STORED
+from src.kb import KB, BuildOptions, ShardedKB, KBServer, KBClient
+from src.kb.benchmark import run_benchmark
+from src.kb.archive import read_npy, verify_archive, write_npy
+from src.kb.cache import load_cached_member, prune_cache, remove_cached
+from src.kb.compact_graph import CompactGraph
+from src.kb.config import Config
+from src.kb.delta import DeltaSegment
+from src.kb.backends import AnnoyBackend, BruteForceBackend
+from src.kb.embeddings import EmbeddingSource
+from src.kb.graph_store import SQLiteStore
+from src.kb.id_map import IdMap
+from src.kb.metrics import Metrics
+from src.kb.server import MicroBatcher
+from src.kb.synthetic import make_synthetic_kb
+from rdflib import BNode, Graph, Literal, RDF, URIRef, Namespace
+
+
+def synthetic_kb(directory, n_entities=500, **kwargs):
+    """
+    builds a knowledge base of synthetic entities, so that checks do not need the data files of test.py
+    """
+    inputs = make_synthetic_kb(os.path.join(directory, 'input'), n_entities=n_entities, vector_length=16)
+    kb = KB()
+    kb.read_raw(out_bk_path_dir=directory, **inputs, **kwargs)
+    return kb
+
+
+def test_id_map():
+    id_map = IdMap([1000007, 5, 256689])
+    assert id_map.to_internal_many([5, 256689, 1000007, 42]).tolist() == [1, 2, 0, -1]
+    assert id_map.to_external_many([2, 0, -1]).tolist() == [256689, 1000007, -1]
+
+    # archives created before dense numbering have no id map and use entity ids as index ids
+    n_e = Namespace("http://example.org/word/")
+    with tempfile.TemporaryDirectory() as directory:
+        graph = Graph()
+        for i in range(50):
+            graph.add((n_e[f"e{i}"], RDF.type, n_e.item))
+            graph.add((n_e[f"e{i}"], n_e.has_article, Literal(i)))
+        graph.serialize(os.path.join(directory, 'data.ttl'), format='ttl')
+        kb = KB()
+        kb.read_raw(data_ttl_path=os.path.join(directory, 'data.ttl'),
+                    embeddings_dir_path=np.random.default_rng(0).standard_normal((50, 8)).astype(np.float32),
+                    embedding_ids=np.arange(50),
+                    out_bk_path_dir=directory,
+                    entity_to_enrich=n_e.item,
+                    entity_predicate=n_e.has_article)
+        expected = kb.select_similar(7)
+        assert len(expected) == 10 and expected[0] == 7
+
+        old_path = os.path.join(directory, 'old', 'kb.ttlplus')
+        os.makedirs(os.path.dirname(old_path))
+        with ZipFile(os.path.join(directory, 'kb.ttlplus')) as src, ZipFile(old_path, 'w') as dst:
+            for info in src.infolist():
+                if info.filename not in (Config.ID_MAP_FILE, Config.ARCHIVE_MANIFEST_FILE):
+                    dst.writestr(info, src.read(info))
+        old_kb = KB()
+        old_kb.read_ttlplus(old_path)
+        assert old_kb._id_map.identity
+        assert old_kb.select_similar(7) == expected
+
+
+def test_read_npy():
+    arrays = {'a.npy': np.arange(7, dtype=np.int8),
+              'b.npy': np.random.default_rng(0).standard_normal((33, 5)).astype(np.float32),
+              'c.npy': np.zeros((0, 4), dtype=np.float32),
+              'd.npy': np.asfortranarray(np.arange(12, dtype=np.int64).reshape(3, 4))}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'arrays.zip')
+        with ZipFile(path, 'w') as archive:
+            # members of odd sizes and a compressed one shift offsets of the following members
+            archive.writestr('deflated.bin', b'x' * 1001, compress_type=ZIP_DEFLATED)
+            for name, array in arrays.items():
+                write_npy(archive, name, array)
+        with ZipFile(path) as archive:
+            for name, array in arrays.items():
+                mapped = read_npy(archive, path, name)
+                assert mapped.dtype == array.dtype and np.array_equal(mapped, array)
+                assert isinstance(mapped, np.memmap) or not array.size
+                assert np.array_equal(read_npy(archive, path, name, mmap=False), array)
+
+
+def test_lookup_tables():
+    n_e = Namespace("http://example.org/word/")
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic_kb(directory)
+        kb = KB()
+        kb.read_ttlplus(os.path.join(directory, 'kb.ttlplus'))
+        lookup = kb._get_lookup()
+        with_embedding = set(kb.graph.subjects(Config.HAS_EMBEDDING, None))
+        images = {s: str(o) for s, o in kb.graph.subject_objects(Config.HAS_IMAGE)}
+        entities = list(kb.graph.subject_objects(n_e.has_article))
+        assert len(lookup) == len(entities)
+        for subject, entity_id in entities:
+            assert lookup.subject(entity_id.value) == subject
+            assert lookup.entity_id(subject) == entity_id.value
+            assert lookup.has_embedding(entity_id.value) == (subject in with_embedding)
+            assert lookup.image(entity_id.value) == images.get(subject)
+        assert not lookup.exists(-1) and kb.select_similar(-1) == []
+
+
+def test_select_similar_by_vector_and_uri():
+    n_e = Namespace("http://example.org/word/")
+    with tempfile.TemporaryDirectory() as directory:
+        kb = synthetic_kb(directory, backend='brute_force')
+        entity_id = int(kb._id_map.external_ids[0])
+        ids, distances = kb.select_similar(entity_id, k_nearest=5, include_distances=True)
+        assert len(ids) == 5 and ids[0] == entity_id and distances == sorted(distances)
+        subject = kb._get_lookup().subject(entity_id)
+        assert kb.select_similar_by_uri(subject, k_nearest=5, include_distances=True) == (ids, distances)
+        assert kb.select_similar_by_vector(kb.get_embeddings([entity_id])[0], k_nearest=5) == ids
+        assert kb.select_similar(entity_id, k_nearest=5, search_k=1000) == ids
+        assert kb.select_similar_by_uri(n_e.unknown) == []
+
+
+
+def test_result_cache_threads():
+    with tempfile.TemporaryDirectory() as directory:
+        kb = synthetic_kb(directory, backend='brute_force')
+        entity_ids = [int(x) for x in kb._id_map.external_ids[:100]]
+        expected = {x: kb.select_similar(x, k_nearest=5) for x in entity_ids}
+        kb._reset_caches()
+        cache_size = Config.RESULT_CACHE_SIZE
+        # a small cache makes threads evict entries others are reading
+        Config.RESULT_CACHE_SIZE = 16
+        try:
+            queries = entity_ids * 20
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = list(pool.map(lambda x: kb.select_similar(x, k_nearest=5), queries))
+        finally:
+            Config.RESULT_CACHE_SIZE = cache_size
+        assert results == [expected[x] for x in queries]
+        info = kb.result_cache_info()
+        assert info['hits'] + info['misses'] == len(queries) and info['size'] <= 16
+
+def test_backends_agree():
+    with tempfile.TemporaryDirectory() as directory:
+        annoy = synthetic_kb(os.path.join(directory, 'annoy'), backend='annoy')
+        exact = synthetic_kb(os.path.join(directory, 'exact'), backend='brute_force')
+        entity_ids = annoy._id_map.external_ids[:100]
+        annoy_ids, annoy_distances = annoy.select_similar_many(entity_ids, k_nearest=10)
+        exact_ids, exact_distances = exact.select_similar_many(entity_ids, k_nearest=10)
+        assert (annoy_ids[:, 0] == entity_ids).all() and (exact_ids[:, 0] == entity_ids).all()
+        overlap = np.mean([len(set(x) & set(y)) / 10 for x, y in zip(annoy_ids.tolist(), exact_ids.tolist())])
+        assert overlap >= 0.9, overlap
+        # distances follow the same definition, so neighbors found by both are equally far
+        same = annoy_ids == exact_ids
+        assert np.allclose(annoy_distances[same], exact_distances[same], atol=1e-3)
+
+
+
+def test_backends_no_neighbors():
+    vectors = np.random.default_rng(0).random((20, 8), dtype=np.float32)
+    exact = BruteForceBackend.from_matrix(vectors)
+    annoy = AnnoyBackend(8)
+    for i, vector in enumerate(vectors):
+        annoy.add_item(i, vector)
+    annoy.build(2)
+    for backend in (exact, annoy):
+        assert backend.get_nns_by_vector(vectors[0], 0, include_distances=True) == ([], [])
+        assert backend.get_nns_by_item(0, 0) == []
+    assert exact.get_nns_by_vector(vectors[0], -1) == []
+    for ids, distances in (exact.get_nns_by_vectors(vectors[:3], 0), exact.get_nns_by_items([0, -1, 2], 0)):
+        assert ids.shape == distances.shape == (3, 0)
+
+def test_index_cache():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = os.path.join(directory, 'cache')
+        os.environ['KB_CACHE_DIR'] = cache
+        try:
+            built = synthetic_kb(directory)
+            # the writer keeps the index it built instead of copying it to the cache
+            assert not os.path.exists(cache)
+            fresh = KB()
+            fresh.read_ttlplus(os.path.join(directory, 'kb.ttlplus'))
+            digest = fresh._meta_dict['INDEX_SHA256']
+            assert os.listdir(cache) == [digest]
+            cached = KB()
+            cached.read_ttlplus(os.path.join(directory, 'kb.ttlplus'))
+            assert os.listdir(cache) == [digest]
+            entity_ids = built._id_map.external_ids[:50]
+            expected = built.select_similar_many(entity_ids)
+            for kb in (fresh, cached):
+                assert all(np.array_equal(x, y, equal_nan=True) for x, y in zip(kb.select_similar_many(entity_ids),
+                                                                                 expected))
+            # compaction replaces the archive, so the copy of the outdated index is removed
+            cached.update(remove_ids=entity_ids[:1])
+            cached.compact()
+            assert digest not in os.listdir(cache)
+        finally:
+            del os.environ['KB_CACHE_DIR']
+
+
+
+def test_cache_entry_removed_before_load():
+    vectors = np.random.default_rng(0).random((20, 8), dtype=np.float32)
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['KB_CACHE_DIR'] = os.path.join(directory, 'cache')
+        try:
+            index = AnnoyBackend(8)
+            for i, vector in enumerate(vectors):
+                index.add_item(i, vector)
+            index.build(2)
+            index.save(os.path.join(directory, AnnoyBackend.FILE_NAME))
+            with ZipFile(os.path.join(directory, 'index.zip'), 'w') as archive:
+                archive.write(os.path.join(directory, AnnoyBackend.FILE_NAME), AnnoyBackend.FILE_NAME)
+
+            loaded = AnnoyBackend(8)
+            paths = []
+
+            def load(path):
+                # another process removes the entry right after this one resolved its path
+                if not paths:
+                    remove_cached(os.path.basename(os.path.dirname(path)))
+                paths.append(path)
+                loaded.load(path)
+
+            with ZipFile(os.path.join(directory, 'index.zip')) as archive:
+                load_cached_member(archive, AnnoyBackend.FILE_NAME, load)
+            assert len(paths) == 2 and os.path.exists(paths[1]) and loaded.get_n_items() == 20
+
+            # an entry used just now survives pruning even if the cache is too big
+            prune_cache(max_bytes=0)
+            assert os.path.exists(paths[1])
+            prune_cache(max_bytes=0, grace_period=0)
+            assert not os.path.exists(paths[1])
+        finally:
+            del os.environ['KB_CACHE_DIR']
+
+def test_compact_graph():
+    n_e = Namespace("http://example.org/word/")
+    graph = Graph()
+    graph.add((n_e.a, RDF.type, n_e.item))
+    graph.add((n_e.a, n_e.has_article, Literal(1)))
+    graph.add((n_e.a, n_e.label, Literal("a\x00b", lang="en")))
+    graph.add((n_e.b, RDF.type, n_e.item))
+    graph.add((n_e.b, n_e.weight, Literal(1.5)))
+    graph.add((BNode("x"), n_e.label, Literal("1")))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'graph.zip')
+        with ZipFile(path, 'w') as archive:
+            CompactGraph.from_graph(graph).save(archive)
+        with ZipFile(path) as archive:
+            compact = CompactGraph.load(archive, path)
+            assert len(compact) == len(graph) and set(compact) == set(graph)
+            assert set(compact.subjects(RDF.type, n_e.item)) == {n_e.a, n_e.b}
+            assert set(compact.triples((n_e.a, None, None))) == set(graph.triples((n_e.a, None, None)))
+            assert set(compact.objects(None, n_e.label)) == {Literal("a\x00b", lang="en"), Literal("1")}
+            assert (n_e.b, n_e.weight, Literal(1.5)) in compact and (n_e.b, n_e.weight, Literal(2)) not in compact
+            assert set(compact.to_graph()) == set(graph)
+
+
+def test_embedding_sources():
+    with tempfile.TemporaryDirectory() as directory:
+        files = make_synthetic_kb(os.path.join(directory, 'files'), n_entities=300, vector_length=8)
+        stacked = make_synthetic_kb(os.path.join(directory, 'stacked'), n_entities=300, vector_length=8,
+                                    stacked_embeddings=True)
+        by_file = EmbeddingSource(files['embeddings_dir_path'], n_jobs=4, chunk_size=64)
+        by_matrix = EmbeddingSource(stacked['embeddings_dir_path'], chunk_size=100)
+        vectors = {start: chunk for start, chunk in by_file.chunks()}
+        assert sorted(vectors) == list(range(0, len(by_file), 64))
+        vectors = dict(zip(by_file.ids.tolist(), np.concatenate([vectors[x] for x in sorted(vectors)])))
+        matrix = np.concatenate([x for _, x in by_matrix.chunks()])
+        assert len(vectors) == len(by_matrix) and all(np.array_equal(vectors[x], y)
+                                                      for x, y in zip(by_matrix.ids.tolist(), matrix))
+
+        for bad, ids in ((np.full((3, 8), np.nan, dtype=np.float32), [1, 2, 3]),
+                         (np.zeros((3, 8), dtype=np.float32), [1, 2]),
+                         (np.zeros(8, dtype=np.float32), [1])):
+            try:
+                next(EmbeddingSource(bad, ids=ids, chunk_size=2).chunks())
+                raise AssertionError("invalid embeddings were accepted")
+            except ValueError:
+                pass
+
+
+def test_auto_tune():
+    with tempfile.TemporaryDirectory() as directory:
+        inputs = make_synthetic_kb(os.path.join(directory, 'input'), n_entities=2000, vector_length=32,
+                                   stacked_embeddings=True)
+        embeddings = EmbeddingSource(inputs.pop('embeddings_dir_path'))
+        held_out = np.zeros(len(embeddings), dtype=bool)
+        held_out[np.random.default_rng(0).choice(len(embeddings), size=200, replace=False)] = True
+        queries = np.concatenate([x for _, x in embeddings.subset(held_out).chunks()])
+
+        kb = KB()
+        kb.read_raw(out_bk_path_dir=directory, embeddings_dir_path=embeddings.subset(~held_out),
+                    build_options=BuildOptions(auto_tune=True, target_recall=0.9, recall_k=10), **inputs)
+        # queries which are not indexed can not find themselves, so they show the recall users get
+        exact_ids, _ = BruteForceBackend.from_matrix(kb._embeddings).get_nns_by_vectors(queries, 10)
+        ids, _ = kb.select_similar_many(vectors=queries, k_nearest=10)
+        exact_ids = kb._id_map.to_external_many(exact_ids)
+        recall = np.mean([len(set(x) & set(y)) / 10 for x, y in zip(ids.tolist(), exact_ids.tolist())])
+        assert recall >= 0.85, recall
+
+        kb = KB()
+        kb.read_raw(out_bk_path_dir=directory, embeddings_dir_path=embeddings,
+                    build_options=BuildOptions(auto_tune=True, n_trees=5), **inputs)
+        assert kb._meta_dict['N_TREES'] == 5
+
+
+def test_select_similar_filtered_small_search_k():
+    n_e = Namespace("http://example.org/word/")
+    with tempfile.TemporaryDirectory() as directory:
+        # a small fixed search_k, e.g. one chosen by auto tuning, should not starve selective filters
+        kb = synthetic_kb(os.path.join(directory, 'annoy'), n_entities=2000, search_k=30)
+        exact = synthetic_kb(os.path.join(directory, 'exact'), n_entities=2000, backend='brute_force')
+        allowed = {kb._entity_id(x) for x in kb.graph.subjects(n_e.category, n_e.c3)}
+        assert len(allowed) < len(kb._id_map) / 10
+        entity_ids = [x for x in kb._id_map.external_ids[:50].tolist() if x not in allowed]
+        overlap = []
+        for entity_id in entity_ids:
+            ids = kb.select_similar(entity_id, k_nearest=3, filter_by=(n_e.category, n_e.c3))
+            assert len(ids) == 3 and set(ids) <= allowed
+            overlap.append(len(set(ids) & set(exact.select_similar(entity_id, k_nearest=3,
+                                                                   filter_by=(n_e.category, n_e.c3)))) / 3)
+        assert np.mean(overlap) >= 0.9, np.mean(overlap)
+        ids, _ = kb.select_similar_many(entity_ids, k_nearest=3, filter_by=(n_e.category, n_e.c3))
+        assert (ids >= 0).all()
+
+
+def test_knn_table():
+    with tempfile.TemporaryDirectory() as directory:
+        kb = synthetic_kb(os.path.join(directory, 'table'), build_options=BuildOptions(knn_k=20))
+        exact = synthetic_kb(os.path.join(directory, 'exact'), backend='brute_force')
+        entity_ids = kb._id_map.external_ids[:50].tolist()
+        overlap = []
+        for entity_id in entity_ids:
+            # rows of the table are what the index finds for the full table width
+            ids, distances = kb.select_similar(entity_id, include_distances=True)
+            nearest, expected = kb._index.get_nns_by_item(kb._id_map.to_internal(entity_id), 20,
+                                                          search_k=kb._search_k(), include_distances=True)
+            assert ids == kb._id_map.to_external_many(nearest[:10]).tolist()
+            assert np.allclose(distances, expected[:10], atol=1e-3)
+            overlap.append(len(set(ids) & set(exact.select_similar(entity_id))) / 10)
+        assert np.mean(overlap) >= 0.9, np.mean(overlap)
+        assert kb.result_cache_info()['misses'] == 0
+
+        # more neighbors than the table has are searched and cached
+        assert len(kb.select_similar(entity_ids[0], k_nearest=50)) == 50
+        assert kb.select_similar(entity_ids[0], k_nearest=50) == kb.select_similar(entity_ids[0], k_nearest=50)
+        assert kb.result_cache_info()['misses'] == 1 and kb.result_cache_info()['hits'] == 2
+
+
+def test_sharded():
+    with tempfile.TemporaryDirectory() as directory:
+        inputs = make_synthetic_kb(os.path.join(directory, 'input'), n_entities=500, vector_length=16)
+        exact = KB()
+        os.makedirs(os.path.join(directory, 'exact'))
+        exact.read_raw(out_bk_path_dir=os.path.join(directory, 'exact'), backend='brute_force', **inputs)
+
+        out_dir = os.path.join(directory, 'sharded')
+        kb = ShardedKB()
+        kb.read_raw(out_bk_path_dir=out_dir, n_shards=4, processes=False, backend='brute_force', **inputs)
+        assert len(kb.shards) == 4
+        entity_ids = exact._id_map.external_ids[:20]
+        for entity_id in entity_ids.tolist():
+            assert kb.shard_of(entity_id) is kb.shards[entity_id % 4]
+        kb.close()
+
+        # neighbors merged across shards are the neighbors of the whole knowledge base
+        kb = ShardedKB()
+        kb.read_manifest(os.path.join(out_dir, Config.SHARD_MANIFEST_FILE))
+        ids, distances = kb.select_similar_many(entity_ids, k_nearest=5)
+        expected_ids, expected_distances = exact.select_similar_many(entity_ids, k_nearest=5)
+        assert ids.shape == (20, 5)
+        assert np.allclose(distances, expected_distances, atol=1e-3)
+        assert np.mean(ids == expected_ids) >= 0.95
+        assert kb.select_similar(int(entity_ids[0]), k_nearest=5) == ids[0].tolist()
+        kb.close()
+
+
+def test_get_images():
+    with tempfile.TemporaryDirectory() as directory:
+        kb = synthetic_kb(directory, n_entities=100, thumbnail_size=16)
+        with_image = [int(x[:-len('.png')]) for x in os.listdir(os.path.join(directory, 'input', 'images'))]
+        without_image = sorted(set(kb._id_map.external_ids.tolist()) - set(with_image))[0]
+        entity_ids = [with_image[0], without_image, with_image[0]]
+
+        images = kb.get_images(entity_ids)
+        assert images[1] is None and np.array_equal(images[0], images[2])
+        assert images[0].shape == (32, 32, 3) and images[0].dtype == np.float32 and not images[0].flags.writeable
+        assert 0 <= images[0].min() and images[0].max() <= 1
+        assert kb.get_image(with_image[0]) is kb.get_image(with_image[0])
+        assert kb.image_cache_info()['hits'] == 2 and kb.image_cache_info()['size'] == 1
+
+        # thumbnails are stored in the archive and cached apart from images
+        thumbnail = kb.get_image(with_image[0], thumbnail=True)
+        assert thumbnail.shape == (16, 16, 3)
+        with open(os.path.join(directory, 'input', 'images', f"{with_image[0]}.png"), 'rb') as f:
+            assert kb.get_image_bytes(with_image[0]) == f.read()
+        assert kb.get_image_bytes(without_image) is None
+        assert kb.image_cache_info()['size'] == 2
+        figure = kb.show_images(entity_ids, title="image with thumbnail")
+        assert len(figure.axes) == len(entity_ids)
+        plt.close(figure)
+
+
+def test_verify_archive():
+    with tempfile.TemporaryDirectory() as directory:
+        kb = synthetic_kb(directory)
+        ttlplus = kb._archive_path
+        expected = kb.select_similar(int(kb._id_map.external_ids[0]))
+        with ZipFile(ttlplus) as archive:
+            verify_archive(archive, ttlplus, full=True)
+            sections = json.loads(archive.read(Config.ARCHIVE_MANIFEST_FILE))['sections']
+        del kb
+
+        kb = KB()
+        kb.read_ttlplus(ttlplus, verify=True)
+        assert kb.select_similar(int(kb._id_map.external_ids[0])) == expected
+        del kb
+
+        # flip a byte in the middle of a stored member, the quick check only looks at the layout
+        section = next(x for x in sections if x['compress_type'] == ZIP_STORED and x['size'] > 0)
+        with open(ttlplus, 'r+b') as f:
+            f.seek(section['offset'] + section['size'] // 2)
+            value = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([value[0] ^ 0xff]))
+        with ZipFile(ttlplus) as archive:
+            verify_archive(archive, ttlplus)
+            try:
+                verify_archive(archive, ttlplus, full=True)
+                assert False, "corrupt member was not detected"
+            except BadZipFile as e:
+                assert section['name'] in str(e)
+        try:
+            KB().read_ttlplus(ttlplus, verify=True)
+            assert False, "corrupt archive was read"
+        except BadZipFile:
+            pass
+
+
+def test_lazy_read_imports():
+    code = ("import sys\n"
+            "from src.kb import KB\n"
+            "kb = KB()\n"
+            "kb.read_ttlplus(sys.argv[1], lazy=True)\n"
+            "assert len(kb.select_similar(int(sys.argv[2]))) == 10\n"
+            "assert 'rdflib' not in sys.modules, 'lazy read imported rdflib'\n")
+    with tempfile.TemporaryDirectory() as directory:
+        kb = synthetic_kb(directory)
+        assert isinstance(kb._meta_dict['ENTITY_PREDICATE'], str)
+        entity_id = int(kb._id_map.external_ids[0])
+        # the test module imports rdflib itself, so the check runs in a fresh interpreter
+        subprocess.run([sys.executable, '-c', code, kb._archive_path, str(entity_id)], check=True)
+
+        # archives written before keep rdflib terms in metadata
+        entity = kb._entity_term('ENTITY')
+        assert isinstance(entity, URIRef)
+        kb._meta_dict['ENTITY'] = entity
+        assert kb._entity_term('ENTITY') == entity
+
+
+def test_micro_batcher():
+    calls = []
+
+    def answer(key, queries):
+        calls.append(len(queries))
+        if (queries < 0).any():
+            raise ValueError("negative query")
+        return queries * 2,
+
+    async def submit_all():
+        batcher = MicroBatcher(answer, window=0.05)
+        return await asyncio.gather(*(batcher.submit('key', np.array(x)) for x in ([1, 2], [-1], [3])),
+                                    return_exceptions=True)
+
+    # the bad request fails alone, the others are answered once it is retried apart from them
+    good, bad, other = asyncio.run(submit_all())
+    assert calls == [4, 2, 1, 1]
+    assert good[0].tolist() == [2, 4] and other[0].tolist() == [6] and isinstance(bad, ValueError)
+
+    for request in ({'k_nearest': True}, {'k_nearest': 0}, {'search_k': False}, {'filter_by': 1}):
+        try:
+            KBServer._search_key(request)
+            assert False, f"{request} was accepted"
+        except ValueError:
+            pass
+    assert KBServer._search_key({'k_nearest': 5, 'filter_by': [3, 1, 3]}) == (5, None, (1, 3))
+
+
+def test_metrics_hooks_and_profiling():
+    metrics = Metrics(enabled=True)
+    seen = []
+
+    def failing_hook(kind, name, value):
+        raise RuntimeError(f"hook failed on {name}")
+
+    metrics.add_hook(failing_hook)
+    metrics.add_hook(lambda kind, name, value: seen.append((kind, name)))
+    # a failing hook is logged and the ones after it still run
+    metrics.count('queries')
+    assert metrics.snapshot()['counters'] == {'queries': 1} and seen == [('count', 'queries')]
+    metrics.remove_hook(failing_hook)
+
+    # nested and concurrent calls are timed while one of them is profiled
+    metrics.enable(profile_calls='cpu')
+
+    def inner():
+        return sum(range(1000))
+
+    def outer():
+        return metrics.call('inner', inner)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda _: metrics.call('outer', outer), range(20)))
+    assert results == [sum(range(1000))] * 20
+    snapshot = metrics.snapshot()
+    assert snapshot['latency']['outer']['count'] == 20 and snapshot['latency']['inner']['count'] == 20
+    assert 'outer' in snapshot['profiles'] and 'inner' not in snapshot['profiles']
+
+
+def test_update_requires_entities():
+    with tempfile.TemporaryDirectory() as directory:
+        kb = synthetic_kb(directory, backend='brute_force')
+        b = int(kb._id_map.external_ids[0])
+        a = kb.select_similar(b)[1]
+        assert b in kb.select_similar(a)
+        subject = kb._get_lookup().subject(b)
+        triples = Graph()
+        for triple in kb.graph.triples((subject, None, None)):
+            triples.add(triple)
+        vector = kb.get_embeddings([b])
+        kb.update(remove_ids=[b])
+        assert b not in kb.select_similar(a, k_nearest=50)
+
+        # an embedding of a removed entity would be found without an entity behind it
+        for ids in ([b], [10 ** 9]):
+            try:
+                kb.update(embeddings_path=vector, embedding_ids=ids)
+                assert False, "embeddings of a missing entity were accepted"
+            except ValueError:
+                pass
+        assert b not in kb.select_similar(a, k_nearest=50) and kb.select_similar(b) == []
+
+        # added back along with its triples, the entity is found and finds its neighbors again
+        triples.serialize(os.path.join(directory, 'b.nt'), format='nt', encoding='utf-8')
+        kb.update(data_ttl_path=os.path.join(directory, 'b.nt'), embeddings_path=vector, embedding_ids=[b])
+        assert b in kb.select_similar(a, k_nearest=50) and kb.select_similar(b)[0] == b
+        kb.compact()
+        assert kb.select_similar(b)[0] == b and kb._get_lookup().exists(b)
+
+
+def test_update():
+    n_e = Namespace("http://example.org/word/")
+    with tempfile.TemporaryDirectory() as directory:
+        kb = synthetic_kb(directory, backend='brute_force')
+        entity_ids = kb._id_map.external_ids[:20].tolist()
+        removed = entity_ids[:5]
+        # added entities are copies of kept ones, so each of them is the closest neighbor of its original
+        originals = entity_ids[10:15]
+        added = list(range(900000, 900005))
+        graph = Graph()
+        for entity_id in added:
+            graph.add((n_e[f"new{entity_id}"], RDF.type, n_e.item))
+            graph.add((n_e[f"new{entity_id}"], n_e.has_article, Literal(entity_id)))
+        graph.serialize(os.path.join(directory, 'new.nt'), format='nt', encoding='utf-8')
+        kb.update(data_ttl_path=os.path.join(directory, 'new.nt'), embeddings_path=kb.get_embeddings(originals),
+                  embedding_ids=added, remove_ids=removed)
+
+        def check(kb):
+            ids, _ = kb.select_similar_many(entity_ids, k_nearest=50)
+            assert not np.isin(ids, removed).any()
+            assert (ids[:5] == -1).all() and kb.select_similar(removed[0]) == []
+            for original, copy in zip(originals, added):
+                assert set(kb.select_similar(original, k_nearest=2)) == {original, copy}
+                assert kb.select_similar(copy, k_nearest=2, include_distances=True)[1][0] < 1e-3
+            assert len(kb.graph.query("SELECT ?s WHERE { ?s a <http://example.org/word/item> }")) == 500
+
+        check(kb)
+        # changes survive a reread of the delta and compaction into a new archive
+        kb = KB()
+        kb.read_ttlplus(os.path.join(directory, 'kb.ttlplus'))
+        check(kb)
+        kb.compact()
+        assert not os.path.exists(DeltaSegment.path_for(os.path.join(directory, 'kb.ttlplus')))
+        check(kb)
+        kb = KB()
+        kb.read_ttlplus(os.path.join(directory, 'kb.ttlplus'))
+        assert kb._delta is None or not len(kb._delta)
+        check(kb)
+
+
+def test_compact_graph_from_store():
+    n_e = Namespace("http://example.org/word/")
+    graph = Graph()
+    graph.add((n_e.a, n_e.label, Literal("a\x00b", lang="en")))
+    graph.add((BNode("x"), n_e.weight, Literal(1.5)))
+    for i in range(Config.GRAPH_STORE_BATCH + 10):
+        graph.add((n_e[f"e{i}"], RDF.type, n_e.item))
+        graph.add((n_e[f"e{i}"], n_e.has_article, Literal(i)))
+    with tempfile.TemporaryDirectory() as directory:
+        store_graph = SQLiteStore.graph(os.path.join(directory, Config.GRAPH_STORE_FILE))
+        store_graph += graph
+        # SQLite orders terms the way the in-memory encoder does, so both give the same arrays
+        compact = store_graph.store.to_compact_graph(directory)
+        expected = CompactGraph.from_graph(graph)
+        assert np.array_equal(compact._terms.data, expected._terms.data)
+        assert np.array_equal(compact._terms.offsets, expected._terms.offsets)
+        assert np.array_equal(compact._triples, expected._triples)
+        assert set(compact.triples((n_e.a, None, None))) == set(graph.triples((n_e.a, None, None)))
+        del compact
+        store_graph.close()
+
+
+def test_read_raw_ntriples():
+    n_e = Namespace("http://example.org/word/")
+    query = "SELECT ?s WHERE { ?s a <http://example.org/word/item> }"
+    with tempfile.TemporaryDirectory() as directory:
+        expected = synthetic_kb(os.path.join(directory, 'ttl'), backend='brute_force')
+        entity_ids = expected._id_map.external_ids[:20]
+        expected_ids, expected_distances = expected.select_similar_many(entity_ids)
+
+        # N-Triples are parsed in chunks by worker processes into a disk-backed store
+        inputs = make_synthetic_kb(os.path.join(directory, 'input'), n_entities=500, vector_length=16,
+                                   data_format='nt.gz')
+        out_dir = os.path.join(directory, 'nt')
+        os.makedirs(out_dir)
+        kb = KB()
+        kb.read_raw(out_bk_path_dir=out_dir, backend='brute_force', n_jobs=4, on_disk_graph=True, **inputs)
+        ids, distances = kb.select_similar_many(entity_ids)
+        assert np.array_equal(ids, expected_ids) and np.allclose(distances, expected_distances, equal_nan=True)
+        assert len(kb.graph) == len(expected.graph)
+        assert set(kb.graph.subjects(n_e.category, n_e.c3)) == set(expected.graph.subjects(n_e.category, n_e.c3))
+
+        kb = KB()
+        kb.read_ttlplus(os.path.join(out_dir, 'kb.ttlplus'), on_disk_graph=True)
+        assert len(kb.graph) == len(expected.graph)
+        assert len(kb.graph.query(query)) == len(expected.graph.query(query)) == 500
+        assert kb.select_similar(int(entity_ids[0])) == expected_ids[0].tolist()
+
+
+def test_benchmark():
+    with tempfile.TemporaryDirectory() as directory:
+        out_path = os.path.join(directory, 'results.json')
+        results = run_benchmark(directory=os.path.join(directory, 'benchmark'), n_entities=500, n_queries=50,
+                                n_repeats=1, out_path=out_path)
+        assert {'params', 'environment', 'generate', 'build', 'enrich', 'archive_bytes', 'read', 'query',
+                'recall'} <= set(results)
+        assert results['recall']['k'] == 10 and 0 < results['recall']['recall'] <= 1
+        assert {'cold', 'cold_lazy', 'warm'} <= set(results['read']) and results['archive_bytes'] > 0
+        with open(out_path) as f:
+            assert json.load(f)['recall'] == results['recall']
+
+
+def test_server():
+    with tempfile.TemporaryDirectory() as directory:
+        kb = synthetic_kb(directory, backend='brute_force')
+        kb.metrics.enable()
+        entity_ids = kb._id_map.external_ids[:20].tolist()
+        vector = kb.get_embeddings(entity_ids[:1])[0]
+        with KBServer(kb, port=0, n_workers=2) as server:
+            with KBClient(*server.address) as client:
+                assert client.health()['status'] == 'ok'
+                assert client.select_similar(entity_ids[0], include_distances=True) == \
+                    kb.select_similar(entity_ids[0], include_distances=True)
+                assert client.select_similar_by_vector(vector, k_nearest=5) == \
+                    kb.select_similar_by_vector(vector, k_nearest=5)
+                ids, distances = client.select_similar_many(entity_ids + [-1], k_nearest=5)
+                expected_ids, expected_distances = kb.select_similar_many(entity_ids + [-1], k_nearest=5)
+                assert np.array_equal(ids, expected_ids)
+                assert np.array_equal(distances, expected_distances, equal_nan=True)
+                assert np.array_equal(client.get_embeddings(entity_ids), kb.get_embeddings(entity_ids))
+                assert 'pid' in client.metrics() and 'counters' in client.metrics()
+                try:
+                    client.select_similar(entity_ids[0], k_nearest=0)
+                    assert False, "invalid request was answered"
+                except ValueError:
+                    pass
+
+
+def test_select_similar_many():
+    with tempfile.TemporaryDirectory() as directory:
+        kb = synthetic_kb(directory)
+        entity_ids = kb._id_map.external_ids[:30].tolist()
+        queries = entity_ids + [-1, entity_ids[0]]
+        ids, distances = kb.select_similar_many(queries, k_nearest=5, n_jobs=4)
+        assert ids.shape == distances.shape == (32, 5) and ids.dtype == np.int64
+        for row, entity_id in enumerate(entity_ids):
+            expected_ids, expected_distances = kb.select_similar(entity_id, k_nearest=5, include_distances=True)
+            assert ids[row].tolist() == expected_ids and np.allclose(distances[row], expected_distances)
+        # rows of missing entities and slots without a neighbor are padded
+        assert (ids[30] == -1).all() and np.isnan(distances[30]).all()
+        assert np.array_equal(ids[31], ids[0])
+        allowed = set(entity_ids[:3])
+        ids, distances = kb.select_similar_many(entity_ids[:2], k_nearest=5, filter_by=allowed)
+        assert set(ids[:, :3].ravel().tolist()) <= allowed and (ids[:, 3:] == -1).all()
+        assert np.isnan(distances[:, 3:]).all() and not np.isnan(distances[:, :3]).any()
+
+        vectors = kb.get_embeddings(entity_ids[:4])
+        ids, distances = kb.select_similar_many(vectors=vectors, k_nearest=5)
+        assert ids.shape == (4, 5) and ids[:, 0].tolist() == entity_ids[:4]
+        assert ids[0].tolist() == kb.select_similar_by_vector(vectors[0], k_nearest=5)
+
+
+def test_enrich_report():
+    n_e = Namespace("http://example.org/word/")
+    graph = Graph()
+    for i, entity_id in enumerate([10, 11, 12, 13, 14, 14]):
+        graph.add((n_e[f"e{i}"], RDF.type, n_e.item))
+        graph.add((n_e[f"e{i}"], n_e.has_article, Literal(entity_id)))
+    # entities of other types are not enriched even if they have an id
+    graph.add((n_e.other, RDF.type, n_e.category))
+    graph.add((n_e.other, n_e.has_article, Literal(10)))
+    with tempfile.TemporaryDirectory() as directory:
+        embeddings, images = os.path.join(directory, 'embeddings'), os.path.join(directory, 'images')
+        os.makedirs(embeddings)
+        os.makedirs(images)
+        for entity_id in (10, 11, 12, 14, 99):
+            np.save(os.path.join(embeddings, f"{entity_id}.npy"), np.zeros(4, dtype=np.float32))
+        open(os.path.join(images, "11.png"), 'wb').close()
+
+        # triples the enrichment used to add one at a time
+        expected = Graph()
+        expected += graph
+        for subject, entity_id in graph.subject_objects(n_e.has_article):
+            if (subject, RDF.type, n_e.item) in graph:
+                if entity_id.value != 13:
+                    expected.add((subject, Config.HAS_EMBEDDING, Literal(f"{entity_id.value}.npy")))
+                if entity_id.value == 11:
+                    expected.add((subject, Config.HAS_IMAGE, Literal("11.png")))
+
+        report = dict()
+        enriched = KB.enrich(graph=graph, emb_path=embeddings, has_id_name=n_e.has_article, entity_type=n_e.item,
+                             img_path=images, report=report)
+        assert report == {'entities': 6, 'matched': 5, 'no_embedding': 1, 'images': 1, 'duplicate_ids': 1}
+        metadata = set(KB._reify_with_metadata(Graph()))
+        assert set(enriched) - metadata == set(expected)